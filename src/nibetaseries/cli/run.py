@@ -77,12 +77,29 @@ def get_parser():
                          help='setting this option returns the residuals from the model'
                               'while straightforward for LSA, for any other methods, take'
                               'the residuals with a grain of salt.')
+    wf_args.add_argument('--return-masked-betaseries', action='store_true', default=False,
+                         help='also output each beta series as a float32 trials by masked '
+                              'voxels numpy (.npy) file with the mask of its voxels, '
+                              'that can be memory mapped without decompressing or masking '
+                              'the beta series image.')
 
     # preprocessing options
     proc_opts = parser.add_argument_group('Options for processing')
     proc_opts.add_argument('--estimator', default='lss',
                            choices=['lss', 'lsa'],
                            help='beta series modeling method')
+    proc_opts.add_argument('--estimation-space', default='voxels',
+                           choices=['voxels', 'parcels'],
+                           help='fit the beta series models on the time series of every '
+                                'voxel, or on the mean time series of every parcel of '
+                                '--atlas-img. Parcel beta series (tsv) are much faster to '
+                                'estimate when only the roi-roi correlations are needed')
+    proc_opts.add_argument('--restrict-to-atlas', action='store_true', default=False,
+                           help='only model the voxels of the brain mask with a label in '
+                                '--atlas-img, the voxels the correlations are computed from. '
+                                'Cortical atlases need fewer voxels to be fit. The outlier '
+                                'beta series volumes dropped before the correlations are '
+                                'also found from the voxels of the atlas')
     proc_opts.add_argument('-sm', '--smoothing-kernel', action='store', type=float, default=None,
                            help='select a smoothing kernel (mm)')
     proc_opts.add_argument('-hp', '--high-pass', action='store', type=float,
@@ -91,6 +108,19 @@ def get_parser():
                            'that are to be included in nuisance regression. '
                            'write the confounds you wish to include separated by a space',
                            nargs="+")
+    proc_opts.add_argument('--censor-outliers', action='store_true', default=False,
+                           help='drop the volumes flagged by the outlier (spike) confounds '
+                                'selected with --confounds (e.g., "motion_outlier.*") from '
+                                'the model, instead of adding a regressor for each outlier. '
+                                'The beta estimates are the same, with a narrower design')
+    proc_opts.add_argument('--noise-model', default='ar1', choices=['ar1', 'ols'],
+                           help='temporal noise model, AR(1) prewhitening or none '
+                                '(ordinary least squares, the fastest)')
+    proc_opts.add_argument('--ar1-estimate', default='trial', choices=['trial', 'condition'],
+                           help='estimate the AR(1) coefficients from each lss trial model, '
+                                'or once from the model with one regressor per condition. '
+                                'The data are then prewhitened once for all the trial models, '
+                                'which are much faster to fit')
     proc_opts.add_argument('--hrf-model', default='glover',
                            choices=['glover', 'spm', 'fir',
                                     'glover + derivative',
@@ -102,6 +132,12 @@ def get_parser():
     proc_opts.add_argument('--fir-delays', default=None,
                            nargs='+', type=int, help='FIR delays in volumes',
                            metavar='VOL')
+    proc_opts.add_argument('--trial-types', default=None, nargs='+',
+                           help='trial types (or regular expressions, e.g., "go.*") whose '
+                                'trials are modeled as target trials (lss only). The events '
+                                'of the other trial types stay in the model as conditions, '
+                                'but are not fit and have no beta series',
+                           metavar='TRIAL_TYPE')
     proc_opts.add_argument('-w', '--work-dir', help='directory where temporary files '
                            'are stored (i.e. non-essential files). '
                            'This directory can be deleted once you are reasonably '
@@ -113,6 +149,13 @@ def get_parser():
     proc_opts.add_argument('--normalize-betas', action='store_true', default=False,
                            help='beta estimates will be divided by the square root '
                                 'of their variance')
+    proc_opts.add_argument('--beta-series-format', default='nifti',
+                           choices=['nifti', 'hdf5'],
+                           help='file format of the beta series. nifti writes a 4D image '
+                                '(.nii.gz) per trial type, hdf5 writes the trials by '
+                                'masked voxels (.h5) in compressed chunks (with the mask '
+                                'and affine) to read single trials or blocks of voxels '
+                                '(requires h5py)')
 
     # Image Selection options
     bids_opts = parser.add_argument_group('Options for selecting images')
@@ -146,6 +189,43 @@ def get_parser():
     g_perfm = parser.add_argument_group('Options to handle performance')
     g_perfm.add_argument('--nthreads', '-n-cpus', action='store', type=int,
                          help='maximum number of threads across all processes')
+    g_perfm.add_argument('--n-jobs', action='store', type=int, default=1,
+                         help='number of workers fitting the trial models of a bold run '
+                              'in parallel (LSS only). Values below 1 use all of the '
+                              'threads available (see --nthreads). The nifti outputs of '
+                              'an LSS bold run are also compressed by as many threads. With '
+                              '--return-residuals, each worker sums the residuals of its '
+                              'trials in an array as large as the masked bold run '
+                              '(memory mapped with --mem-budget-gb)')
+    g_perfm.add_argument('--mem-budget-gb', action='store', type=float, default=None,
+                         help='memory budget (in gigabytes) for fitting the model(s) of a '
+                              'bold run. The bold data, the beta series, and the residuals '
+                              'are memory mapped and the model(s) are fit in blocks of '
+                              'voxels that fit in the budget')
+    g_perfm.add_argument('--precision', action='store', default='float64',
+                         choices=['float64', 'float32'],
+                         help='floating point precision of the bold data, the model fits, '
+                              'the beta series, and the correlations. float32 halves the '
+                              'memory use and the size of the beta series files')
+    g_perfm.add_argument('--cache-bold', action='store_true', default=False,
+                         help='decompress each gzipped bold run once into the working '
+                              'directory (see --work-dir). The uncompressed runs are memory '
+                              'mapped and reused by reruns, at the cost of their disk space')
+    g_perfm.add_argument('--batch-runs', action='store_true', default=False,
+                         help='fit all the bold runs of a subject one after the other in a '
+                              'single process, that shares the design factorizations and '
+                              'reads the next run while a run is fit, instead of a process '
+                              'per run')
+    g_perfm.add_argument('--cache-designs', action='store_true', default=False,
+                         help='cache the factorizations of the design matrices in the '
+                              'working directory (see --work-dir). The runs and subjects '
+                              'with identical designs (events, repetition time, confounds) '
+                              'reuse them instead of factorizing their designs again')
+    g_perfm.add_argument('--compression-level', action='store', type=int, default=1,
+                         choices=range(10), metavar='[0-9]',
+                         help='gzip compression level of the nifti outputs (beta series, '
+                              'residuals). 1 is the fastest, 9 the smallest, and 0 saves '
+                              'uncompressed .nii files')
     g_perfm.add_argument('--use-plugin', action='store', default=None,
                          help='nipype plugin configuration file')
 
@@ -169,6 +249,14 @@ def main():
     if (opts.hrf_model == 'fir') and (opts.fir_delays is None):
         raise ValueError('If the FIR HRF model is selected, '
                          'FIR delays must be provided.')
+    if opts.trial_types and (opts.estimator != 'lss'):
+        raise ValueError('Trial types can only be selected with the lss estimator.')
+    if (opts.estimation_space == 'parcels') and not (opts.atlas_img and opts.atlas_lut):
+        raise ValueError('If the parcels estimation space is selected, '
+                         'an atlas image and lookup table must be provided.')
+    if opts.restrict_to_atlas and not (opts.atlas_img and opts.atlas_lut):
+        raise ValueError('If the beta series are restricted to the atlas, '
+                         'an atlas image and lookup table must be provided.')
 
     # Set up directories
     # TODO: set up some sort of versioning system
@@ -232,6 +320,11 @@ def main():
             nthreads = cpu_count()
         plugin_settings['plugin_args']['n_procs'] = nthreads
 
+    # a single betaseries node cannot use more threads than the plugin offers
+    n_jobs = opts.n_jobs
+    if n_jobs < 1 or n_jobs > nthreads:
+        n_jobs = nthreads
+
     # Nipype config (logs and execution)
     ncfg.update_config({
         'logging': {'log_directory': log_dir,
@@ -258,17 +351,31 @@ def main():
     if opts.analysis_level == "participant":
         nibetaseries_participant_wf = init_nibetaseries_participant_wf(
             estimator=opts.estimator,
+            ar1_estimate=opts.ar1_estimate,
             atlas_img=atlas_img,
             atlas_lut=atlas_lut,
+            batch_runs=opts.batch_runs,
+            beta_series_format=opts.beta_series_format,
             bids_dir=bids_dir,
+            cache_bold=opts.cache_bold,
+            cache_designs=opts.cache_designs,
+            censor_outliers=opts.censor_outliers,
+            compression_level=opts.compression_level,
             database_path=opts.database_path,
             derivatives_pipeline_dir=derivatives_pipeline_dir,
+            estimation_space=opts.estimation_space,
             exclude_description_label=opts.exclude_description_label,
             fir_delays=opts.fir_delays,
             hrf_model=opts.hrf_model,
             high_pass=opts.high_pass,
+            mem_budget_gb=opts.mem_budget_gb,
+            n_jobs=n_jobs,
+            noise_model=opts.noise_model,
             norm_betas=opts.normalize_betas,
             output_dir=output_dir,
+            precision=opts.precision,
+            restrict_to_atlas=opts.restrict_to_atlas,
+            return_masked_betaseries=opts.return_masked_betaseries,
             return_residuals=opts.return_residuals,
             run_label=opts.run_label,
             signal_scaling=signal_scaling,
@@ -278,6 +385,7 @@ def main():
             space_label=opts.space_label,
             subject_list=subject_list,
             task_label=opts.task_label,
+            trial_types=opts.trial_types,
             description_label=opts.description_label,
             work_dir=work_dir,
         )
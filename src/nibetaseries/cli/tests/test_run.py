@@ -129,3 +129,21 @@ def test_fir_delays(monkeypatch):
         main()
 
     assert "If the FIR HRF model is selected" in str(no_delays.value)
+
+
+def test_restrict_to_atlas(monkeypatch):
+    import sys
+
+    parser_args = [
+            'nibs',
+            'bids_dir',
+            'derivatives_pipeline',
+            'output_dir',
+            'participant',
+            '--restrict-to-atlas',
+    ]
+    monkeypatch.setattr(sys, 'argv', parser_args)
+    with pytest.raises(ValueError) as no_atlas:
+        main()
+
+    assert "If the beta series are restricted to the atlas" in str(no_atlas.value)
@@ -12,17 +12,28 @@ from nipype.interfaces.base import (
 
 class CensorVolumesInputSpec(BaseInterfaceInputSpec):
     timeseries_file = File(exists=True, mandatory=True,
-                           desc="a 4d nifti file")
+                           desc="a 4d nifti file (or an hdf5 or parcel (tsv) beta series)")
     mask_file = File(exists=True, mandatory=True,
                      desc='binary mask for the 4d nifti file')
     threshold = traits.Float(default_value=10.0,
                              usedefault=True,
                              desc="the modified z-score to use as a threshold")
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc="floating point precision of the censored file")
+    compression_level = traits.Range(low=0, high=9, value=1, usedefault=True,
+                                     desc="gzip compression level of the censored file"
+                                          " (0 saves an uncompressed .nii file)")
+    compression_threads = traits.Int(1, usedefault=True,
+                                     desc="number of threads compressing the censored file")
+    mem_budget_gb = traits.Either(None, traits.Float(), default=None, usedefault=True,
+                                  desc="memory budget (in gigabytes) to read the volumes"
+                                       " in batches (with memory mapped masked and"
+                                       " censored volumes)")
 
 
 class CensorVolumesOutputSpec(TraitedSpec):
     censored_file = File(exists=True,
-                         desc="a 4d nifti file with extreme volumes removed")
+                         desc="a 4d nifti file (or tsv file) with extreme volumes removed")
     outliers = traits.Array(desc="boolean array indicating which indices are noise")
 
 
@@ -33,21 +44,90 @@ class CensorVolumes(SimpleInterface):
     output_spec = CensorVolumesOutputSpec
 
     def _run_interface(self, runtime):
+        import os
         import nibabel as nib
+        import numpy as np
         from nipype.utils.filemanip import fname_presuffix
-
-        bold_img = nib.load(self.inputs.timeseries_file)
+        from .nistats import (load_beta_series, _load_bold, _iter_volumes,
+                              _nifti_extension, _save_nifti)
+
+        if self.inputs.timeseries_file.endswith('.tsv'):
+            # a parcel beta series, one row per trial
+            import pandas as pd
+
+            timeseries = pd.read_csv(self.inputs.timeseries_file, sep='\t')
+            outliers = is_outlier(timeseries.values.astype(self.inputs.precision),
+                                  thresh=self.inputs.threshold)
+            out = fname_presuffix(self.inputs.timeseries_file, suffix='_censored')
+            timeseries[~outliers].to_csv(out, sep='\t', index=False)
+
+            self._results['censored_file'] = out
+            self._results['outliers'] = outliers
+            return runtime
+
+        if self.inputs.timeseries_file.endswith('.h5'):
+            bold_img = load_beta_series(self.inputs.timeseries_file)
+        else:
+            bold_img = _load_bold(self.inputs.timeseries_file)
         bold_mask_img = nib.load(self.inputs.mask_file)
-
-        bold_data = bold_img.get_fdata()
         bold_mask = bold_mask_img.get_fdata().astype(bool)
 
-        outliers = is_outlier(bold_data[bold_mask].T, thresh=self.inputs.threshold)
-
-        out = fname_presuffix(self.inputs.timeseries_file, suffix='_censored')
-
-        bold_img.__class__(bold_data[..., ~outliers],
-                           bold_img.affine, bold_img.header).to_filename(out)
+        # the volumes are read in batches, twice: to find the outliers
+        # from the masked volumes and to copy the other volumes
+        # (with a memory budget, the masked volumes and the censored volumes are
+        # memory mapped in the working directory, and the outliers are found
+        # from blocks of voxels)
+        n_scans = bold_img.shape[3]
+        n_volumes = n_scans
+        block_size = None
+        memmap_file = os.path.join(runtime.cwd, 'desc-censormasked_bold.npy')
+        censored_file = os.path.join(runtime.cwd, 'desc-censored_bold4d.npy')
+        if self.inputs.mem_budget_gb is not None:
+            budget = self.inputs.mem_budget_gb * 1024 ** 3
+            n_volumes = max(1, int(budget / (2 * 8 * bold_mask.size)))
+            block_size = max(1, int(budget / (2 * 8 * n_scans)))
+
+        masked_shape = (n_scans, int(bold_mask.sum()))
+        if block_size is None:
+            masked_data = np.empty(masked_shape, dtype=self.inputs.precision)
+        else:
+            masked_data = np.lib.format.open_memmap(memmap_file, mode='w+',
+                                                    dtype=self.inputs.precision,
+                                                    shape=masked_shape)
+        for start, volumes in _iter_volumes(bold_img, n_volumes):
+            masked_data[start:start + volumes.shape[-1]] = volumes[bold_mask].T
+        outliers = is_outlier(masked_data, thresh=self.inputs.threshold, block_size=block_size)
+        del masked_data
+        if block_size is not None:
+            os.remove(memmap_file)
+
+        censored_shape = bold_mask.shape + (int((~outliers).sum()),)
+        if block_size is None:
+            censored_data = np.empty(censored_shape, dtype=self.inputs.precision, order='F')
+        else:
+            censored_data = np.lib.format.open_memmap(censored_file, mode='w+',
+                                                      dtype=self.inputs.precision,
+                                                      shape=censored_shape,
+                                                      fortran_order=True)
+        n_censored = 0
+        for start, volumes in _iter_volumes(bold_img, n_volumes):
+            kept = ~outliers[start:start + volumes.shape[-1]]
+            censored_data[..., n_censored:n_censored + kept.sum()] = volumes[..., kept]
+            n_censored += kept.sum()
+
+        # the censored volumes are always a nifti file
+        out = fname_presuffix(self.inputs.timeseries_file,
+                              suffix='_censored' +
+                              _nifti_extension(self.inputs.compression_level),
+                              use_ext=False)
+
+        header = bold_img.header.copy()
+        header.set_data_dtype(self.inputs.precision)
+        _save_nifti(bold_img.__class__(censored_data, bold_img.affine, header),
+                    out, self.inputs.compression_level, self.inputs.compression_threads)
+        del censored_data
+        if block_size is not None:
+            os.remove(censored_file)
 
         self._results['censored_file'] = out
         self._results['outliers'] = outliers
@@ -57,11 +137,14 @@ class CensorVolumes(SimpleInterface):
 
 class AtlasConnectivityInputSpec(BaseInterfaceInputSpec):
     timeseries_file = File(exists=True, mandatory=True,
-                           desc='The 4d file being used to extract timeseries data')
+                           desc='The 4d file being used to extract timeseries data'
+                                ' (or a tsv file of the parcel timeseries)')
     atlas_file = File(exists=True, mandatory=True,
                       desc='The atlas image with each roi given a unique index')
     atlas_lut = File(exists=True, mandatory=True,
                      desc='The atlas lookup table to match the atlas image')
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc="floating point precision of the roi timeseries")
 
 
 class AtlasConnectivityOutputSpec(TraitedSpec):
@@ -90,10 +173,19 @@ class AtlasConnectivity(NilearnBaseInterface, SimpleInterface):
 
         plt.switch_backend('Agg')
 
-        # extract timeseries from every label
-        masker = NiftiLabelsMasker(labels_img=self.inputs.atlas_file,
-                                   standardize=True, verbose=1)
-        timeseries = masker.fit_transform(self.inputs.timeseries_file)
+        if self.inputs.timeseries_file.endswith('.tsv'):
+            # the timeseries of every label (parcel) were estimated already
+            from nilearn.signal import clean
+
+            timeseries = clean(pd.read_csv(self.inputs.timeseries_file, sep='\t').values,
+                               detrend=False, standardize=True)
+            timeseries = timeseries.astype(self.inputs.precision, copy=False)
+        else:
+            # extract timeseries from every label
+            masker = NiftiLabelsMasker(labels_img=self.inputs.atlas_file,
+                                       standardize=True, dtype=self.inputs.precision,
+                                       verbose=1)
+            timeseries = masker.fit_transform(self.inputs.timeseries_file)
         # create correlation matrix
         correlation_measure = ConnectivityMeasure(cov_estimator=EmpiricalCovariance(),
                                                   kind="correlation")
@@ -150,7 +242,7 @@ def _fisher_r_to_z(x):
     return np.arctanh(x)
 
 
-def is_outlier(points, thresh=3.5):
+def is_outlier(points, thresh=3.5, block_size=None):
     """
     Returns a boolean array with True if points are outliers and False
     otherwise.
@@ -166,6 +258,9 @@ def is_outlier(points, thresh=3.5):
         the modified z-score to use as a threshold. Observations with
         a modified z-score (based on the median absolute deviation) greater
         than this value will be classified as outliers.
+    block_size: int or None
+        number of dimensions (columns) read at once, e.g., from a memory
+        mapped array (all dimensions if None)
 
     Returns
     -------
@@ -180,8 +275,13 @@ def is_outlier(points, thresh=3.5):
 
     if len(points.shape) == 1:
         points = points[:, None]
-    median = np.median(points, axis=0)
-    diff = np.sum((points - median)**2, axis=-1)
+    n_dims = points.shape[1]
+    block_size = block_size or max(n_dims, 1)
+    diff = np.zeros(points.shape[0])
+    for start in range(0, n_dims, block_size):
+        block = np.asarray(points[:, start:start + block_size])
+        median = np.median(block, axis=0)
+        diff += np.sum((block - median)**2, axis=-1)
     diff = np.sqrt(diff)
     med_abs_deviation = np.median(diff)
 
@@ -40,10 +40,80 @@ class LSSBetaSeriesInputSpec(BaseInterfaceInputSpec):
                                desc="FIR delays (in scans)",
                                default=None, usedefault=True)
     return_tstat = traits.Bool(desc="use the T-statistic instead of the raw beta estimates")
+    mem_budget_gb = traits.Either(None, traits.Float(), default=None, usedefault=True,
+                                  desc="memory budget (in gigabytes) to fit the model"
+                                       " in blocks of voxels (with memory mapped data"
+                                       " and residuals)")
+    return_residuals = traits.Bool(False, usedefault=True,
+                                   desc="calculate the model residuals"
+                                        " (uses more memory)")
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc="floating point precision of the bold data,"
+                                 " the model fit, and the beta series")
+    beta_series_format = traits.Enum('nifti', 'hdf5', usedefault=True,
+                                     desc="file format of the beta series (hdf5 stores"
+                                          " the trials by masked voxels in chunks)")
+    return_masked_betaseries = traits.Bool(False, usedefault=True,
+                                           desc="also save each beta series as a float32"
+                                                " trials by masked voxels .npy file"
+                                                " (with the mask)")
+    compression_level = traits.Range(low=0, high=9, value=1, usedefault=True,
+                                     desc="gzip compression level of the nifti outputs"
+                                          " (0 saves uncompressed .nii files)")
+    compression_threads = traits.Int(1, usedefault=True,
+                                     desc="number of threads compressing the nifti"
+                                          " outputs (in independent gzip blocks)")
+    bold_cache_dir = traits.Either(None, traits.Directory(), default=None, usedefault=True,
+                                   desc="directory caching the gzipped bold run as an"
+                                        " uncompressed (memory mapped) .nii file")
+    design_cache_dir = traits.Either(None, traits.Directory(), default=None, usedefault=True,
+                                     desc="directory caching the factorizations of the"
+                                          " (whitened) design matrices, reused by the runs"
+                                          " (and subjects) with identical designs")
+    atlas_file = traits.Either(None, File(exists=True), default=None, usedefault=True,
+                               desc="atlas image with each parcel given a unique index,"
+                                    " to fit the model(s) on the mean time series of the"
+                                    " parcels instead of the voxels")
+    atlas_support_file = traits.Either(None, File(exists=True), default=None,
+                                       usedefault=True,
+                                       desc="atlas image, only the voxels of the brain mask"
+                                            " with a (nonzero) atlas label are modeled")
+    censor_outliers = traits.Bool(False, usedefault=True,
+                                  desc="drop the volumes flagged by the outlier (spike)"
+                                       " regressors of the selected confounds (e.g.,"
+                                       " motion_outlier.*) instead of modeling them")
+    trial_types = traits.Either(None, traits.List(traits.Str), default=None, usedefault=True,
+                                desc="trial types (or regular expressions) fit as target"
+                                     " trials, the other events are only modeled as"
+                                     " conditions (None fits every trial)")
+    residual_precision = traits.Enum('float32', 'float64', usedefault=True,
+                                     desc="precision of the running sum of residuals"
+                                          " (float64 uses a compensated sum)")
+    noise_model = traits.Enum('ar1', 'ols', usedefault=True,
+                              desc="temporal noise model, AR(1) prewhitening or none"
+                                   " (ordinary least squares)")
+    ar1_estimate = traits.Enum('trial', 'condition', usedefault=True,
+                               desc="estimate the AR(1) coefficients from each trial model,"
+                                    " or once from the model with one regressor per"
+                                    " condition, the data are then whitened once for"
+                                    " every trial model")
+    project_nuisance = traits.Bool(False, usedefault=True,
+                                   desc="with an AR(1) noise model estimated from each"
+                                        " trial model, project the confounds and drifts"
+                                        " out of a copy of the bold data once, so the"
+                                        " ordinary least squares fit of each trial model"
+                                        " only has the condition regressors (the other"
+                                        " noise models always project the data)")
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc="number of workers fitting the trial models in parallel"
+                             " (-1 uses all processors), each worker sums the residuals"
+                             " of its trials in an array as large as the masked data")
 
 
 class LSSBetaSeriesOutputSpec(TraitedSpec):
     beta_maps = OutputMultiPath(File)
+    masked_beta_maps = OutputMultiPath(File)
+    mask_file = File(exists=True)
     design_matrices = traits.Dict()
     residual = traits.File(exists=True)
 
@@ -54,7 +124,9 @@ class LSSBetaSeries(NistatsBaseInterface, SimpleInterface):
     output_spec = LSSBetaSeriesOutputSpec
 
     def _run_interface(self, runtime):
-        from nistats import first_level_model
+        from joblib import Parallel, delayed, effective_n_jobs
+        import numpy as np
+        import pandas as pd
         import os
 
         # get t_r from bold_metadata
@@ -67,88 +139,183 @@ class LSSBetaSeries(NistatsBaseInterface, SimpleInterface):
         else:
             confounds = None
 
-        # setup the model
-        model = first_level_model.FirstLevelModel(
-            t_r=t_r,
-            slice_time_ref=0,
-            hrf_model=self.inputs.hrf_model,
-            mask_img=self.inputs.mask_file,
-            smoothing_fwhm=self.inputs.smoothing_kernel,
-            signal_scaling=self.inputs.signal_scaling,
-            high_pass=self.inputs.high_pass,
-            drift_model='cosine',
-            verbose=1,
-            fir_delays=self.inputs.fir_delays,
-            minimize_memory=False,
-        )
+        # mask, smooth, and scale the bold data once for every trial
+        # (into a memory mapped file with a memory budget)
+        memmap_file = os.path.join(runtime.cwd, 'desc-masked_bold.npy')
+        data, masker = _prepare_bold_data(self.inputs.bold_file,
+                                          self.inputs.mask_file,
+                                          t_r,
+                                          self.inputs.smoothing_kernel,
+                                          self.inputs.signal_scaling,
+                                          mem_budget_gb=self.inputs.mem_budget_gb,
+                                          memmap_file=memmap_file,
+                                          precision=self.inputs.precision,
+                                          bold_cache_dir=self.inputs.bold_cache_dir,
+                                          atlas_file=self.inputs.atlas_file,
+                                          atlas_support_file=self.inputs.atlas_support_file)
+        n_scans = data.shape[0]
+        frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
+
+        # drop the outlier scans instead of fitting a spike regressor for each
+        scans = None
+        if self.inputs.censor_outliers:
+            confounds, scans = _censor_outliers(confounds)
+        if scans is not None:
+            censored_file = os.path.join(runtime.cwd, 'desc-censored_bold.npy')
+            censored = _censor_scans(
+                data, scans,
+                block_size=_voxel_block_size(n_scans, self.inputs.mem_budget_gb, n_arrays=2,
+                                             itemsize=data.dtype.itemsize),
+                memmap_file=None if self.inputs.mem_budget_gb is None else censored_file)
+            if isinstance(data, np.memmap):
+                del data
+                os.remove(memmap_file)
+            data, memmap_file = censored, censored_file
+            n_scans = data.shape[0]
+
+        # convolve the regressor of every trial once for all the trial models
+        # (over every scan, before the outlier scans are dropped)
+        design = _LSSDesignBuilder(pd.read_csv(self.inputs.events_file, sep='\t'),
+                                   frame_times,
+                                   self.inputs.hrf_model,
+                                   self.inputs.high_pass,
+                                   fir_delays=self.inputs.fir_delays,
+                                   confounds=confounds,
+                                   scans=scans)
+
+        # the confounds and drifts of every trial model are projected out of the bold
+        # data once (into a memory mapped file with a memory budget), the whitened
+        # refits of the trial models with their own AR(1) estimates use the full
+        # designs, so the copy is only made there if requested
+        nuisance = None
+        projected_file = os.path.join(runtime.cwd, 'desc-projected_bold.npy')
+        projection_kwargs = dict(
+            block_size=_voxel_block_size(n_scans, self.inputs.mem_budget_gb, n_arrays=3,
+                                         itemsize=data.dtype.itemsize),
+            memmap_file=None if self.inputs.mem_budget_gb is None else projected_file,
+            design_cache_dir=self.inputs.design_cache_dir)
+        if self.inputs.noise_model == 'ols' or self.inputs.ar1_estimate == 'condition':
+            # with the same noise model for every trial model, the data are also
+            # whitened once, and the trial models only fit the condition regressors
+            if self.inputs.noise_model == 'ols':
+                labels = np.zeros(data.shape[1])
+            else:
+                labels = _ar1_labels(
+                    data, design.condition_design_matrix().values,
+                    block_size=_voxel_block_size(n_scans, self.inputs.mem_budget_gb,
+                                                 itemsize=data.dtype.itemsize),
+                    scans=design.scans,
+                    design_cache_dir=self.inputs.design_cache_dir)
+            nuisance = _NuisanceProjection(design.nuisance, data, labels=labels,
+                                           scans=design.scans, **projection_kwargs)
+        elif self.inputs.project_nuisance:
+            nuisance = _NuisanceProjection(design.nuisance, data, **projection_kwargs)
+
+        # fit the trials in contiguous chunks spread over a pool of workers,
+        # the (memory mapped) bold matrix is shared instead of copied per worker
+        # (only the trials of the selected trial types are targets)
+        selected = _select_trial_types(design.trial_types, self.inputs.trial_types)
+        trials = [(trial_id, trial_type, int(trial_idx))
+                  for trial_id, (trial_type, trial_idx)
+                  in enumerate(zip(design.trial_types, design.trial_counters))
+                  if selected[trial_id]]
+        n_chunks = min(effective_n_jobs(self.inputs.n_jobs), len(trials))
+        # every worker gets its share of the memory budget
+        block_size = _voxel_block_size(
+            n_scans, None if self.inputs.mem_budget_gb is None
+            else self.inputs.mem_budget_gb / n_chunks, itemsize=data.dtype.itemsize)
+        # (each worker sums the residuals of its trials, in a memory mapped file
+        # in the working directory with a memory budget)
+        residual_template = os.path.join(runtime.cwd, 'desc-residualsum{}_bold.npy')
+        chunk_results = Parallel(n_jobs=n_chunks)(
+            delayed(_fit_lss_trials)(data,
+                                     design,
+                                     [trials[i] for i in chunk],
+                                     self.inputs.return_tstat,
+                                     self.inputs.return_residuals,
+                                     self.inputs.residual_precision,
+                                     block_size,
+                                     nuisance,
+                                     self.inputs.design_cache_dir,
+                                     None if self.inputs.mem_budget_gb is None
+                                     else residual_template.format(chunk_idx))
+            for chunk_idx, chunk in enumerate(
+                np.array_split(np.arange(len(trials)), n_chunks)))
+
+        # one beta series (volume per trial) for each trial type (or FIR delay),
+        # memory mapped in the working directory with a memory budget
+        beta_series_template = os.path.join(runtime.cwd, 'desc-{trial_type}_betaseries')
+        n_trials = {}
+        for trial_type in pd.unique(design.trial_types[selected]):
+            n_type_trials = (design.trial_types == trial_type).sum()
+            for new_ttype, _ in _lss_estimates(trial_type, design.hrf_model,
+                                               design.fir_delays):
+                n_trials[new_ttype] = n_type_trials
+        if self.inputs.atlas_file:
+            # (or one row per trial and column per parcel)
+            beta_series = _ParcelBetaSeriesWriter(
+                masker.labels_, n_trials, beta_series_template,
+                dtype=self.inputs.precision,
+                masked=self.inputs.return_masked_betaseries)
+        else:
+            beta_series = _BetaSeriesWriter(
+                masker.mask_img_, n_trials, beta_series_template,
+                dtype=self.inputs.precision,
+                memmap_dir=None if self.inputs.mem_budget_gb is None else runtime.cwd,
+                file_format=self.inputs.beta_series_format,
+                masked=self.inputs.return_masked_betaseries,
+                compression_level=self.inputs.compression_level,
+                compression_threads=self.inputs.compression_threads)
 
-        # initialize dictionary to contain trial estimates (betas)
-        beta_maps = {}
+        # write the trial estimates (betas) into their beta series in trial order
         residuals = None
         design_matrix_collector = {}
-        for target_trial_df, trial_type, trial_idx in \
-                _lss_events_iterator(self.inputs.events_file):
-
-            # fit the model for the target trial
-            model.fit(self.inputs.bold_file,
-                      events=target_trial_df,
-                      confounds=confounds)
-
-            if self.inputs.hrf_model == 'fir':
-                # FS modeling
-                for delay in self.inputs.fir_delays:
-                    delay_ttype = trial_type+'_delay_{}'.format(delay)
-                    new_delay_ttype = delay_ttype.replace('_delay_{}'.format(delay),
-                                                          'Delay{}Vol'.format(delay))
-                    beta_map = _calc_beta_map(model,
-                                              delay_ttype,
-                                              self.inputs.hrf_model,
-                                              self.inputs.return_tstat)
-                    if new_delay_ttype in beta_maps:
-                        beta_maps[new_delay_ttype].append(beta_map)
-                    else:
-                        beta_maps[new_delay_ttype] = [beta_map]
-            else:
-                # calculate the beta map
-                beta_map = _calc_beta_map(model,
-                                          trial_type,
-                                          self.inputs.hrf_model,
-                                          self.inputs.return_tstat)
-                design_matrix_collector[trial_idx] = model.design_matrices_[0]
-                # assign beta map to appropriate list
-                if trial_type in beta_maps:
-                    beta_maps[trial_type].append(beta_map)
-                else:
-                    beta_maps[trial_type] = [beta_map]
+        while chunk_results:
+            trial_results, chunk_residuals = chunk_results.pop(0)
+            for trial_idx, design_matrix, trial_maps in trial_results:
+                design_matrix_collector[trial_idx] = design_matrix
+                for new_ttype, beta_map in trial_maps:
+                    beta_series.add(new_ttype, trial_idx, beta_map)
+            del trial_results
 
             # add up all the residuals (to be divided later)
             if residuals is None:
-                residuals = model.residuals[0].get_fdata()
+                residuals = chunk_residuals
             else:
-                residuals += model.residuals[0].get_fdata()
-
-        # make an average residual
-        ave_residual = residuals / (trial_idx + 1)
-        # make residual nifti image
-        residual_file = os.path.join(runtime.cwd, 'desc-residuals_bold.nii.gz')
-        nib.Nifti2Image(
-            ave_residual,
-            model.residuals[0].affine,
-            model.residuals[0].header,
-        ).to_filename(residual_file)
-        # make a beta series from each beta map list
-        beta_series_template = os.path.join(runtime.cwd,
-                                            'desc-{trial_type}_betaseries.nii.gz')
+                residuals.merge(chunk_residuals)
+
+        if self.inputs.return_residuals:
+            # make an average residual (only in-mask voxels are kept until now)
+            # (over the models of the selected trials)
+            ave_residual = residuals.mean(len(trials))
+            # make residual nifti image (or parcel time series)
+            self._results['residual'] = _save_residuals(
+                masker, ave_residual, os.path.join(runtime.cwd, 'desc-residuals_bold'),
+                self.inputs.compression_level, self.inputs.compression_threads,
+                dtype=self.inputs.precision, scans=scans,
+                memmap_dir=None if self.inputs.mem_budget_gb is None else runtime.cwd)
+            del ave_residual
+            residuals.remove()
+        # save the beta series as they are
         # collector for the betaseries files
-        beta_series_lst = []
-        for t_type, betas in beta_maps.items():
-            beta_series = nib.funcs.concat_images(betas)
-            nib.save(beta_series, beta_series_template.format(trial_type=t_type))
-            beta_series_lst.append(beta_series_template.format(trial_type=t_type))
+        beta_series_lst = beta_series.save()
+        if self.inputs.return_masked_betaseries:
+            self._results['masked_beta_maps'] = beta_series.masked_files
+        if self.inputs.return_masked_betaseries and not self.inputs.atlas_file:
+            self._results['mask_file'] = beta_series.save_mask(
+                os.path.join(runtime.cwd, 'desc-betaseries_mask' +
+                             _nifti_extension(self.inputs.compression_level)))
+
+        # the memory mapped bold data is not an output
+        if isinstance(data, np.memmap):
+            del data
+            os.remove(memmap_file)
+        if nuisance is not None and isinstance(nuisance.data, np.memmap):
+            del nuisance
+            os.remove(projected_file)
 
         self._results['beta_maps'] = beta_series_lst
         self._results['design_matrices'] = design_matrix_collector
-        self._results['residual'] = residual_file
         return runtime
 
 
@@ -175,10 +342,57 @@ class LSABetaSeriesInputSpec(BaseInterfaceInputSpec):
                                      desc="full wide half max smoothing kernel")
     high_pass = traits.Float(0.0078125, desc="the high pass filter (Hz)")
     return_tstat = traits.Bool(desc="use the T-statistic instead of the raw beta estimates")
+    mem_budget_gb = traits.Either(None, traits.Float(), default=None, usedefault=True,
+                                  desc="memory budget (in gigabytes) to fit the model"
+                                       " in blocks of voxels (with memory mapped data"
+                                       " and residuals)")
+    return_residuals = traits.Bool(False, usedefault=True,
+                                   desc="calculate the model residuals"
+                                        " (uses more memory)")
+    precision = traits.Enum('float64', 'float32', usedefault=True,
+                            desc="floating point precision of the bold data,"
+                                 " the model fit, and the beta series")
+    beta_series_format = traits.Enum('nifti', 'hdf5', usedefault=True,
+                                     desc="file format of the beta series (hdf5 stores"
+                                          " the trials by masked voxels in chunks)")
+    return_masked_betaseries = traits.Bool(False, usedefault=True,
+                                           desc="also save each beta series as a float32"
+                                                " trials by masked voxels .npy file"
+                                                " (with the mask)")
+    compression_level = traits.Range(low=0, high=9, value=1, usedefault=True,
+                                     desc="gzip compression level of the nifti outputs"
+                                          " (0 saves uncompressed .nii files)")
+    compression_threads = traits.Int(1, usedefault=True,
+                                     desc="number of threads compressing the nifti"
+                                          " outputs (in independent gzip blocks)")
+    bold_cache_dir = traits.Either(None, traits.Directory(), default=None, usedefault=True,
+                                   desc="directory caching the gzipped bold run as an"
+                                        " uncompressed (memory mapped) .nii file")
+    design_cache_dir = traits.Either(None, traits.Directory(), default=None, usedefault=True,
+                                     desc="directory caching the factorizations of the"
+                                          " (whitened) design matrices, reused by the runs"
+                                          " (and subjects) with identical designs")
+    atlas_file = traits.Either(None, File(exists=True), default=None, usedefault=True,
+                               desc="atlas image with each parcel given a unique index,"
+                                    " to fit the model(s) on the mean time series of the"
+                                    " parcels instead of the voxels")
+    atlas_support_file = traits.Either(None, File(exists=True), default=None,
+                                       usedefault=True,
+                                       desc="atlas image, only the voxels of the brain mask"
+                                            " with a (nonzero) atlas label are modeled")
+    censor_outliers = traits.Bool(False, usedefault=True,
+                                  desc="drop the volumes flagged by the outlier (spike)"
+                                       " regressors of the selected confounds (e.g.,"
+                                       " motion_outlier.*) instead of modeling them")
+    noise_model = traits.Enum('ar1', 'ols', usedefault=True,
+                              desc="temporal noise model, AR(1) prewhitening or none"
+                                   " (ordinary least squares)")
 
 
 class LSABetaSeriesOutputSpec(TraitedSpec):
     beta_maps = OutputMultiPath(File)
+    masked_beta_maps = OutputMultiPath(File)
+    mask_file = File(exists=True)
     design_matrices = traits.List()
     residual = traits.File(exists=True)
 
@@ -189,7 +403,9 @@ class LSABetaSeries(NistatsBaseInterface, SimpleInterface):
     output_spec = LSABetaSeriesOutputSpec
 
     def _run_interface(self, runtime):
-        from nistats import first_level_model
+        from nistats.design_matrix import make_first_level_design_matrix
+        import numpy as np
+        import pandas as pd
         import os
 
         # get t_r from bold_metadata
@@ -202,60 +418,248 @@ class LSABetaSeries(NistatsBaseInterface, SimpleInterface):
         else:
             confounds = None
 
+        # mask, smooth, and scale the bold data
+        # (into a memory mapped file with a memory budget)
+        memmap_file = os.path.join(runtime.cwd, 'desc-masked_bold.npy')
+        data, masker = _prepare_bold_data(self.inputs.bold_file,
+                                          self.inputs.mask_file,
+                                          t_r,
+                                          self.inputs.smoothing_kernel,
+                                          self.inputs.signal_scaling,
+                                          mem_budget_gb=self.inputs.mem_budget_gb,
+                                          memmap_file=memmap_file,
+                                          precision=self.inputs.precision,
+                                          bold_cache_dir=self.inputs.bold_cache_dir,
+                                          atlas_file=self.inputs.atlas_file,
+                                          atlas_support_file=self.inputs.atlas_support_file)
+        n_scans = data.shape[0]
+        frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
+
+        # drop the outlier scans instead of fitting a spike regressor for each
+        scans = None
+        if self.inputs.censor_outliers:
+            confounds, scans = _censor_outliers(confounds)
+
         # setup the model
-        model = first_level_model.FirstLevelModel(
-            t_r=t_r,
-            slice_time_ref=0,
+        lsa_df = _lsa_events_converter(self.inputs.events_file)
+        design_matrix = make_first_level_design_matrix(
+            frame_times,
+            lsa_df,
             hrf_model=self.inputs.hrf_model,
-            mask_img=self.inputs.mask_file,
-            smoothing_fwhm=self.inputs.smoothing_kernel,
-            signal_scaling=self.inputs.signal_scaling,
-            high_pass=self.inputs.high_pass,
             drift_model='cosine',
-            verbose=1,
-            minimize_memory=False,
+            high_pass=self.inputs.high_pass,
+            add_regs=None if confounds is None else confounds.values,
+            add_reg_names=None if confounds is None else confounds.columns.tolist(),
         )
+        if scans is not None:
+            # (the regressors are computed over every scan before dropping the outliers)
+            design_matrix = design_matrix.loc[scans]
+            censored_file = os.path.join(runtime.cwd, 'desc-censored_bold.npy')
+            censored = _censor_scans(
+                data, scans,
+                block_size=_voxel_block_size(n_scans, self.inputs.mem_budget_gb, n_arrays=2,
+                                             itemsize=data.dtype.itemsize),
+                memmap_file=None if self.inputs.mem_budget_gb is None else censored_file)
+            if isinstance(data, np.memmap):
+                del data
+                os.remove(memmap_file)
+            data, memmap_file = censored, censored_file
+            n_scans = data.shape[0]
 
-        # initialize dictionary to contain trial estimates (betas)
-        beta_maps = {}
-        lsa_df = _lsa_events_converter(self.inputs.events_file)
-        model.fit(self.inputs.bold_file, events=lsa_df, confounds=confounds)
-        design_matrix = model.design_matrices_[0]
-        for i_trial in lsa_df.index:
-            t_name = lsa_df.loc[i_trial, 'trial_type']
-            t_type = lsa_df.loc[i_trial, 'original_trial_type']
+        # every trial estimate (beta) comes out of the same fit
+        basis_columns = [_basis_columns(t_name, self.inputs.hrf_model)
+                         for t_name in lsa_df['trial_type']]
+        n_basis = len(basis_columns[0])
+        # (the residuals are memory mapped in the working directory with a memory budget)
+        residual_file = os.path.join(runtime.cwd, 'desc-residuals_bold.npy')
+        effects, variances, residuals = _run_glm(
+            data, design_matrix, [col for cols in basis_columns for col in cols],
+            return_residuals=self.inputs.return_residuals,
+            block_size=_voxel_block_size(n_scans, self.inputs.mem_budget_gb,
+                                         itemsize=data.dtype.itemsize),
+            scans=scans,
+            labels=np.zeros(data.shape[1]) if self.inputs.noise_model == 'ols' else None,
+            design_cache_dir=self.inputs.design_cache_dir,
+            residual_file=None if self.inputs.mem_budget_gb is None else residual_file)
+        # the memory mapped bold data is not an output
+        if isinstance(data, np.memmap):
+            del data
+            os.remove(memmap_file)
+        # (n_basis, n_trials, n_voxels) to combine the basis functions of all trials
+        beta_array = _combine_basis(
+            effects.reshape(len(lsa_df), n_basis, -1).swapaxes(0, 1))
+        if self.inputs.return_tstat:
+            beta_array = _tstat(beta_array, _combine_basis(
+                variances.reshape(len(lsa_df), n_basis, -1).swapaxes(0, 1)))
 
-            # calculate the beta map
-            beta_map = _calc_beta_map(model,
-                                      t_name,
-                                      self.inputs.hrf_model,
-                                      self.inputs.return_tstat)
-
-            # assign beta map to appropriate list
-            if t_type in beta_maps:
-                beta_maps[t_type].append(beta_map)
-            else:
-                beta_maps[t_type] = [beta_map]
-
-        # calculate the residual
-        residual_file = os.path.join(runtime.cwd, 'desc-residuals_bold.nii.gz')
-        model.residuals[0].to_filename(residual_file)
-        # make a beta series from each beta map list
-        beta_series_template = os.path.join(runtime.cwd,
-                                            'desc-{trial_type}_betaseries.nii.gz')
+        if self.inputs.return_residuals:
+            # calculate the residual
+            self._results['residual'] = _save_residuals(
+                masker, residuals, os.path.join(runtime.cwd, 'desc-residuals_bold'),
+                self.inputs.compression_level, self.inputs.compression_threads,
+                scans=scans,
+                memmap_dir=None if self.inputs.mem_budget_gb is None else runtime.cwd)
+            if isinstance(residuals, np.memmap):
+                del residuals
+                os.remove(residual_file)
+        # make a beta series from the trials of each trial type
+        # (memory mapped in the working directory with a memory budget)
+        original_trial_types = lsa_df['original_trial_type'].values
+        n_trials = {t_type: (original_trial_types == t_type).sum()
+                    for t_type in pd.unique(original_trial_types)}
+        beta_series_template = os.path.join(runtime.cwd, 'desc-{trial_type}_betaseries')
+        if self.inputs.atlas_file:
+            # (or one row per trial and column per parcel)
+            beta_series = _ParcelBetaSeriesWriter(
+                masker.labels_, n_trials, beta_series_template,
+                dtype=self.inputs.precision,
+                masked=self.inputs.return_masked_betaseries)
+        else:
+            beta_series = _BetaSeriesWriter(
+                masker.mask_img_, n_trials, beta_series_template,
+                dtype=self.inputs.precision,
+                memmap_dir=None if self.inputs.mem_budget_gb is None else runtime.cwd,
+                file_format=self.inputs.beta_series_format,
+                masked=self.inputs.return_masked_betaseries,
+                compression_level=self.inputs.compression_level,
+                compression_threads=self.inputs.compression_threads)
+        for t_type, trial_idx, beta_map in zip(original_trial_types,
+                                               _trial_counters(original_trial_types),
+                                               beta_array):
+            beta_series.add(t_type, trial_idx, beta_map)
+        del beta_array
         # collector for the betaseries files
-        beta_series_lst = []
-        for t_type, betas in beta_maps.items():
-            beta_series = nib.funcs.concat_images(betas)
-            nib.save(beta_series, beta_series_template.format(trial_type=t_type))
-            beta_series_lst.append(beta_series_template.format(trial_type=t_type))
+        beta_series_lst = beta_series.save()
+        if self.inputs.return_masked_betaseries:
+            self._results['masked_beta_maps'] = beta_series.masked_files
+        if self.inputs.return_masked_betaseries and not self.inputs.atlas_file:
+            self._results['mask_file'] = beta_series.save_mask(
+                os.path.join(runtime.cwd, 'desc-betaseries_mask' +
+                             _nifti_extension(self.inputs.compression_level)))
 
         self._results['beta_maps'] = beta_series_lst
         self._results['design_matrices'] = [design_matrix]
-        self._results['residual'] = residual_file
         return runtime
 
 
+class _BetaSeriesRunsInputSpec(BaseInterfaceInputSpec):
+    bold_file = traits.List(traits.Either(File(exists=True), nib.spatialimages.SpatialImage),
+                            mandatory=True, desc="The bold runs")
+    bold_metadata = traits.List(traits.Dict(), mandatory=True,
+                                desc="Dictionary containing useful information about"
+                                     " each bold run")
+    mask_file = traits.List(File(exists=True), mandatory=True,
+                            desc="Binarized nifti file indicating the brain of each bold run")
+    events_file = traits.List(File(exists=True), mandatory=True,
+                              desc="File that contains all events from each bold run")
+    confounds_file = traits.List(traits.Either(None, File(exists=True)),
+                                 desc="File that contains all usable confounds of each"
+                                      " bold run")
+
+
+class LSSBetaSeriesRunsInputSpec(_BetaSeriesRunsInputSpec, LSSBetaSeriesInputSpec):
+    pass
+
+
+class LSABetaSeriesRunsInputSpec(_BetaSeriesRunsInputSpec, LSABetaSeriesInputSpec):
+    pass
+
+
+class BetaSeriesRunsOutputSpec(TraitedSpec):
+    beta_maps = traits.List(traits.List(File(exists=True)),
+                            desc="beta series files of each run")
+    masked_beta_maps = traits.List(traits.List(File(exists=True)),
+                                   desc="masked beta series files of each run")
+    mask_file = traits.List(File(exists=True), desc="beta series mask of each run")
+    design_matrices = traits.List(desc="design matrices of each run")
+    residual = traits.List(File(exists=True), desc="residuals of each run")
+
+
+class _BetaSeriesRuns(NistatsBaseInterface, SimpleInterface):
+    """Fit the beta series of several bold runs one after the other in a single process
+
+    The runs (e.g., of a subject) share the process (and the modules it imported)
+    and the factorizations of identical designs (see ``_gram_pinv``), and the next
+    bold run is read in a background thread while a run is fit. Each run is fit by
+    ``_run_class`` in its own subdirectory of the working directory, with the inputs
+    that are not lists of runs shared by every run.
+    """
+    output_spec = BetaSeriesRunsOutputSpec
+    _run_class = None
+    _run_inputs = ('bold_file', 'bold_metadata', 'mask_file', 'events_file', 'confounds_file')
+
+    def _run_interface(self, runtime):
+        from concurrent.futures import ThreadPoolExecutor
+        from nipype.interfaces.base import isdefined
+        from nipype.utils.filemanip import ensure_list
+        import os
+        import tempfile
+
+        n_runs = len(self.inputs.bold_file)
+        runs = {name: getattr(self.inputs, name) for name in self._run_inputs}
+        if not isdefined(runs['confounds_file']):
+            runs['confounds_file'] = [None] * n_runs
+        for name, values in runs.items():
+            if len(values) != n_runs:
+                raise ValueError("{} has {} runs instead of {}".format(
+                    name, len(values), n_runs))
+
+        shared_inputs = {name: value for name, value in self.inputs.get_traitsfree().items()
+                         if name not in self._run_inputs}
+        # (without a design cache, the runs share one in the working directory)
+        if shared_inputs['design_cache_dir'] is None:
+            shared_inputs['design_cache_dir'] = tempfile.mkdtemp(prefix='designcache',
+                                                                 dir=runtime.cwd)
+
+        run_outputs = {name: [] for name in self.output_spec().copyable_trait_names()}
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            next_bold = reader.submit(_read_bold, runs['bold_file'][0],
+                                      self.inputs.bold_cache_dir, self.inputs.mem_budget_gb)
+            for run_idx in range(n_runs):
+                bold_img = next_bold.result()
+                # read the next run while this run is fit
+                if run_idx + 1 < n_runs:
+                    next_bold = reader.submit(_read_bold, runs['bold_file'][run_idx + 1],
+                                              self.inputs.bold_cache_dir,
+                                              self.inputs.mem_budget_gb)
+
+                run_dir = os.path.join(runtime.cwd, 'run{:d}'.format(run_idx))
+                os.makedirs(run_dir, exist_ok=True)
+                run_interface = self._run_class(
+                    bold_file=bold_img,
+                    bold_metadata=runs['bold_metadata'][run_idx],
+                    mask_file=runs['mask_file'][run_idx],
+                    events_file=runs['events_file'][run_idx],
+                    confounds_file=runs['confounds_file'][run_idx],
+                    **shared_inputs)
+                outputs = run_interface.run(cwd=run_dir).outputs
+                for name, values in run_outputs.items():
+                    values.append(getattr(outputs, name))
+                # (the interface keeps the bold run read in memory)
+                del bold_img, run_interface, outputs
+
+        for name, values in run_outputs.items():
+            if all(isdefined(value) for value in values):
+                if name in ('beta_maps', 'masked_beta_maps'):
+                    values = [ensure_list(value) for value in values]
+                self._results[name] = values
+        return runtime
+
+
+class LSSBetaSeriesRuns(_BetaSeriesRuns):
+    """Calculates BetaSeries Maps From several BOLD files in a single process
+    (see ``LSSBetaSeries``)."""
+    input_spec = LSSBetaSeriesRunsInputSpec
+    _run_class = LSSBetaSeries
+
+
+class LSABetaSeriesRuns(_BetaSeriesRuns):
+    """Calculates BetaSeries Maps From several BOLD files in a single process
+    (see ``LSABetaSeries``)."""
+    input_spec = LSABetaSeriesRunsInputSpec
+    _run_class = LSABetaSeries
+
+
 def _lsa_events_converter(events_file):
     """Make a model where each trial has its own regressor using least squares
     all (LSA)
@@ -265,20 +669,19 @@ def _lsa_events_converter(events_file):
     events_file : str
         File that contains all events from the bold run
 
-    Yields
-    ------
+    Returns
+    -------
     events : DataFrame
         A DataFrame in which each trial has its own trial_type
     """
 
     import pandas as pd
     events = pd.read_csv(events_file, sep='\t')
+    trial_counters = pd.Series(_trial_counters(events['trial_type'].values) + 1,
+                               index=events.index)
     events['original_trial_type'] = events['trial_type']
-    for cond, cond_df in events.groupby('trial_type'):
-        cond_idx = cond_df.index
-        for i_trial, trial_idx in enumerate(cond_idx):
-            trial_name = '{0}_{1:04d}'.format(cond, i_trial+1)
-            events.loc[trial_idx, 'trial_type'] = trial_name
+    events['trial_type'] = (events['trial_type'].astype(str) + '_' +
+                            trial_counters.astype(str).str.zfill(4))
     return events
 
 
@@ -292,9 +695,11 @@ def _lss_events_iterator(events_file):
 
     Yields
     ------
-    events_trial : DataFrame
-        A DataFrame in which the target trial maintains its trial type,
-        but all other trials are assigned to 'other'
+    trial_labels : numpy.ndarray
+        The trial_type of every event in the model of the target trial:
+        the target trial maintains its trial type,
+        but all other trials of its type are assigned to 'other'
+        (``events.assign(trial_type=trial_labels)`` makes the model's events)
     trial_type : str
         The trial_type of the target trial
     trial_counter : int
@@ -304,18 +709,64 @@ def _lss_events_iterator(events_file):
     import pandas as pd
     import numpy as np
     events = pd.read_csv(events_file, sep='\t')
-    trial_counter = dict([(t, 0) for t in np.unique(events['trial_type'])])
-    for trial_id in range(len(events)):
-        trial_type = events.loc[trial_id, 'trial_type']
-        # make a copy of the dataframe
-        events_trial = events.copy()
+    trial_types = events['trial_type'].values
+    trial_counters = _trial_counters(trial_types)
+    for trial_id, (trial_type, trial_counter) in enumerate(zip(trial_types, trial_counters)):
         # assign new name to all events from original condition
-        trial_type_id = events_trial['trial_type'] == trial_type
-        events_trial.loc[trial_type_id, 'trial_type'] = 'other'
+        trial_labels = np.where(trial_types == trial_type, 'other', trial_types)
         # assign the trial of interest to be its original value
-        events_trial.loc[trial_id, 'trial_type'] = trial_type
-        yield events_trial, trial_type, trial_counter[trial_type]
-        trial_counter[trial_type] += 1
+        trial_labels[trial_id] = trial_type
+        yield trial_labels, trial_type, int(trial_counter)
+
+
+def _trial_counters(trial_types):
+    """Index of every trial among the trials of the same type (in a single pass)
+
+    Parameters
+    ----------
+    trial_types : numpy.ndarray
+        The trial_type of every event
+
+    Returns
+    -------
+    trial_counters : numpy.ndarray
+        The marker for the nth trial of its type for every event
+    """
+    import pandas as pd
+
+    return pd.Series(trial_types).groupby(trial_types, sort=False).cumcount().values
+
+
+def _select_trial_types(trial_types, selected_trial_types=None):
+    """Mark the events of the selected trial types
+
+    Parameters
+    ----------
+    trial_types : numpy.ndarray
+        The trial_type of every event
+    selected_trial_types : list or None
+        trial types, which can be listed as regular expressions (e.g., "go.*"),
+        None selects every trial type
+
+    Returns
+    -------
+    selected : numpy.ndarray
+        True for every event of a selected trial type
+    """
+    import numpy as np
+    import re
+
+    if selected_trial_types is None:
+        return np.ones(len(trial_types), dtype=bool)
+
+    trial_type_expr = re.compile(r"|".join(selected_trial_types))
+    # (trial types read as numbers are matched as they are written)
+    selected = np.array([bool(trial_type_expr.fullmatch(str(trial_type)))
+                         for trial_type in trial_types], dtype=bool)
+    if not selected.any():
+        raise ValueError("None of the trial types {} match the events' trial types {}"
+                         .format(selected_trial_types, sorted(set(trial_types))))
+    return selected
 
 
 def _select_confounds(confounds_file, selected_confounds):
@@ -362,91 +813,1970 @@ def _select_confounds(confounds_file, selected_confounds):
     return desired_confounds
 
 
-def _calc_beta_map(model, trial_type, hrf_model, tstat):
+def _censor_outliers(confounds):
+    """Separate the outlier (spike) regressors from the confounds
+
+    A spike regressor has a single nonzero value (e.g., the ``motion_outlierXX``
+    and ``non_steady_state_outlierXX`` columns of fmriprep), it fits the flagged
+    scan exactly, which is the same as dropping the scan from the model
+    (for ordinary least squares).
+
+    Parameters
+    ----------
+    confounds : pandas.DataFrame or None
+        selected confounds (see ``_select_confounds``)
+
+    Returns
+    -------
+    confounds : pandas.DataFrame or None
+        the confounds without the spike regressors (None if there are none left)
+    scans : numpy.ndarray or None
+        True for every scan that is not flagged by a spike regressor
+        (None if there are no spike regressors)
     """
-    Calculates the beta estimates for every voxel from
-    a nistats model
+    if confounds is None:
+        return None, None
+    nonzero = confounds.values != 0
+    spikes = nonzero.sum(axis=0) == 1
+    if not spikes.any():
+        return confounds, None
+
+    scans = ~nonzero[:, spikes].any(axis=1)
+    confounds = confounds.loc[:, ~spikes]
+    return (confounds if confounds.shape[1] else None), scans
+
+
+def _censor_scans(data, scans, block_size=None, memmap_file=None):
+    """Keep the uncensored scans of the masked bold data
 
     Parameters
     ----------
-    model : nistats.first_level_model.FirstLevelModel
-        a fit model of the first level results
-    trial_type : str
-        the trial to create the beta estimate
-    hrf_model : str
-        the hemondynamic response function used to fit the model
-    tstat : bool
-        return the t-statistic for the betas instead of the raw estimates
+    data : numpy.ndarray
+        masked bold data of shape (n_scans, n_voxels)
+    scans : numpy.ndarray
+        True for every scan to keep
+    block_size : int or None
+        number of voxels copied at once (all voxels if None)
+    memmap_file : str or None
+        .npy file memory mapping the censored data (kept in memory if None)
 
     Returns
     -------
-    beta_map : nibabel.nifti2.Nifti2Image
-        nifti image containing voxelwise beta estimates
+    censored : numpy.ndarray or numpy.memmap
+        masked bold data of shape (n_kept_scans, n_voxels)
     """
     import numpy as np
 
-    # make it so we do not divide by zero
-    TINY = 1e-50
-    raw_beta_map = _estimate_map(model, trial_type, hrf_model, 'effect_size')
-    if tstat:
-        var_map = _estimate_map(model, trial_type, hrf_model, 'effect_variance')
-        tstat_array = raw_beta_map.get_fdata() / np.sqrt(np.maximum(var_map.get_fdata(), TINY))
-        return nib.Nifti2Image(tstat_array, raw_beta_map.affine, raw_beta_map.header)
-    else:
-        return raw_beta_map
+    if memmap_file is None:
+        return np.asarray(data)[scans]
+
+    n_voxels = data.shape[1]
+    censored = np.lib.format.open_memmap(memmap_file, mode='w+', dtype=data.dtype,
+                                         shape=(int(scans.sum()), n_voxels),
+                                         fortran_order=True)
+    block_size = block_size or max(n_voxels, 1)
+    for start in range(0, n_voxels, block_size):
+        block = slice(start, start + block_size)
+        censored[:, block] = np.asarray(data[:, block])[scans]
+    censored.flush()
+    del censored
+    return np.load(memmap_file, mmap_mode='r')
+
+
+def _restore_scans(arr, scans):
+    """Put back the censored scans (as zeros) into an array of shape (n_kept_scans, ...)"""
+    import numpy as np
+
+    restored = np.zeros((scans.size,) + arr.shape[1:], dtype=arr.dtype)
+    restored[scans] = arr
+    return restored
+
+
+def _prepare_bold_data(bold_file, mask_file, t_r, smoothing_kernel, signal_scaling,
+                       mem_budget_gb=None, memmap_file=None, precision='float64',
+                       bold_cache_dir=None, atlas_file=None, atlas_support_file=None):
+    """Mask, smooth, and scale a bold run the same way nistats does before fitting
+
+    Parameters
+    ----------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        The bold run
+    mask_file : str or nibabel.spatialimages.SpatialImage
+        Binarized nifti file indicating the brain
+    t_r : float
+        Repetition time of the bold run (in seconds)
+    smoothing_kernel : float or None
+        full wide half max smoothing kernel
+    signal_scaling : False or 0
+        Whether (0) or not (False) to scale each voxel's timeseries
+    mem_budget_gb : float or None
+        memory budget (in gigabytes) to process the bold run in batches
+        of volumes (and blocks of voxels) into ``memmap_file``
+    memmap_file : str or None
+        .npy file holding the masked data when there is a memory budget
+    precision : str
+        floating point type of the masked data ('float64' or 'float32')
+    bold_cache_dir : str or None
+        directory of the decompressed bold runs (see ``_cached_bold``)
+    atlas_file : str or None
+        atlas image with each parcel given a unique index,
+        the data is then the mean time series of each parcel
+    atlas_support_file : str or None
+        atlas image restricting the brain mask to its labeled voxels
+        (see ``_atlas_support_mask``)
+
+    Returns
+    -------
+    data : numpy.ndarray or numpy.memmap
+        masked (and optionally smoothed and scaled) bold data
+        of shape (n_scans, n_voxels), or (n_scans, n_parcels) with an atlas
+    masker : nilearn.input_data.NiftiMasker or nilearn.input_data.NiftiLabelsMasker
+        fitted masker to transform voxel estimates back into images
+        (with the labels of the parcels in ``labels_``)
+    """
+    from nilearn._utils.niimg_conversions import _check_same_fov, check_niimg
+    from nilearn.input_data import NiftiMasker, NiftiLabelsMasker
+    from nistats.first_level_model import mean_scaling
+
+    if bold_cache_dir is not None:
+        bold_file = _cached_bold(bold_file, bold_cache_dir)
+
+    if atlas_support_file is not None:
+        mask_file = _atlas_support_mask(mask_file, atlas_support_file)
+
+    if atlas_file is not None:
+        # the parcels are averaged (in the brain mask) before scaling,
+        # so the scaled signal is relative to the mean of each parcel
+        masker = NiftiLabelsMasker(labels_img=atlas_file,
+                                   mask_img=mask_file,
+                                   smoothing_fwhm=smoothing_kernel,
+                                   standardize=False,
+                                   t_r=t_r,
+                                   dtype=precision)
+        data = masker.fit_transform(bold_file)
+        if signal_scaling is not False:
+            data, _ = mean_scaling(data, signal_scaling)
+        return data.astype(precision, copy=False), masker
+
+    masker = NiftiMasker(mask_img=mask_file,
+                         smoothing_fwhm=smoothing_kernel,
+                         standardize=False,
+                         mask_strategy='epi',
+                         t_r=t_r,
+                         dtype=precision)
+    masker.fit(bold_file)
+
+    if mem_budget_gb is not None:
+        bold_img = check_niimg(_load_bold(bold_file), ensure_ndim=4)
+        # (the masker resamples the bold run when it does not match the mask)
+        if _check_same_fov(bold_img, masker.mask_img_):
+            data = _masked_bold_memmap(bold_img, masker.mask_img_, smoothing_kernel,
+                                       signal_scaling, mem_budget_gb, memmap_file,
+                                       precision)
+            return data, masker
+
+    data = masker.transform(bold_file)
+    if signal_scaling is not False:
+        data, _ = mean_scaling(data, signal_scaling)
+
+    return data.astype(precision, copy=False), masker
+
+
+def _cached_bold(bold_file, cache_dir):
+    """Decompress a gzipped bold run once into a cache of uncompressed .nii files
+
+    nibabel memory maps uncompressed nifti files, so the nodes (and reruns)
+    reading a cached bold run share its pages in the page cache instead of
+    decompressing the whole run again. Like nipype's default (timestamp) hashing,
+    a cached run is identified by the path, size, and modification time of the
+    gzipped run, and replaces the cached copies of previous versions of the run.
+
+    Parameters
+    ----------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        The bold run (only .nii.gz files are cached)
+    cache_dir : str
+        directory of the decompressed bold runs
+
+    Returns
+    -------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        the cached (uncompressed) bold run, or the bold run itself
+        when it is not a gzipped file
+    """
+    import glob
+    import gzip
+    import hashlib
+    import os
+    import shutil
+    import tempfile
+
+    if not isinstance(bold_file, str) or not bold_file.endswith('.gz'):
+        return bold_file
+
+    bold_stat = os.stat(bold_file)
+    key = hashlib.sha1('{}:{}:{}'.format(os.path.realpath(bold_file), bold_stat.st_size,
+                                         bold_stat.st_mtime_ns).encode()).hexdigest()
+    bold_name = os.path.basename(bold_file)[:-len('.gz')]
+    cached_file = os.path.join(cache_dir, '{}_{}'.format(key, bold_name))
+    if os.path.exists(cached_file):
+        return cached_file
+
+    # decompress next to the cache entry and rename it once complete,
+    # so concurrent nodes never read a partially decompressed run
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, partial_file = tempfile.mkstemp(suffix='.nii', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as decompressed, gzip.open(bold_file, 'rb') as compressed:
+            shutil.copyfileobj(compressed, decompressed, 2 ** 24)
+        os.replace(partial_file, cached_file)
+    except BaseException:
+        os.remove(partial_file)
+        raise
+
+    for stale_file in glob.glob(os.path.join(cache_dir, '*_' + bold_name)):
+        if (stale_file != cached_file and
+                len(os.path.basename(stale_file)) == len(os.path.basename(cached_file))):
+            os.remove(stale_file)
 
+    return cached_file
 
-def _estimate_map(model, trial_type, hrf_model, output_type):
+
+def _atlas_support_mask(mask_file, atlas_file):
+    """Intersect a brain mask with the labeled voxels of an atlas
+
+    The atlas is resampled to the brain mask (with nearest neighbor
+    interpolation) like ``NiftiLabelsMasker`` resamples it to the beta series,
+    so the voxels left out of the mask are never averaged into a parcel.
+    Every voxel is fit on its own, so the estimates of the remaining
+    voxels do not change.
+
+    Parameters
+    ----------
+    mask_file : str or nibabel.spatialimages.SpatialImage
+        Binarized nifti file indicating the brain
+    atlas_file : str or nibabel.spatialimages.SpatialImage
+        atlas image with each parcel given a unique (nonzero) index
+
+    Returns
+    -------
+    mask_img : nibabel.nifti1.Nifti1Image
+        the brain voxels with an atlas label
+    """
+    import numpy as np
+    from nilearn._utils.niimg_conversions import _check_same_fov, check_niimg_3d
+    from nilearn.image import new_img_like, resample_to_img
+
+    mask_img = check_niimg_3d(mask_file)
+    atlas_img = check_niimg_3d(atlas_file)
+    if not _check_same_fov(mask_img, atlas_img):
+        atlas_img = resample_to_img(atlas_img, mask_img, interpolation='nearest')
+
+    support = (np.asarray(mask_img.dataobj) != 0) & (np.asarray(atlas_img.dataobj) != 0)
+    return new_img_like(mask_img, support.astype(np.uint8))
+
+
+def _read_bold(bold_file, bold_cache_dir=None, mem_budget_gb=None):
+    """Read a bold run ahead of its fit (e.g., in a background thread)
+
+    Parameters
+    ----------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        The bold run
+    bold_cache_dir : str or None
+        directory of the decompressed bold runs (see ``_cached_bold``)
+    mem_budget_gb : float or None
+        memory budget (in gigabytes) of the fit
+
+    Returns
+    -------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        the cached (decompressed) bold run, or the bold run read in memory,
+        or the bold run itself with a memory budget (its volumes are then
+        read in batches while it is masked, see ``_masked_bold_memmap``)
+    """
+    if not isinstance(bold_file, str):
+        return bold_file
+    if bold_cache_dir is not None:
+        return _cached_bold(bold_file, bold_cache_dir)
+    if mem_budget_gb is not None:
+        return bold_file
+    return _read_img(bold_file)
+
+
+def _read_img(img_file):
+    """Load an image with its data read in memory"""
+    import numpy as np
+
+    img = nib.load(img_file)
+    return img.__class__(np.asanyarray(img.dataobj), img.affine, img.header)
+
+
+def _load_bold(bold_file):
+    """Load a bold run to read its volumes in batches (see ``_iter_volumes``)
+
+    The file of a gzipped bold run stays open between reads, so each batch
+    of volumes is decompressed from where the previous batch ended (or from
+    the closest point of the seek index that ``indexed_gzip``, when installed,
+    builds over the gzip stream) instead of from the start of the file.
+
+    Parameters
+    ----------
+    bold_file : str or nibabel.spatialimages.SpatialImage
+        The bold run
+
+    Returns
+    -------
+    bold_img : nibabel.spatialimages.SpatialImage
+        the bold run, whose data is read on demand
+    """
+    if not isinstance(bold_file, str):
+        return bold_file
+    return nib.load(bold_file, keep_file_open=bold_file.endswith('.gz'))
+
+
+def _iter_volumes(img, n_volumes):
+    """Read a 4D image in batches of consecutive volumes
+
+    Parameters
+    ----------
+    img : nibabel.spatialimages.SpatialImage
+        4D image (see ``_load_bold``)
+    n_volumes : int
+        number of volumes in a batch
+
+    Yields
+    ------
+    start : int
+        index of the first volume of the batch
+    volumes : numpy.ndarray
+        the (scaled) data of the batch of volumes, of shape (x, y, z, n_volumes)
+        (or less for the last batch)
+    """
+    import numpy as np
+
+    for start in range(0, img.shape[3], n_volumes):
+        yield start, np.asanyarray(img.dataobj[..., start:start + n_volumes])
+
+
+def _masked_bold_memmap(bold_img, mask_img, smoothing_kernel, signal_scaling,
+                        mem_budget_gb, memmap_file, precision='float64'):
+    """Mask, smooth, and scale a bold run into a memory mapped .npy file
+
+    The volumes are smoothed and masked in batches and each voxel's timeseries
+    is scaled in blocks of voxels, so that at most ``mem_budget_gb`` of data is
+    in memory at once. The result is the same as
+    ``NiftiMasker.transform`` followed by ``mean_scaling``.
+
+    Parameters
+    ----------
+    bold_img : nibabel.spatialimages.SpatialImage
+        The bold run
+    mask_img : nibabel.spatialimages.SpatialImage
+        Binarized nifti image indicating the brain
+    smoothing_kernel : float or None
+        full wide half max smoothing kernel
+    signal_scaling : False or 0
+        Whether (0) or not (False) to scale each voxel's timeseries
+    mem_budget_gb : float
+        memory budget (in gigabytes)
+    memmap_file : str
+        .npy file to hold the masked data
+    precision : str
+        floating point type of the masked data ('float64' or 'float32')
+
+    Returns
+    -------
+    data : numpy.memmap
+        read-only masked (and optionally smoothed and scaled) bold data
+        of shape (n_scans, n_voxels), stored voxel by voxel
     """
-    Calculates model output for every voxel from
-    a nistats model
+    import os
+    import numpy as np
+    from nilearn.image.image import _smooth_array
+    from nistats.first_level_model import mean_scaling
+
+    mask = np.asarray(mask_img.dataobj).astype(bool)
+    n_scans = bold_img.shape[3]
+    budget = mem_budget_gb * 1024 ** 3
+    # a batch of volumes is loaded, converted, and masked
+    n_volumes = max(1, int(budget / (3 * 8 * mask.size)))
+
+    raw_file = memmap_file if signal_scaling is False else memmap_file + '.raw.npy'
+    raw = None
+    for start, volumes in _iter_volumes(bold_img, n_volumes):
+        volumes = np.array(volumes)
+        if volumes.dtype.kind != 'f':
+            volumes = volumes.astype(np.float32)
+        _smooth_array(volumes, bold_img.affine, fwhm=smoothing_kernel,
+                      ensure_finite=True, copy=False)
+        if raw is None:
+            # voxel timeseries are contiguous to read blocks of voxels
+            # (scaling is done at the precision of the bold data)
+            raw_dtype = precision if signal_scaling is False else volumes.dtype
+            raw = np.lib.format.open_memmap(raw_file, mode='w+', dtype=raw_dtype,
+                                            shape=(n_scans, int(mask.sum())),
+                                            fortran_order=True)
+        raw[start:start + n_volumes] = volumes[mask].T
+        del volumes
+    raw.flush()
+    del raw
+
+    if signal_scaling is not False:
+        raw = np.load(raw_file, mmap_mode='r')
+        scaled = np.lib.format.open_memmap(memmap_file, mode='w+', dtype=precision,
+                                           shape=raw.shape, fortran_order=True)
+        block_size = _voxel_block_size(n_scans, mem_budget_gb, n_arrays=3)
+        for start in range(0, raw.shape[1], block_size):
+            block = slice(start, start + block_size)
+            scaled[:, block], _ = mean_scaling(np.asarray(raw[:, block]), signal_scaling)
+        scaled.flush()
+        del raw, scaled
+        os.remove(raw_file)
+
+    return np.load(memmap_file, mmap_mode='r')
+
+
+def _basis_columns(trial_type, hrf_model):
+    """Design matrix columns of every hrf basis function for a trial type
 
     Parameters
     ----------
-    model : nistats.first_level_model.FirstLevelModel
-        a fit model of the first level results
     trial_type : str
-        the trial to create the beta estimate
+        the trial type modeled in the design matrix
     hrf_model : str
         the hemondynamic response function used to fit the model
-    output_type : str
-        Type of the output map.
-        Can be ‘z_score’, ‘stat’, ‘p_value’, ‘effect_size’, or ‘effect_variance’
 
     Returns
     -------
-    map_img : nibabel.nifti2.Nifti2Image
-        nifti image containing voxelwise output_type estimates
+    columns : list
+        the main regressor followed by its derivative and dispersion regressors
+        (when they are part of the hrf model)
     """
-    import numpy as np
-
-    # calculate the beta map
-    map_list = []
-    map_base = model.compute_contrast(trial_type, output_type=output_type)
-    map_list.append(map_base.get_fdata())
-    sign = np.where(map_list[0] < 0, -1, 1)
+    columns = [trial_type]
     if 'derivative' in hrf_model:
-        td_contrast = '_'.join([trial_type, 'derivative'])
-        map_list.append(
-            model.compute_contrast(
-                td_contrast, output_type=output_type).get_fdata())
+        columns.append('_'.join([trial_type, 'derivative']))
     if 'dispersion' in hrf_model:
-        dd_contrast = '_'.join([trial_type, 'dispersion'])
-        map_list.append(
-            model.compute_contrast(
-                dd_contrast, output_type=output_type).get_fdata())
+        columns.append('_'.join([trial_type, 'dispersion']))
+    return columns
 
-    if len(map_list) == 1:
-        map_img = map_base
+
+def _ar1_whiten(arr, rho, scans=None):
+    """Whiten the rows of an array according to an AR(1) covariance structure
+    (see nistats.regression.ARModel.whiten), keeping its floating point type
+
+    With ``scans`` (True for every scan of the run in the rows of the array),
+    the rows are whitened according to the AR(1) covariance of the kept scans.
+    Each row is its innovation from the previous kept scan, scaled by the standard
+    deviation of the innovations over the gap. The whitened model is then the one
+    of every scan with a spike regressor for each dropped scan, with the dropped
+    scans fit exactly (and left out of the normal equations).
+    """
+    import numpy as np
+
+    arr = np.asarray(arr)
+    if arr.dtype.kind != 'f':
+        arr = arr.astype(np.float64)
+    whitened = arr.copy()
+    if scans is None:
+        whitened[1:] -= rho * arr[:-1]
+        return whitened
+
+    # number of innovations since the previous kept scan (or the start of the run)
+    times = np.flatnonzero(scans)
+    steps = np.concatenate(([times[0] + 1], np.diff(times)))
+    factors = (rho ** steps[1:]).reshape((-1,) + (1,) * (arr.ndim - 1))
+    whitened[1:] -= factors * arr[:-1]
+    if abs(rho) < 1:
+        variances = (1 - rho ** (2 * steps)) / (1 - rho ** 2)
+    else:
+        variances = steps.astype(np.float64)
+    whitened /= np.sqrt(variances).reshape((-1,) + (1,) * (arr.ndim - 1))
+    return whitened
+
+
+def _run_glm(data, design_matrix, columns, bins=100, return_residuals=True,
+             gram_cache=None, block_size=None, residual_sum=None, nuisance=None,
+             scans=None, labels=None, design_cache_dir=None, residual_file=None):
+    """Fit a GLM with an AR(1) noise model over every voxel at once
+
+    Reproduces the estimates of ``nistats.first_level_model.run_glm``,
+    but only the parameter estimates and variances of ``columns`` are kept
+    instead of a full regression result object per AR(1) bin.
+    The models are solved through the inverse of their normal equations
+    (see ``_whitened_inverse``).
+    The voxels can be fit in blocks to bound the memory used by the fit,
+    the inverses of the (whitened) designs are shared by all the blocks.
+    The inverses are always computed in float64, the voxelwise products
+    and the estimates have the floating point type of the data.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        masked (float32 or float64) bold data of shape (n_scans, n_voxels)
+    design_matrix : pandas.DataFrame
+        design matrix of shape (n_scans, n_regressors)
+    columns : list
+        names of the regressors to estimate
+    bins : int
+        maximum number of discrete bins for the AR(1) coefficients
+    return_residuals : bool
+        keep the model residuals (requires an array as large as the data)
+    gram_cache : dict or None
+        inverses of previously fit designs to update (see ``_whitened_inverse``)
+    block_size : int or None
+        number of voxels fit at once (all voxels if None)
+    residual_sum : _ResidualSum or None
+        add the model residuals to this sum block by block
+        instead of returning them
+    nuisance : _NuisanceProjection or None
+        the last regressors of the design projected out of the data,
+        the ordinary least squares fit then only has the other regressors
+    scans : numpy.ndarray or None
+        True for every scan of the run kept in the rows of the data and design
+        (all scans if None), the AR(1) noise model spans the dropped scans
+        (see ``_ar1_whiten``)
+    labels : numpy.ndarray or None
+        (discretized) AR(1) coefficient of every voxel, e.g., zeros for an
+        ordinary least squares fit (estimated from the design if None)
+    design_cache_dir : str or None
+        directory caching the inverses of the whitened designs
+        (see ``_gram_pinv``)
+    residual_file : str or None
+        .npy file of the memory mapped residuals (in memory if None)
+
+    Returns
+    -------
+    effects : numpy.ndarray
+        parameter estimates of shape (len(columns), n_voxels)
+    variances : numpy.ndarray
+        variance of the parameter estimates of shape (len(columns), n_voxels)
+    residuals : numpy.ndarray, numpy.memmap, or None
+        model residuals of shape (n_scans, n_voxels)
+        (None if return_residuals is False or residual_sum is given)
+    """
+    import numpy as np
+
+    dtype = data.dtype
+    design = design_matrix.values
+    col_idx = [design_matrix.columns.get_loc(col) for col in columns]
+    n_scans, n_regressors = design.shape
+    n_voxels = data.shape[1]
+    block_size = block_size or max(n_voxels, 1)
+    blocks = [slice(start, start + block_size) for start in range(0, n_voxels, block_size)]
+
+    if labels is None:
+        labels = _ar1_labels(data, design, bins, gram_cache, block_size, nuisance, scans,
+                             design_cache_dir)
+    # the same whitened designs are used by every block
+    whitened = {}
+    for val in np.unique(labels):
+        whitened_design, inverse = _whitened_inverse(design, val, gram_cache, scans=scans,
+                                                     design_cache_dir=design_cache_dir)
+        whitened[val] = (whitened_design.astype(dtype, copy=False),
+                         inverse.astype(dtype, copy=False),
+                         np.diag(inverse)[col_idx])
+
+    effects = np.zeros((len(col_idx), n_voxels), dtype=dtype)
+    variances = np.zeros_like(effects)
+    return_residuals = return_residuals and residual_sum is None
+    residuals = None
+    if return_residuals and residual_file is None:
+        residuals = np.zeros((n_scans, n_voxels), dtype=dtype)
+    elif return_residuals:
+        residuals = np.lib.format.open_memmap(residual_file, mode='w+', dtype=dtype,
+                                              shape=(n_scans, n_voxels))
+    for block in blocks:
+        block_data = np.asarray(data[:, block])
+        block_labels = labels[block]
+        block_effects = effects[:, block]
+        block_variances = variances[:, block]
+        if residual_sum is not None:
+            block_residuals = np.zeros(block_data.shape, dtype=dtype)
+        elif return_residuals:
+            block_residuals = residuals[:, block]
+        # refit the voxels sharing the same (discretized) AR(1) coefficient
+        for val in np.unique(block_labels):
+            voxels = block_labels == val
+            # (with the diagonal of the normalized covariance for the selected columns)
+            whitened_design, inverse, cov_diag = whitened[val]
+            whitened_data = _ar1_whiten(block_data[:, voxels], val, scans)
+            theta = inverse.dot(whitened_design.T.dot(whitened_data))
+            predicted = whitened_design.dot(theta)
+            dispersion = (((whitened_data - predicted) ** 2).sum(axis=0, dtype=np.float64) /
+                          (n_scans - n_regressors))
+            block_effects[:, voxels] = theta[col_idx]
+            block_variances[:, voxels] = cov_diag[:, np.newaxis] * dispersion
+            if return_residuals or residual_sum is not None:
+                # like nistats, residuals are taken from the unwhitened data
+                block_residuals[:, voxels] = block_data[:, voxels] - predicted
+        if residual_sum is not None:
+            residual_sum.add(block_residuals, block)
+
+    return effects, variances, residuals
+
+
+def _ar1_labels(data, design, bins=100, gram_cache=None, block_size=None, nuisance=None,
+                scans=None, design_cache_dir=None):
+    """Discretized AR(1) coefficients from an ordinary least squares fit
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        masked bold data of shape (n_scans, n_voxels)
+    design : numpy.ndarray
+        design matrix of shape (n_scans, n_regressors)
+    bins : int
+        maximum number of discrete bins for the AR(1) coefficients
+    gram_cache : dict or None
+        inverses of previously fit designs to update (see ``_whitened_inverse``)
+    block_size : int or None
+        number of voxels fit at once (all voxels if None)
+    nuisance : _NuisanceProjection or None
+        the last regressors of the design projected out of the data,
+        the fit then only has the other regressors
+    scans : numpy.ndarray or None
+        True for every scan of the run kept in the rows of the data and design
+        (the coefficients are only estimated from pairs of successive scans)
+    design_cache_dir : str or None
+        directory caching the inverse of the design (see ``_gram_pinv``)
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        AR(1) coefficient of every voxel, rounded down to a multiple of ``1 / bins``
+    """
+    import numpy as np
+
+    dtype = data.dtype
+    n_voxels = data.shape[1]
+    block_size = block_size or max(n_voxels, 1)
+    lagged = slice(None) if scans is None else np.diff(np.flatnonzero(scans)) == 1
+    if nuisance is None:
+        _, inverse = _whitened_inverse(design, 0., gram_cache, scans=scans,
+                                       design_cache_dir=design_cache_dir)
+        ols_design = design
+        ols_data = data
     else:
-        map_array = sign * \
-            np.sqrt(
-                np.sum(
-                    np.array([np.power(c, 2) for c in map_list]), axis=0))
+        # (with the same residuals on the projected data and regressors)
+        ols_design = nuisance.project(design[:, :design.shape[1] - nuisance.n_columns])
+        inverse, _ = _gram_pinv(ols_design)
+        ols_data = nuisance.data
+    ols_pinv = inverse.dot(ols_design.T).astype(dtype, copy=False)
+    ols_design = ols_design.astype(dtype, copy=False)
+    ar1 = np.empty(n_voxels)
+    for start in range(0, n_voxels, block_size):
+        block = slice(start, start + block_size)
+        block_data = np.asarray(ols_data[:, block])
+        ols_residuals = block_data - ols_design.dot(ols_pinv.dot(block_data))
+        # (the sums over scans are accumulated in float64)
+        lag_products = (ols_residuals[1:] * ols_residuals[:-1])[lagged]
+        ar1[block] = (lag_products.sum(axis=0, dtype=np.float64) /
+                      (ols_residuals ** 2).sum(axis=0, dtype=np.float64))
+        del ols_residuals, lag_products
+    return (ar1 * bins).astype(int) * 1. / bins
+
+
+def _run_projected_glm(projection, design_matrix, columns, block_size=None,
+                       residual_sum=None, data=None):
+    """Fit a GLM on data with the (whitened) nuisance regressors projected out
+
+    The AR(1) coefficients of the voxels are those of the projection
+    (see ``_NuisanceProjection``), so that only the other (condition) regressors
+    of the design are whitened, projected, and fit. The estimates, variances,
+    and residuals are those of ``_run_glm`` with the same AR(1) coefficients.
+
+    Parameters
+    ----------
+    projection : _NuisanceProjection
+        the data whitened with the AR(1) coefficient of each voxel
+        and projected out of the last regressors of the design
+    design_matrix : pandas.DataFrame
+        design matrix of shape (n_scans, n_regressors)
+    columns : list
+        names of the regressors to estimate
+    block_size : int or None
+        number of voxels fit at once (all voxels if None)
+    residual_sum : _ResidualSum or None
+        add the model residuals (from the unwhitened ``data``) to this sum
+    data : numpy.ndarray or None
+        masked bold data of shape (n_scans, n_voxels) (only for the residuals)
+
+    Returns
+    -------
+    effects : numpy.ndarray
+        parameter estimates of shape (len(columns), n_voxels)
+    variances : numpy.ndarray
+        variance of the parameter estimates of shape (len(columns), n_voxels)
+    """
+    import numpy as np
+
+    dtype = projection.data.dtype
+    n_scans, n_regressors = design_matrix.shape
+    n_voxels = projection.data.shape[1]
+    conditions = design_matrix.values[:, :n_regressors - projection.n_columns]
+    col_idx = [design_matrix.columns.get_loc(col) for col in columns]
+    block_size = block_size or max(n_voxels, 1)
+
+    # the small whitened and projected designs are shared by every block
+    fits = {}
+    for val in projection.bases:
+        projected_design = projection.project(conditions, val)
+        inverse, _ = _gram_pinv(projected_design)
+        fits[val] = (projected_design.astype(dtype, copy=False),
+                     inverse.dot(projected_design.T).astype(dtype, copy=False),
+                     np.diag(inverse)[col_idx])
+
+    effects = np.zeros((len(col_idx), n_voxels), dtype=dtype)
+    variances = np.zeros_like(effects)
+    for start in range(0, n_voxels, block_size):
+        block = slice(start, start + block_size)
+        block_data = np.asarray(projection.data[:, block])
+        block_labels = projection.labels[block]
+        block_effects = effects[:, block]
+        block_variances = variances[:, block]
+        if residual_sum is not None:
+            raw_data = np.asarray(data[:, block])
+            block_residuals = np.zeros(block_data.shape, dtype=dtype)
+        for val in np.unique(block_labels):
+            voxels = block_labels == val
+            projected_design, pinv, cov_diag = fits[val]
+            # (without copying the block when its voxels share a coefficient)
+            voxel_data = block_data if voxels.all() else block_data[:, voxels]
+            theta = pinv.dot(voxel_data)
+            whitened_residuals = voxel_data - projected_design.dot(theta)
+            dispersion = ((whitened_residuals ** 2).sum(axis=0, dtype=np.float64) /
+                          (n_scans - n_regressors))
+            block_effects[:, voxels] = theta[col_idx]
+            block_variances[:, voxels] = cov_diag[:, np.newaxis] * dispersion
+            if residual_sum is not None:
+                # like nistats, the whitened prediction is taken from the unwhitened data
+                block_residuals[:, voxels] = (
+                    raw_data[:, voxels] - _ar1_whiten(raw_data[:, voxels], val,
+                                                      projection.scans)
+                    + whitened_residuals)
+        if residual_sum is not None:
+            residual_sum.add(block_residuals, block)
+
+    return effects, variances
+
+
+def _voxel_block_size(n_scans, mem_budget_gb, n_arrays=6, itemsize=8):
+    """Number of voxels to fit at once to stay within a memory budget
+
+    Parameters
+    ----------
+    n_scans : int
+        number of scans of the bold run
+    mem_budget_gb : float or None
+        memory budget (in gigabytes)
+    n_arrays : int
+        number of (n_scans, block_size) arrays used at once
+    itemsize : int
+        number of bytes of an array element (8 for float64, 4 for float32)
+
+    Returns
+    -------
+    block_size : int or None
+        number of voxels per block (None if there is no budget)
+    """
+    if mem_budget_gb is None:
+        return None
+    return max(1, int(mem_budget_gb * 1024 ** 3 / (n_arrays * n_scans * itemsize)))
+
+
+def _combine_basis(estimates):
+    """Combine estimates across hrf basis functions
+
+    The combined estimate is the root sum of squares of the estimates
+    of every basis function with the sign of the main regressor's estimate.
+    The estimates are overwritten to avoid allocating more arrays.
+
+    Parameters
+    ----------
+    estimates : numpy.ndarray
+        estimates of shape (n_basis, ...), with the main regressor first
+
+    Returns
+    -------
+    combined : numpy.ndarray
+        the main estimate signed root sum of squares of all estimates
+        of shape (...)
+    """
+    import numpy as np
+
+    if estimates.shape[0] == 1:
+        return estimates[0]
+    negative = estimates[0] < 0
+    np.square(estimates, out=estimates)
+    combined = estimates[0]
+    for basis_estimates in estimates[1:]:
+        combined += basis_estimates
+    np.sqrt(combined, out=combined)
+    np.negative(combined, out=combined, where=negative)
+    return combined
+
+
+def _tstat(effect, variance):
+    """Divide estimates by their standard error (see ``_combine_basis``)"""
+    import numpy as np
+
+    # make it so we do not divide by zero
+    # (1e-50 is below the smallest float32)
+    TINY = max(1e-50, np.finfo(variance.dtype).tiny)
+    tstat = np.maximum(variance, TINY)
+    np.sqrt(tstat, out=tstat)
+    return np.divide(effect, tstat, out=tstat)
+
+
+def _fit_lss_trials(data, design, trials, return_tstat, return_residuals=True,
+                    residual_precision='float32', block_size=None, nuisance=None,
+                    design_cache_dir=None, residual_file=None):
+    """Fit the LSS model of every trial in a list of trials
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        masked bold data of shape (n_scans, n_voxels)
+    design : _LSSDesignBuilder
+        builder of the design matrix of each trial
+    trials : list
+        tuples of (trial_id, trial_type, trial_counter), where trial_id
+        is the row of the trial in the events file
+    return_tstat : bool
+        return the t-statistic for the betas instead of the raw estimates
+    return_residuals : bool
+        add up the model residuals of the trials
+    residual_precision : str
+        precision of the running sum of residuals ('float32' or 'float64')
+    block_size : int or None
+        number of voxels fit at once (all voxels if None)
+    nuisance : _NuisanceProjection or None
+        the confounds and drifts of the designs projected out of the data
+        (with the data whitened once for every trial model when it has labels)
+    design_cache_dir : str or None
+        directory caching the inverses of the whitened designs
+        (see ``_gram_pinv``)
+    residual_file : str or None
+        .npy file of the memory mapped sum of residuals (in memory if None),
+        the sum spans every voxel whatever the block size
+
+    Returns
+    -------
+    trial_results : list
+        tuples of (trial_counter, design_matrix, trial_maps) for every trial,
+        where trial_maps is a list of (trial_type, beta_map) pairs
+    residuals : _ResidualSum or None
+        sum of the model residuals of all trials
+        (None if return_residuals is False)
+    """
+    trial_results = []
+    residuals = None
+    if return_residuals:
+        residuals = _ResidualSum(residual_precision, data.shape, memmap_file=residual_file,
+                                 block_size=block_size)
+    # inverses of the normal equations, updated from one trial model to the next
+    gram_cache = {}
+    for trial_id, trial_type, trial_idx in trials:
+        design_matrix = design.design_matrix(trial_id)
+
+        estimates = _lss_estimates(trial_type, design.hrf_model, design.fir_delays)
+
+        # fit the model for the target trial over all voxels at once
+        # (the residuals are added to the running sum block by block)
+        columns = [col for _, cols in estimates for col in cols]
+        if nuisance is not None and nuisance.labels is not None:
+            effects, variances = _run_projected_glm(
+                nuisance, design_matrix, columns, block_size=block_size,
+                residual_sum=residuals, data=data)
+        else:
+            effects, variances, _ = _run_glm(
+                data, design_matrix, columns,
+                return_residuals=False, gram_cache=gram_cache,
+                block_size=block_size, residual_sum=residuals, nuisance=nuisance,
+                scans=design.scans, design_cache_dir=design_cache_dir)
+
+        trial_maps = []
+        start = 0
+        for new_ttype, columns in estimates:
+            stop = start + len(columns)
+            # calculate the beta map
+            beta_map = _combine_basis(effects[start:stop])
+            if return_tstat:
+                beta_map = _tstat(beta_map, _combine_basis(variances[start:stop]))
+            start = stop
+            trial_maps.append((new_ttype, beta_map))
+        trial_results.append((trial_idx, design_matrix, trial_maps))
+
+    return trial_results, residuals
+
+
+def _lss_estimates(trial_type, hrf_model, fir_delays=None):
+    """Beta series estimated from the LSS model of a trial
+
+    Parameters
+    ----------
+    trial_type : str
+        the trial type of the target trial
+    hrf_model : str
+        the hemondynamic response function used to fit the model
+    fir_delays : list or None
+        FIR delays (in scans)
+
+    Returns
+    -------
+    estimates : list
+        tuples of (beta series name, design matrix columns) for every beta series
+    """
+    if hrf_model == 'fir':
+        # FS modeling: one beta series per delay
+        return [
+            (trial_type + 'Delay{}Vol'.format(delay),
+             [trial_type + '_delay_{}'.format(delay)])
+            for delay in fir_delays
+        ]
+    return [(trial_type, _basis_columns(trial_type, hrf_model))]
+
+
+def _whitened_inverse(design, rho, cache=None, max_updates=20, scans=None,
+                      design_cache_dir=None):
+    """Inverse of the normal equations of an AR(1) whitened design
+
+    When ``cache`` holds the inverse for the same AR(1) coefficient from a
+    previous design with only a few different columns (e.g., the previous LSS
+    trial model), the inverse is updated for the replaced columns
+    (see ``_replace_columns``) instead of being computed again.
+
+    Parameters
+    ----------
+    design : numpy.ndarray
+        design matrix of shape (n_scans, n_regressors)
+    rho : float
+        AR(1) coefficient used to whiten the design
+    cache : dict or None
+        whitened design, inverse, and number of updates since the inverse
+        was last computed for each AR(1) coefficient (updated in place)
+    max_updates : int
+        number of successive updates after which the inverse is computed again
+        to keep rounding errors from accumulating
+    scans : numpy.ndarray or None
+        True for every scan of the run kept in the rows of the design
+        (see ``_ar1_whiten``)
+    design_cache_dir : str or None
+        directory caching the inverses computed from scratch (see ``_gram_pinv``)
+
+    Returns
+    -------
+    whitened_design : numpy.ndarray
+        the whitened design of shape (n_scans, n_regressors)
+    inverse : numpy.ndarray
+        (pseudo-)inverse of the normal equations of the whitened design
+        of shape (n_regressors, n_regressors)
+    """
+    import numpy as np
+
+    whitened_design = _ar1_whiten(design, rho, scans)
+    previous = None if cache is None else cache.get(rho)
+    inverse = None
+    if previous is not None:
+        old_design, old_inverse, n_updates = previous
+        if old_design.shape == whitened_design.shape and n_updates is not None:
+            changed = np.flatnonzero((old_design != whitened_design).any(axis=0))
+            # a rank 2 * n_changed update is only worth it for a few columns
+            if 2 * changed.size >= whitened_design.shape[1] or n_updates >= max_updates:
+                pass
+            elif changed.size == 0:
+                inverse = old_inverse
+            else:
+                inverse = _replace_columns(old_inverse, old_design,
+                                           whitened_design, changed)
+                n_updates += 1
+
+    if inverse is None:
+        inverse, full_rank = _gram_pinv(whitened_design, design_cache_dir)
+        # the update formulas do not hold for a pseudo-inverse
+        n_updates = 0 if full_rank else None
+
+    if cache is not None:
+        cache[rho] = (whitened_design, inverse, n_updates)
+    return whitened_design, inverse
+
+
+def _gram_pinv(design, cache_dir=None):
+    """Pseudo-inverse of the normal equations of a design
+
+    The runs (and subjects) with the same events, repetition time, number of scans,
+    hrf model, drifts, and confounds fit the same designs. With a ``cache_dir``,
+    the inverse is saved under a fingerprint of the design itself
+    (see ``_design_cache_file``), and later fits of the same design load it
+    instead of computing it again.
+
+    Parameters
+    ----------
+    design : numpy.ndarray
+        design matrix of shape (n_scans, n_regressors)
+    cache_dir : str or None
+        directory caching the inverses of full rank designs
+
+    Returns
+    -------
+    inverse : numpy.ndarray
+        pseudo-inverse of ``design.T.dot(design)``,
+        so that ``inverse.dot(design.T)`` is the pseudo-inverse of the design
+    full_rank : bool
+        whether the design has full column rank
+    """
+    import os
+    import numpy as np
+    from scipy import linalg
+
+    if cache_dir is not None:
+        cached_file = _design_cache_file('gram', design, cache_dir)
+        if os.path.exists(cached_file):
+            return np.load(cached_file), True
+
+    eigvals, eigvecs = linalg.eigh(design.T.dot(design))
+    # same cutoff as scipy.linalg.pinv on the singular values of the design
+    keep = eigvals > (max(design.shape) * np.finfo(float).eps) ** 2 * eigvals.max()
+    inverse = (eigvecs[:, keep] / eigvals[keep]).dot(eigvecs[:, keep].T)
+    full_rank = bool(keep.all())
+    # (a loaded inverse is taken to be the inverse of a full rank design)
+    if cache_dir is not None and full_rank:
+        _save_cached_array(inverse, cached_file)
+    return inverse, full_rank
+
+
+def _design_cache_file(kind, design, cache_dir):
+    """Cache file of a factorization of a design
+
+    The file is named after a hash of the values of the (whitened) design,
+    which covers everything the design is made of (events, repetition time,
+    number of scans, hrf model, drifts, confounds, dropped scans,
+    AR(1) coefficient), so that a factorization is only reused for
+    exactly the same design.
+
+    Parameters
+    ----------
+    kind : str
+        name of the factorization (prefix of the file name)
+    design : numpy.ndarray
+        design matrix of shape (n_scans, n_regressors)
+    cache_dir : str
+        directory of the cached factorizations
+
+    Returns
+    -------
+    cached_file : str
+        .npy file of the factorization of the design
+    """
+    import hashlib
+    import os
+    import numpy as np
+
+    design = np.ascontiguousarray(design)
+    key = hashlib.sha1('{}:{}:{}:'.format(kind, design.dtype.str, design.shape).encode())
+    key.update(design.data)
+    return os.path.join(cache_dir, '{}_{}.npy'.format(kind, key.hexdigest()))
+
+
+def _save_cached_array(arr, cached_file):
+    """Save an array into a cache shared by concurrent nodes
+
+    The array is written next to the cache entry and renamed once complete,
+    so concurrent nodes never load a partially written array.
+    """
+    import os
+    import tempfile
+    import numpy as np
+
+    cache_dir = os.path.dirname(cached_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, partial_file = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as partial:
+            np.save(partial, arr)
+        os.replace(partial_file, cached_file)
+    except BaseException:
+        os.remove(partial_file)
+        raise
+
+
+def _replace_columns(inverse, old_design, new_design, changed):
+    """Update the inverse of the normal equations for replaced design columns
+
+    Replacing the columns ``changed`` of the design by ``D = new - old`` adds
+    ``E A' + A E' + E B E'`` to the normal equations, with ``E`` the identity
+    columns of the replaced regressors, ``A = old' D``, and ``B = D' D``.
+    This low rank term is folded into the inverse with the Woodbury identity.
+
+    Parameters
+    ----------
+    inverse : numpy.ndarray
+        inverse of the normal equations of the old design
+    old_design : numpy.ndarray
+        the old design of shape (n_scans, n_regressors)
+    new_design : numpy.ndarray
+        the new design of shape (n_scans, n_regressors)
+    changed : numpy.ndarray
+        indices of the columns that differ between both designs
+
+    Returns
+    -------
+    inverse : numpy.ndarray
+        inverse of the normal equations of the new design
+    """
+    import numpy as np
+
+    n_regressors = inverse.shape[0]
+    n_changed = changed.size
+    delta = new_design[:, changed] - old_design[:, changed]
+    update = np.hstack((np.eye(n_regressors)[:, changed], old_design.T.dot(delta)))
+    # inverse of the middle matrix [[B, I], [I, 0]] of the low rank term
+    middle_inv = np.zeros((2 * n_changed, 2 * n_changed))
+    middle_inv[:n_changed, n_changed:] = np.eye(n_changed)
+    middle_inv[n_changed:, :n_changed] = np.eye(n_changed)
+    middle_inv[n_changed:, n_changed:] = -delta.T.dot(delta)
+
+    inverse_update = inverse.dot(update)
+    capacitance = middle_inv + update.T.dot(inverse_update)
+    inverse = inverse - inverse_update.dot(np.linalg.solve(capacitance, inverse_update.T))
+    # keep the inverse symmetric
+    return (inverse + inverse.T) / 2
+
+
+def _trial_regressors(onsets, durations, amplitudes, hrf_model, frame_times,
+                      fir_delays=None, oversampling=50, min_onset=-24):
+    """Convolve the regressor of each trial with the hrf model
+
+    Follows ``nistats.hemodynamic_models.compute_regressor`` for every trial
+    on its own, but without orthogonalizing the hrf basis functions, so the
+    regressor of a group of trials is the sum of their regressors.
+
+    Parameters
+    ----------
+    onsets : numpy.ndarray
+        onset of each trial (in seconds)
+    durations : numpy.ndarray
+        duration of each trial (in seconds)
+    amplitudes : numpy.ndarray
+        amplitude of each trial
+    hrf_model : str
+        the hemondynamic response function used to fit the model
+    frame_times : numpy.ndarray
+        acquisition time of every scan (in seconds)
+    fir_delays : list or None
+        FIR delays (in scans)
+    oversampling : int
+        oversampling factor used in temporal convolutions
+    min_onset : float
+        minimal onset relative to frame_times[0] (in seconds)
+
+    Returns
+    -------
+    regressors : numpy.ndarray
+        regressors of shape (n_trials, n_scans, n_basis)
+    """
+    import numpy as np
+    from nistats.hemodynamic_models import (
+        _hrf_kernel, _resample_regressor, _sample_condition)
+
+    tr = float(frame_times.max()) / (np.size(frame_times) - 1)
+    _, hr_frame_times = _sample_condition(
+        (np.array([]), np.array([]), np.array([])), frame_times, oversampling, min_onset)
+    n_hr = hr_frame_times.size
+
+    # boxcar of each trial over the high resolution frame times
+    t_onset = np.minimum(np.searchsorted(hr_frame_times, onsets), n_hr - 1)
+    t_offset = np.minimum(np.searchsorted(hr_frame_times, onsets + durations), n_hr - 1)
+    t_offset[(t_offset < n_hr - 1) & (t_offset == t_onset)] += 1
+
+    # the convolution of a boxcar is the difference of two shifted step responses
+    steps = [np.cumsum(kernel) for kernel in
+             _hrf_kernel(hrf_model, tr, oversampling, fir_delays)]
+    hr_times = np.arange(n_hr)
+
+    def step_response(step, shift):
+        lag = hr_times - shift
+        response = np.zeros(n_hr)
+        response[lag >= 0] = step[np.minimum(lag[lag >= 0], step.size - 1)]
+        return response
+
+    regressors = []
+    for onset, offset, amplitude in zip(t_onset, t_offset, amplitudes):
+        conv_reg = np.array([amplitude * (step_response(step, onset) -
+                                          step_response(step, offset))
+                             for step in steps])
+        if hrf_model == 'fir' and oversampling > 1:
+            regressors.append(_resample_regressor(conv_reg[:, oversampling - 1:],
+                                                  hr_frame_times[: 1 - oversampling],
+                                                  frame_times))
+        else:
+            regressors.append(_resample_regressor(conv_reg, hr_frame_times, frame_times))
+
+    return np.array(regressors).reshape(len(regressors), frame_times.size, len(steps))
+
+
+class _LSSDesignBuilder(object):
+    """Assemble the LSS design matrix of each trial from cached regressors
+
+    Every trial's regressor is convolved once (see ``_trial_regressors``),
+    the regressor of each LSS model's target trial, the other trials from its
+    condition, and the other conditions are then sums of the cached regressors.
+    The design matrices match ``nistats.design_matrix.make_first_level_design_matrix``
+    (with a cosine drift model), except that they are not regularized
+    when they are singular at working precision.
+
+    Parameters
+    ----------
+    events : pandas.DataFrame
+        all events from the bold run
+    frame_times : numpy.ndarray
+        acquisition time of every scan (in seconds)
+    hrf_model : str
+        the hemondynamic response function used to fit the model
+    high_pass : float
+        the high pass filter (Hz)
+    fir_delays : list or None
+        FIR delays (in scans)
+    confounds : pandas.DataFrame or None
+        confound regressors added to every design matrix
+    scans : numpy.ndarray or None
+        True for every scan kept in the design matrices (all scans if None),
+        the regressors are computed over every scan before the others are dropped
+    """
+
+    def __init__(self, events, frame_times, hrf_model, high_pass,
+                 fir_delays=None, confounds=None, scans=None):
+        import numpy as np
+        from nistats.design_matrix import _make_drift
+        from nistats.experimental_paradigm import check_events
+
+        trial_type, onset, duration, modulation = check_events(events)
+        # (numeric trial types are named like the events iterator labels them,
+        # and can be sorted with the 'other' regressor)
+        trial_type = trial_type.astype(str).astype(object)
+        self.frame_times = frame_times
+        self.scans = scans
+        rows = slice(None) if scans is None else scans
+        self.hrf_model = hrf_model.lower()
+        self.fir_delays = fir_delays
+        self.trial_types = trial_type
+        self.trial_counters = _trial_counters(trial_type)
+        self.regressors = _trial_regressors(onset, duration, modulation, self.hrf_model,
+                                            frame_times, fir_delays)
+        self.condition_regressors = {
+            cond: self.regressors[trial_type == cond].sum(axis=0)
+            for cond in np.unique(trial_type)
+        }
+
+        drift, drift_names = _make_drift('cosine', frame_times, 1, high_pass)
+        if confounds is None:
+            self.nuisance = drift
+            self.nuisance_names = drift_names
+        else:
+            self.nuisance = np.hstack((confounds.values, drift))
+            self.nuisance_names = confounds.columns.tolist() + drift_names
+        self.nuisance = self.nuisance[rows]
+
+    def design_matrix(self, trial_id):
+        """The LSS design matrix of a trial
+
+        Parameters
+        ----------
+        trial_id : int
+            row of the target trial in the events
+
+        Returns
+        -------
+        design_matrix : pandas.DataFrame
+            design matrix of shape (n_scans, n_regressors)
+        """
+        trial_type = self.trial_types[trial_id]
+        target = self.regressors[trial_id]
+        condition_regressors = dict(self.condition_regressors)
+        condition_regressors[trial_type] = target
+        if (self.trial_types == trial_type).sum() > 1:
+            condition_regressors['other'] = self.condition_regressors[trial_type] - target
+
+        return self._assemble(condition_regressors)
+
+    def condition_design_matrix(self):
+        """The design matrix with one regressor for each condition
+
+        Returns
+        -------
+        design_matrix : pandas.DataFrame
+            design matrix of shape (n_scans, n_regressors)
+        """
+        return self._assemble(self.condition_regressors)
+
+    def _assemble(self, condition_regressors):
+        import numpy as np
+        import pandas as pd
+        from nistats.hemodynamic_models import _orthogonalize, _regressor_names
+
+        rows = slice(None) if self.scans is None else self.scans
+        columns = []
+        names = []
+        # conditions are sorted like nistats does
+        for cond in sorted(condition_regressors):
+            regressors = condition_regressors[cond]
+            if self.hrf_model != 'fir':
+                regressors = _orthogonalize(regressors.copy())
+            columns.append(regressors[rows])
+            names += _regressor_names(cond, self.hrf_model, self.fir_delays)
+        columns.append(self.nuisance)
+        names += self.nuisance_names
+
+        return pd.DataFrame(np.hstack(columns), columns=names,
+                            index=self.frame_times[rows])
+
+
+class _ResidualSum(object):
+    """Running sum of masked model residuals
+
+    The sum is kept in float32, or in float64 with a (Kahan-Babuska)
+    compensation term so that adding many nearly cancelling residuals
+    does not lose precision.
+    With a memory budget, the sum (and its compensation) are memory mapped
+    files, which are pickled by name (e.g., when returned by a worker) and
+    merged or averaged by blocks of voxels.
+
+    Parameters
+    ----------
+    precision : str
+        'float32' or 'float64'
+    shape : tuple or None
+        shape (n_scans, n_voxels) of the sum (allocated by the first residuals if None)
+    memmap_file : str or None
+        .npy file of the memory mapped sum (in memory if None)
+    block_size : int or None
+        number of voxels merged or averaged at once (all voxels if None)
+    """
+
+    def __init__(self, precision='float32', shape=None, memmap_file=None, block_size=None):
+        self.precision = precision
+        self.memmap_file = memmap_file
+        self.block_size = block_size
+        self.total = None
+        self.compensation = None
+        if shape is not None:
+            self._allocate(shape)
+
+    @property
+    def _compensation_file(self):
+        return self.memmap_file[:-len('.npy')] + '_compensation.npy'
+
+    def _allocate(self, shape):
+        import numpy as np
+
+        if self.memmap_file is None:
+            self.total = np.zeros(shape, dtype=self.precision)
+            if self.precision == 'float64':
+                self.compensation = np.zeros_like(self.total)
+            return
+
+        self.total = np.lib.format.open_memmap(self.memmap_file, mode='w+',
+                                               dtype=self.precision, shape=shape)
+        if self.precision == 'float64':
+            self.compensation = np.lib.format.open_memmap(
+                self._compensation_file, mode='w+', dtype=self.precision, shape=shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memmap_file is not None:
+            # (the memory mapped arrays are reopened from their files)
+            for name in ('total', 'compensation'):
+                if state[name] is not None:
+                    state[name].flush()
+                    state[name] = True
+        return state
+
+    def __setstate__(self, state):
+        import numpy as np
+
+        self.__dict__.update(state)
+        if self.memmap_file is not None:
+            if self.total is not None:
+                self.total = np.load(self.memmap_file, mmap_mode='r+')
+            if self.compensation is not None:
+                self.compensation = np.load(self._compensation_file, mmap_mode='r+')
+
+    def _blocks(self):
+        n_voxels = self.total.shape[1]
+        block_size = self.block_size or max(n_voxels, 1)
+        return [slice(start, start + block_size) for start in range(0, n_voxels, block_size)]
+
+    def add(self, residuals, voxels=slice(None)):
+        """Add residuals of shape (n_scans, n_voxels) to the sum
+        (or to the sum of a block of voxels)"""
+        import numpy as np
+
+        if self.total is None:
+            self._allocate(residuals.shape)
+
+        if self.compensation is None:
+            self.total[:, voxels] += residuals
+            return
+
+        total = self.total[:, voxels]
+        new_total = total + residuals
+        # recover the low order bits lost by the larger of the two terms
+        lost = np.where(np.abs(total) >= np.abs(residuals),
+                        (total - new_total) + residuals,
+                        (residuals - new_total) + total)
+        self.compensation[:, voxels] += lost
+        self.total[:, voxels] = new_total
+
+    def merge(self, other):
+        """Add the sum of another ``_ResidualSum`` to this sum (and remove its files)"""
+        import numpy as np
+
+        if other.total is None:
+            return
+        if self.total is None:
+            self._allocate(other.total.shape)
+        for block in other._blocks():
+            self.add(np.asarray(other.total[:, block]), block)
+            if other.compensation is not None:
+                self.add(np.asarray(other.compensation[:, block]), block)
+        other.remove()
+
+    def mean(self, n):
+        """The sum divided by ``n``
+        (a memory mapped sum is divided in place)"""
+        if self.memmap_file is None:
+            if self.compensation is None:
+                return self.total / n
+            return (self.total + self.compensation) / n
+
+        for block in self._blocks():
+            if self.compensation is None:
+                self.total[:, block] /= n
+            else:
+                self.total[:, block] = (self.total[:, block] + self.compensation[:, block]) / n
+        return self.total
+
+    def remove(self):
+        """Release the sum and remove its memory mapped files"""
+        import os
+
+        self.total = None
+        self.compensation = None
+        if self.memmap_file is None:
+            return
+        for memmap_file in (self.memmap_file, self._compensation_file):
+            if os.path.exists(memmap_file):
+                os.remove(memmap_file)
+
+
+class _NuisanceProjection(object):
+    """Bold data with the nuisance regressors shared by every model projected out
+
+    By the Frisch-Waugh-Lovell theorem, regressing the projected data on the
+    projected other regressors gives the estimates and the residuals of the full
+    model. The nuisance regressors (e.g., the confounds and drifts of every LSS
+    trial model) are orthonormalized by a single (pivoted) QR decomposition,
+    and the data are projected once for all the models.
+
+    When the AR(1) coefficient of every voxel is known before the models are fit
+    (``labels``), the data are whitened first, and the nuisance regressors whitened
+    with each coefficient are projected out (one QR decomposition per coefficient).
+
+    Parameters
+    ----------
+    nuisance : numpy.ndarray
+        nuisance regressors of shape (n_scans, n_nuisance),
+        the last columns of the design matrices
+    data : numpy.ndarray
+        masked bold data of shape (n_scans, n_voxels)
+    block_size : int or None
+        number of voxels projected at once (all voxels if None)
+    memmap_file : str or None
+        .npy file memory mapping the projected data (kept in memory if None)
+    labels : numpy.ndarray or None
+        (discretized) AR(1) coefficient of every voxel (the data are not whitened if None)
+    scans : numpy.ndarray or None
+        True for every scan of the run kept in the rows of the data
+        (see ``_ar1_whiten``)
+    design_cache_dir : str or None
+        directory caching the orthonormal bases (see ``_orthonormal_basis``)
+    """
+
+    def __init__(self, nuisance, data, block_size=None, memmap_file=None, labels=None,
+                 scans=None, design_cache_dir=None):
+        import numpy as np
+
+        self.n_columns = nuisance.shape[1]
+        self.labels = labels
+        self.scans = scans
+        self.bases = {val: _orthonormal_basis(_ar1_whiten(nuisance, val, scans),
+                                              design_cache_dir)
+                      for val in (np.unique(labels) if labels is not None else [0.])}
+
+        n_voxels = data.shape[1]
+        if memmap_file is None:
+            self.data = np.empty(data.shape, dtype=data.dtype)
+        else:
+            self.data = np.lib.format.open_memmap(memmap_file, mode='w+', dtype=data.dtype,
+                                                  shape=data.shape, fortran_order=True)
+        bases = {val: basis.astype(data.dtype, copy=False) for val, basis in self.bases.items()}
+        block_size = block_size or max(n_voxels, 1)
+        for start in range(0, n_voxels, block_size):
+            block = slice(start, start + block_size)
+            block_data = np.asarray(data[:, block])
+            if labels is None:
+                basis = bases[0.]
+                self.data[:, block] = block_data - basis.dot(basis.T.dot(block_data))
+                continue
+            block_labels = labels[block]
+            projected = np.empty_like(block_data)
+            for val in np.unique(block_labels):
+                voxels = block_labels == val
+                whitened = _ar1_whiten(block_data[:, voxels], val, scans)
+                projected[:, voxels] = whitened - bases[val].dot(bases[val].T.dot(whitened))
+            self.data[:, block] = projected
+        if memmap_file is not None:
+            self.data.flush()
+            del self.data
+            self.data = np.load(memmap_file, mmap_mode='r')
+
+    def project(self, regressors, rho=0.):
+        """Project the nuisance regressors out of regressors of shape (n_scans, n)
+        (both whitened with the AR(1) coefficient ``rho`` when there are labels)"""
+        if self.labels is not None:
+            regressors = _ar1_whiten(regressors, rho, self.scans)
+        basis = self.bases[rho]
+        return regressors - basis.dot(basis.T.dot(regressors))
+
+
+def _orthonormal_basis(regressors, cache_dir=None):
+    """Orthonormal basis of the span of regressors of shape (n_scans, n)
+    from a (pivoted) QR decomposition (cached like ``_gram_pinv``)"""
+    import os
+    import numpy as np
+    from scipy import linalg
+
+    if cache_dir is not None:
+        cached_file = _design_cache_file('basis', regressors, cache_dir)
+        if os.path.exists(cached_file):
+            return np.load(cached_file)
+
+    basis, triangle, _ = linalg.qr(regressors, mode='economic', pivoting=True)
+    # drop the directions of linearly dependent regressors
+    diag = np.abs(np.diag(triangle))
+    rank = (diag > max(regressors.shape) * np.finfo(float).eps * diag.max()).sum()
+    basis = basis[:, :rank]
+    if cache_dir is not None:
+        _save_cached_array(basis, cached_file)
+    return basis
+
+
+class _BetaSeriesWriter(object):
+    """Write the beta series of every trial type as the trial estimates come in
+
+    The beta series are either 4D nifti images, allocated once (in memory or
+    as memory mapped files) with each trial's estimates written into its volume
+    and saved without concatenating per-trial images, or hdf5 files where each
+    trial's estimates are written into a row of a chunked and compressed
+    trials by masked voxels dataset (see ``load_beta_series``).
+    Optionally, the estimates are also written into a float32 trials by masked
+    voxels .npy file per beta series, which ``numpy.load(masked_file,
+    mmap_mode='r')`` reads without a copy (see ``save_mask`` for its voxels).
+
+    Parameters
+    ----------
+    mask_img : nibabel.spatialimages.SpatialImage
+        Binarized nifti image of the voxels with estimates
+    n_trials : dict
+        number of trials (volumes) of each beta series, in output order
+    template : str
+        file name of the beta series with a ``{trial_type}`` field
+        (without extension)
+    dtype : str
+        floating point type of the beta series
+    memmap_dir : str or None
+        directory of the memory mapped nifti beta series (in memory if None)
+    file_format : str
+        'nifti' (.nii.gz, or .nii without compression) or 'hdf5' (.h5)
+    masked : bool
+        also write the masked beta series (.npy)
+    compression_level : int
+        gzip compression level of the nifti files (0 for uncompressed .nii files)
+    compression_threads : int
+        number of threads compressing the nifti files (see ``_save_nifti``)
+    """
+
+    def __init__(self, mask_img, n_trials, template, dtype='float64', memmap_dir=None,
+                 file_format='nifti', masked=False, compression_level=1,
+                 compression_threads=1):
+        import os
+        import numpy as np
+
+        self.mask_img = mask_img
+        self.mask = np.asarray(mask_img.dataobj).astype(bool)
+        self.file_format = file_format
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        extension = '.h5' if file_format == 'hdf5' else _nifti_extension(compression_level)
+        self.files = {trial_type: template.format(trial_type=trial_type) + extension
+                      for trial_type in n_trials}
+        self.memmap_files = []
+        self.series = {}
+        self.masked_series = {}
+        self.masked_files = []
+        for trial_type, n_type_trials in n_trials.items():
+            if masked:
+                # each trial's (row) estimates are contiguous
+                masked_file = template.format(trial_type=trial_type) + '.npy'
+                self.masked_series[trial_type] = np.lib.format.open_memmap(
+                    masked_file, mode='w+', dtype=np.float32,
+                    shape=(int(n_type_trials), int(self.mask.sum())))
+                self.masked_files.append(masked_file)
+            if file_format == 'hdf5':
+                self.series[trial_type] = _create_hdf5_series(
+                    self.files[trial_type], trial_type, int(n_type_trials),
+                    self.mask, mask_img.affine, dtype)
+                continue
+            shape = self.mask.shape + (int(n_type_trials),)
+            # volumes are contiguous (like in the nifti file)
+            if memmap_dir is None:
+                self.series[trial_type] = np.zeros(shape, dtype=dtype, order='F')
+            else:
+                memmap_file = os.path.join(memmap_dir,
+                                           'desc-{}_betaseries4d.npy'.format(trial_type))
+                self.series[trial_type] = np.lib.format.open_memmap(
+                    memmap_file, mode='w+', dtype=dtype, shape=shape, fortran_order=True)
+                self.memmap_files.append(memmap_file)
+
+    def add(self, trial_type, trial_idx, beta_map):
+        """Write the masked estimates of the nth trial of a beta series"""
+        if trial_type in self.masked_series:
+            self.masked_series[trial_type][trial_idx] = beta_map
+        if self.file_format == 'hdf5':
+            self.series[trial_type]['betaseries'][trial_idx] = beta_map
+        else:
+            self.series[trial_type][..., trial_idx][self.mask] = beta_map
+
+    def save(self):
+        """Save every beta series
+
+        Returns
+        -------
+        beta_series_files : list
+            the file of every beta series
+        """
+        import os
+        from nilearn.image import new_img_like
+
+        for trial_type, series in self.series.items():
+            if self.file_format == 'hdf5':
+                series.close()
+            else:
+                _save_nifti(new_img_like(self.mask_img, series), self.files[trial_type],
+                            self.compression_level, self.compression_threads)
+        self.series = {}
+        for masked_series in self.masked_series.values():
+            masked_series.flush()
+        self.masked_series = {}
+        for memmap_file in self.memmap_files:
+            os.remove(memmap_file)
+        self.memmap_files = []
+        return list(self.files.values())
+
+    def save_mask(self, mask_file):
+        """Save the mask of the voxels (columns) of the masked beta series
+
+        The columns are the nonzero voxels of the mask in C order,
+        i.e., ``beta_series[..., trial_idx][mask] == masked_series[trial_idx]``.
+
+        Returns
+        -------
+        mask_file : str
+            the saved mask
+        """
+        from nilearn.image import new_img_like
+
+        _save_nifti(new_img_like(self.mask_img, self.mask.astype('uint8')), mask_file,
+                    self.compression_level, self.compression_threads)
+        return mask_file
+
+
+class _ParcelBetaSeriesWriter(object):
+    """Write the parcel beta series of every trial type as the trial estimates come in
+
+    Each beta series is a tsv file with a row per trial and a column per parcel
+    (named by its atlas label). Optionally, the beta series are also saved as
+    float32 trials by parcels .npy files, like the masked beta series of
+    ``_BetaSeriesWriter``.
+
+    Parameters
+    ----------
+    labels : list
+        atlas label of each parcel (column)
+    n_trials : dict
+        number of trials (rows) of each beta series, in output order
+    template : str
+        file name of the beta series with a ``{trial_type}`` field
+        (without extension)
+    dtype : str
+        floating point type of the beta series
+    masked : bool
+        also write the beta series as .npy files
+    """
+
+    def __init__(self, labels, n_trials, template, dtype='float64', masked=False):
+        import numpy as np
+
+        self.labels = [int(label) for label in labels]
+        self.files = {trial_type: template.format(trial_type=trial_type) + '.tsv'
+                      for trial_type in n_trials}
+        self.masked_files = []
+        if masked:
+            self.masked_files = [template.format(trial_type=trial_type) + '.npy'
+                                 for trial_type in n_trials]
+        self.series = {trial_type: np.zeros((int(n_type_trials), len(self.labels)),
+                                            dtype=dtype)
+                       for trial_type, n_type_trials in n_trials.items()}
+
+    def add(self, trial_type, trial_idx, beta_map):
+        """Write the parcel estimates of the nth trial of a beta series"""
+        self.series[trial_type][trial_idx] = beta_map
+
+    def save(self):
+        """Save every beta series
+
+        Returns
+        -------
+        beta_series_files : list
+            the file of every beta series
+        """
+        import numpy as np
+        import pandas as pd
+
+        for trial_type, series in self.series.items():
+            pd.DataFrame(series, columns=self.labels).to_csv(
+                self.files[trial_type], sep='\t', index=False)
+        for masked_file, series in zip(self.masked_files, self.series.values()):
+            np.save(masked_file, series.astype(np.float32))
+        self.series = {}
+        return list(self.files.values())
+
+
+def _save_residuals(masker, residuals, template, compression_level=1, compression_threads=1,
+                    dtype=None, scans=None, memmap_dir=None):
+    """Save the residuals of the voxels as a nifti image (or of the parcels as a tsv file)
+
+    Parameters
+    ----------
+    masker : nilearn.input_data.NiftiMasker or nilearn.input_data.NiftiLabelsMasker
+        the masker of the data (see ``_prepare_bold_data``)
+    residuals : numpy.ndarray or numpy.memmap
+        residual time series of shape (n_scans, n_voxels or n_parcels)
+    template : str
+        file name of the residuals (without extension)
+    compression_level : int
+        gzip compression level of the nifti image (see ``_save_nifti``)
+    compression_threads : int
+        number of threads compressing the nifti image
+    dtype : str or None
+        floating point type of the saved residuals (the type of residuals if None)
+    scans : numpy.ndarray or None
+        True for every scan of the run in the rows of the residuals,
+        the other (censored) scans are saved as zeros (all scans if None)
+    memmap_dir : str or None
+        directory of the memory mapped 4D residuals written volume by volume
+        (unmasked in memory if None)
+
+    Returns
+    -------
+    residual_file : str
+        the saved residuals
+    """
+    import os
+    import numpy as np
+    import pandas as pd
+    from nilearn.image import new_img_like
+    from nilearn.input_data import NiftiLabelsMasker
+
+    dtype = dtype or residuals.dtype
+    if isinstance(masker, NiftiLabelsMasker):
+        residuals = np.asarray(residuals).astype(dtype, copy=False)
+        if scans is not None:
+            residuals = _restore_scans(residuals, scans)
+        residual_file = template + '.tsv'
+        pd.DataFrame(residuals, columns=[int(label) for label in masker.labels_]).to_csv(
+            residual_file, sep='\t', index=False)
+        return residual_file
+
+    residual_file = template + _nifti_extension(compression_level)
+    if memmap_dir is None:
+        residuals = np.asarray(residuals).astype(dtype, copy=False)
+        if scans is not None:
+            residuals = _restore_scans(residuals, scans)
+        return _save_nifti(masker.inverse_transform(residuals), residual_file,
+                           compression_level, compression_threads)
+
+    # volumes are contiguous (like in the nifti file)
+    mask = np.asarray(masker.mask_img_.dataobj).astype(bool)
+    kept_scans = np.arange(residuals.shape[0]) if scans is None else np.flatnonzero(scans)
+    n_scans = residuals.shape[0] if scans is None else scans.size
+    memmap_file = os.path.join(memmap_dir, 'desc-residuals_bold4d.npy')
+    series = np.lib.format.open_memmap(memmap_file, mode='w+', dtype=dtype,
+                                       shape=mask.shape + (n_scans,), fortran_order=True)
+    try:
+        for row, scan in enumerate(kept_scans):
+            series[..., scan][mask] = residuals[row]
+        _save_nifti(new_img_like(masker.mask_img_, series), residual_file,
+                    compression_level, compression_threads)
+    finally:
+        del series
+        os.remove(memmap_file)
+    return residual_file
+
+
+def _create_hdf5_series(hdf5_file, trial_type, n_trials, mask, affine, dtype):
+    """Create an hdf5 beta series file
+
+    The file holds a ``betaseries`` dataset of shape (n_trials, n_voxels)
+    chunked by trial and block of voxels, the ``mask`` of the voxels,
+    and the ``affine`` of the mask.
+
+    Returns
+    -------
+    series : h5py.File
+        the beta series file opened for writing
+    """
+    import h5py
+    import numpy as np
+
+    n_voxels = int(mask.sum())
+    series = h5py.File(hdf5_file, 'w')
+    # one trial (or a block of voxels across trials) is read
+    # without decompressing the whole beta series
+    series.create_dataset('betaseries', shape=(n_trials, n_voxels), dtype=dtype,
+                          chunks=(1, max(1, min(n_voxels, 32768))),
+                          compression='gzip', shuffle=True)
+    series.create_dataset('mask', data=mask.astype(np.uint8), compression='gzip')
+    series.create_dataset('affine', data=affine)
+    series.attrs['trial_type'] = trial_type
+    return series
+
+
+def load_beta_series(beta_series_file):
+    """Load a beta series written as a nifti or hdf5 file
+
+    Parameters
+    ----------
+    beta_series_file : str
+        the beta series file (.nii, .nii.gz, or .h5)
+
+    Returns
+    -------
+    beta_series : nibabel.nifti1.Nifti1Image
+        4D image with one volume per trial
+
+    Notes
+    -----
+    Single trials or blocks of voxels can be read from an hdf5 beta series
+    without loading the whole file, e.g.,
+    ``h5py.File(beta_series_file, 'r')['betaseries'][trial_idx]``
+    are the estimates of a trial for the (nonzero) voxels of the ``mask`` dataset.
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if not beta_series_file.endswith('.h5'):
+        return nib.load(beta_series_file)
+
+    import h5py
+
+    with h5py.File(beta_series_file, 'r') as series:
+        mask = series['mask'][()].astype(bool)
+        betas = series['betaseries']
+        data = np.zeros(mask.shape + (betas.shape[0],), dtype=betas.dtype, order='F')
+        for trial_idx in range(betas.shape[0]):
+            data[..., trial_idx][mask] = betas[trial_idx]
+        affine = series['affine'][()]
+    return nib.Nifti1Image(data, affine)
+
+
+def _nifti_extension(compression_level):
+    """The extension of a nifti file saved with a gzip compression level"""
+    return '.nii' if compression_level == 0 else '.nii.gz'
+
+
+def _save_nifti(img, nifti_file, compression_level=1, n_threads=1):
+    """Save a nifti image with a gzip compression level and multiple threads
+
+    The image is written uncompressed (next to ``nifti_file``) and then
+    compressed in blocks, each block a gzip member compressed by one of the
+    threads. The concatenated members make a standard gzip file that nibabel
+    (and any gzip reader) reads like a single-threaded one.
+
+    Parameters
+    ----------
+    img : nibabel.spatialimages.SpatialImage
+        the image to save
+    nifti_file : str
+        the file name (.nii.gz, or .nii to save without compression)
+    compression_level : int
+        gzip compression level (1 is the fastest, 9 the smallest)
+    n_threads : int
+        number of threads compressing the blocks
+
+    Returns
+    -------
+    nifti_file : str
+        the saved file
+    """
+    import os
+    import tempfile
+    import nibabel as nib
+
+    if not nifti_file.endswith('.gz'):
+        nib.save(img, nifti_file)
+        return nifti_file
+
+    fd, raw_file = tempfile.mkstemp(suffix='.nii', dir=os.path.dirname(nifti_file) or None)
+    os.close(fd)
+    try:
+        nib.save(img, raw_file)
+        _block_gzip(raw_file, nifti_file, compression_level, n_threads)
+    finally:
+        os.remove(raw_file)
+    return nifti_file
+
+
+def _block_gzip(in_file, out_file, compression_level=1, n_threads=1, block_size=2 ** 22):
+    """Compress a file as consecutive gzip members of ``block_size`` bytes
+
+    zlib releases the GIL, so the blocks are compressed in parallel by a pool
+    of threads while they are read and written in order (at most two blocks
+    per thread are held in memory).
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    n_threads = max(1, n_threads)
+    with open(in_file, 'rb') as raw, open(out_file, 'wb') as compressed, \
+            ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = deque()
+        for block in iter(lambda: raw.read(block_size), b''):
+            pending.append(pool.submit(_gzip_member, block, compression_level))
+            if len(pending) >= 2 * n_threads:
+                compressed.write(pending.popleft().result())
+        while pending:
+            compressed.write(pending.popleft().result())
+
 
-        map_img = nib.Nifti2Image(
-            map_array,
-            map_base.affine,
-            map_base.header)
+def _gzip_member(block, compression_level):
+    """Compress a block of bytes into a gzip member"""
+    import gzip
+    import io
 
-    return map_img
+    member = io.BytesIO()
+    with gzip.GzipFile(fileobj=member, mode='wb',
+                       compresslevel=compression_level, mtime=0) as gz:
+        gz.write(block)
+    return member.getvalue()
@@ -21,11 +21,6 @@ def corr_fig(base_dir):
     return base_dir.ensure("desc-condTest_correlation.svg")
 
 
-@pytest.fixture(scope='session')
-def bs_out(base_dir):
-    return base_dir.ensure("desc-condTest_betaseries.nii.gz")
-
-
 def test_derivatives_data_sink_tsv(base_dir, betaseries_file, corr_csv, preproc_file):
 
     # the expected output
@@ -68,7 +63,9 @@ def test_derivatives_data_sink_svg(base_dir, betaseries_file, corr_fig, preproc_
     assert res.outputs.out_file == expected_out
 
 
-def test_derivatives_data_sink_bs(base_dir, betaseries_file, bs_out, preproc_file):
+@pytest.mark.parametrize("extension", ['nii.gz', 'nii', 'h5', 'npy'])
+def test_derivatives_data_sink_bs(base_dir, betaseries_file, preproc_file, extension):
+    bs_out = base_dir.ensure("desc-condTest_betaseries." + extension)
 
     # the expected output
     expected_out = os.path.join(
@@ -78,7 +75,7 @@ def test_derivatives_data_sink_bs(base_dir, betaseries_file, bs_out, preproc_fil
         'ses-pre',
         'func',
         ('sub-01_ses-pre_task-waffles_run-1_space-MNI152NLin2009cAsym'
-         '_desc-condTest_betaseries.nii.gz'))
+         '_desc-condTest_betaseries.' + extension))
 
     # create and run instance of the interface
     dds = DerivativesDataSink(base_directory=str(base_dir),
@@ -3,12 +3,19 @@ import nibabel as nib
 import numpy as np
 import pandas as pd
 import os
+import pytest
 
-from ..nilearn import AtlasConnectivity, CensorVolumes
+from ..nilearn import AtlasConnectivity, CensorVolumes, is_outlier
+from ..nistats import _BetaSeriesWriter
 
 
-def test_censor_volumes(tmp_path, betaseries_file, brainmask_file):
-    outlier_file = tmp_path / 'betaseries_outlier.nii.gz'
+@pytest.mark.parametrize("beta_series_format", ['nifti', 'hdf5'])
+@pytest.mark.parametrize("mem_budget_gb", [None, 1e-6, 1e-8])
+def test_censor_volumes(tmp_path, monkeypatch, betaseries_file, brainmask_file,
+                        beta_series_format, mem_budget_gb):
+    if beta_series_format == 'hdf5':
+        pytest.importorskip('h5py')
+    monkeypatch.chdir(str(tmp_path))
 
     # make an outlier volume
     outlier_idx = 6
@@ -16,19 +23,61 @@ def test_censor_volumes(tmp_path, betaseries_file, brainmask_file):
     beta_data = beta_img.get_fdata()
     beta_data[..., outlier_idx] += 1000
 
-    beta_img.__class__(
-        beta_data, beta_img.affine, beta_img.header).to_filename(str(outlier_file))
+    mask_img = nib.load(str(brainmask_file))
+    mask = mask_img.get_fdata().astype(bool)
+    beta_series = _BetaSeriesWriter(mask_img, {'outlier': beta_data.shape[-1]},
+                                    str(tmp_path / 'desc-{trial_type}_betaseries'),
+                                    file_format=beta_series_format)
+    for trial_idx in range(beta_data.shape[-1]):
+        beta_series.add('outlier', trial_idx, beta_data[..., trial_idx][mask])
+    outlier_file, = beta_series.save()
 
     censor_volumes = CensorVolumes(timeseries_file=str(outlier_file),
-                                   mask_file=str(brainmask_file))
+                                   mask_file=str(brainmask_file),
+                                   mem_budget_gb=mem_budget_gb)
 
     res = censor_volumes.run()
 
     assert nib.load(res.outputs.censored_file).shape[-1] == beta_img.shape[-1] - 1
+    np.testing.assert_array_equal(nib.load(res.outputs.censored_file).get_fdata(),
+                                  np.delete(beta_data, outlier_idx, axis=-1))
     assert res.outputs.outliers[outlier_idx]
+    # the memory mapped volumes are not left in the working directory
+    assert not list(tmp_path.glob('*.npy'))
 
 
-def test_atlas_connectivity(betaseries_file, atlas_file, atlas_lut):
+def test_is_outlier():
+    np.random.seed(3)
+    points = np.random.rand(20, 7)
+    points[6] += 10
+
+    outliers = is_outlier(points)
+    assert np.flatnonzero(outliers).tolist() == [6]
+    # the same outliers from blocks of dimensions
+    np.testing.assert_array_equal(is_outlier(points, block_size=2), outliers)
+
+
+def test_censor_volumes_parcels(tmp_path, brainmask_file):
+    # make an outlier trial
+    outlier_idx = 6
+    np.random.seed(3)
+    parcel_series = pd.DataFrame(np.random.rand(20, 3), columns=[1, 2, 3])
+    parcel_series.iloc[outlier_idx] += 1000
+    parcel_file = str(tmp_path / 'desc-outlier_betaseries.tsv')
+    parcel_series.to_csv(parcel_file, sep='\t', index=False)
+
+    res = CensorVolumes(timeseries_file=parcel_file, mask_file=str(brainmask_file)).run()
+
+    censored_series = pd.read_csv(res.outputs.censored_file, sep='\t')
+    assert res.outputs.censored_file.endswith('_censored.tsv')
+    assert res.outputs.outliers[outlier_idx]
+    np.testing.assert_allclose(censored_series.values,
+                               parcel_series.drop(outlier_idx).values)
+
+
+@pytest.mark.parametrize("parcels", [False, True])
+def test_atlas_connectivity(tmp_path, betaseries_file, atlas_file, atlas_lut, parcels,
+                            monkeypatch):
     # read in test files
     bs_data = nib.load(str(betaseries_file)).get_data()
     atlas_lut_df = pd.read_csv(str(atlas_lut), sep='\t')
@@ -40,8 +89,16 @@ def test_atlas_connectivity(betaseries_file, atlas_file, atlas_lut):
     pcorr_df = pd.DataFrame(pcorr, index=regions, columns=regions)
     expected_zcorr_df = pcorr_df.apply(lambda x: (np.log(1 + x) - np.log(1 - x)) * 0.5)
 
-    # run instance of AtlasConnectivity
-    ac = AtlasConnectivity(timeseries_file=str(betaseries_file),
+    timeseries_file = str(betaseries_file)
+    if parcels:
+        # the beta series of the (one voxel) parcels
+        timeseries_file = str(tmp_path / 'desc-test_betaseries.tsv')
+        pd.DataFrame(bs_data.squeeze().T, columns=[1, 2]).to_csv(
+            timeseries_file, sep='\t', index=False)
+
+    # run instance of AtlasConnectivity (writing its outputs in tmp_path)
+    monkeypatch.chdir(str(tmp_path))
+    ac = AtlasConnectivity(timeseries_file=timeseries_file,
                            atlas_file=str(atlas_file),
                            atlas_lut=str(atlas_lut))
 
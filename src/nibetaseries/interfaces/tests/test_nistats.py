@@ -1,5 +1,6 @@
 ''' Testing module for nibetaseries.interfaces.nistats '''
 import os
+import glob
 import json
 import re
 
@@ -10,10 +11,82 @@ from nistats import first_level_model
 import pytest
 
 
-from ..nistats import (LSSBetaSeries, LSABetaSeries,
+from ..nistats import (LSSBetaSeries, LSABetaSeries, LSSBetaSeriesRuns, LSABetaSeriesRuns,
+                       load_beta_series,
                        _lss_events_iterator, _lsa_events_converter,
                        _select_confounds,
-                       _calc_beta_map)
+                       _basis_columns, _ResidualSum,
+                       _LSSDesignBuilder, _whitened_inverse, _save_nifti,
+                       _block_gzip, _cached_bold, _load_bold, _iter_volumes,
+                       _select_trial_types, _run_glm, _run_projected_glm, _ar1_labels,
+                       _NuisanceProjection)
+
+
+def _nistats_beta_map(model, trial_type, hrf_model, tstat):
+    """The estimates of a trial from the contrasts of a fit nistats model
+
+    The contrasts of the hrf basis functions are combined into their norm
+    (with the sign of the main regressor), like the beta series.
+    """
+    import numpy as np
+
+    contrasts = {
+        output_type: np.array([
+            model.compute_contrast(col, output_type=output_type).get_fdata()
+            for col in _basis_columns(trial_type, hrf_model)])
+        for output_type in ('effect_size', 'effect_variance')
+    }
+    sign = np.where(contrasts['effect_size'][0] < 0, -1, 1)
+    beta_map = sign * np.sqrt((contrasts['effect_size'] ** 2).sum(axis=0))
+    if tstat:
+        beta_map /= np.sqrt(np.maximum(
+            np.sqrt((contrasts['effect_variance'] ** 2).sum(axis=0)), 1e-50))
+    return beta_map
+
+
+@pytest.fixture
+def run_beta_series(sub_metadata, preproc_file, sub_events, confounds_file, brainmask_file,
+                    tmp_path, monkeypatch):
+    """Run a beta series interface on the test run in a temporary working directory
+
+    The inputs of the test model are updated with the keyword arguments,
+    and the outputs of the interface are returned.
+    """
+    with open(str(sub_metadata), 'r') as md:
+        bold_metadata = json.load(md)
+    monkeypatch.chdir(str(tmp_path))
+
+    def run(interface, **inputs):
+        model_inputs = dict(bold_file=str(preproc_file),
+                            bold_metadata=bold_metadata,
+                            mask_file=str(brainmask_file),
+                            events_file=str(sub_events),
+                            confounds_file=str(confounds_file),
+                            selected_confounds=['white_matter', 'csf'],
+                            signal_scaling=0,
+                            hrf_model='glover',
+                            smoothing_kernel=None,
+                            high_pass=0.008,
+                            return_residuals=True)
+        model_inputs.update(inputs)
+        return interface(**model_inputs).run().outputs
+
+    return run
+
+
+def _read_outputs(outputs):
+    """Read the beta series (and the residuals) of a run by file name without extension
+
+    (the outputs of the next run in the same working directory replace them)
+    """
+    from nipype.interfaces.base import isdefined
+    from nipype.utils.filemanip import ensure_list
+
+    out_files = ensure_list(outputs.beta_maps)
+    if isdefined(outputs.residual):
+        out_files.append(outputs.residual)
+    return {os.path.basename(out_file).split('.')[0]: load_beta_series(out_file).get_fdata()
+            for out_file in out_files}
 
 
 @pytest.mark.parametrize(
@@ -50,7 +123,8 @@ def test_lss_beta_series(sub_metadata, preproc_file, sub_events,
                                 hrf_model=hrf_model,
                                 return_tstat=return_tstat,
                                 smoothing_kernel=None,
-                                high_pass=0.008)
+                                high_pass=0.008,
+                                return_residuals=True)
     res = beta_series.run()
 
     events_df = pd.read_csv(str(sub_events), sep='\t')
@@ -78,6 +152,91 @@ def test_lss_beta_series(sub_metadata, preproc_file, sub_events,
     os.remove(res.outputs.residual)
 
 
+@pytest.mark.parametrize(
+    "hrf_model,fir_delays,return_tstat,smoothing_kernel,noise_model",
+    [
+        ('spm', None, False, 4.0, 'ar1'),
+        ('glover + derivative', None, True, None, 'ar1'),
+        ('glover + derivative + dispersion', None, False, None, 'ar1'),
+        ('fir', [0, 1, 2], True, 4.0, 'ar1'),
+        ('glover + derivative', None, True, 4.0, 'ols'),
+    ]
+)
+def test_lss_beta_series_matches_nistats(sub_metadata, preproc_file, sub_events,
+                                         confounds_file, brainmask_file,
+                                         hrf_model, fir_delays, return_tstat,
+                                         smoothing_kernel, noise_model):
+    """Test the lss betas match fitting a nistats model for each trial
+    """
+    import numpy as np
+
+    selected_confounds = ['white_matter', 'csf']
+    with open(str(sub_metadata), 'r') as md:
+        bold_metadata = json.load(md)
+
+    beta_series = LSSBetaSeries(bold_file=str(preproc_file),
+                                bold_metadata=bold_metadata,
+                                mask_file=str(brainmask_file),
+                                events_file=str(sub_events),
+                                confounds_file=str(confounds_file),
+                                selected_confounds=selected_confounds,
+                                signal_scaling=0,
+                                hrf_model=hrf_model,
+                                fir_delays=fir_delays,
+                                return_tstat=return_tstat,
+                                noise_model=noise_model,
+                                smoothing_kernel=smoothing_kernel,
+                                high_pass=0.008,
+                                return_residuals=True)
+    res = beta_series.run()
+
+    confounds = _select_confounds(str(confounds_file), selected_confounds)
+    events = pd.read_csv(str(sub_events), sep='\t')
+    expected = {}
+    residuals = []
+    for trial_labels, trial_type, _ in _lss_events_iterator(str(sub_events)):
+        # (a new model for every trial, a refit model keeps its first residuals)
+        model = first_level_model.FirstLevelModel(
+            t_r=bold_metadata['RepetitionTime'],
+            slice_time_ref=0,
+            hrf_model=hrf_model,
+            fir_delays=fir_delays,
+            mask_img=str(brainmask_file),
+            smoothing_fwhm=smoothing_kernel,
+            signal_scaling=0,
+            noise_model=noise_model,
+            high_pass=0.008,
+            drift_model='cosine',
+            minimize_memory=False,
+        )
+        model.fit(str(preproc_file), events=events.assign(trial_type=trial_labels),
+                  confounds=confounds)
+        residuals.append(model.residuals[0].get_fdata())
+        if fir_delays:
+            estimates = [(trial_type + 'Delay{}Vol'.format(delay),
+                          trial_type + '_delay_{}'.format(delay))
+                         for delay in fir_delays]
+        else:
+            estimates = [(trial_type, trial_type)]
+        for new_ttype, column in estimates:
+            expected.setdefault(new_ttype, []).append(
+                _nistats_beta_map(model, column, hrf_model, return_tstat))
+
+    assert len(expected) == len(res.outputs.beta_maps)
+    for beta_map in res.outputs.beta_maps:
+        trial_type = re.search(r'desc-([A-Za-z0-9]+)_', beta_map).groups()[0]
+        np.testing.assert_allclose(load_img(beta_map).get_fdata(),
+                                   np.stack(expected[trial_type], axis=-1),
+                                   rtol=1e-6, atol=1e-10)
+        os.remove(beta_map)
+
+    # the residual is the average over the models of all trials
+    assert len(residuals) == len(events)
+    np.testing.assert_allclose(load_img(res.outputs.residual).get_fdata(),
+                               np.mean(residuals, axis=0), rtol=1e-6, atol=1e-8)
+    os.remove(res.outputs.residual)
+
+
 @pytest.mark.parametrize("use_nibabel", [(True), (False)])
 def test_fs_beta_series(sub_metadata, preproc_file, sub_events,
                         confounds_file, brainmask_file, use_nibabel):
@@ -105,7 +264,8 @@ def test_fs_beta_series(sub_metadata, preproc_file, sub_events,
                                 fir_delays=fir_delays,
                                 return_tstat=False,
                                 smoothing_kernel=None,
-                                high_pass=0.008)
+                                high_pass=0.008,
+                                return_residuals=True)
     res = beta_series.run()
 
     events_df = pd.read_csv(str(sub_events), sep='\t')
@@ -166,7 +326,8 @@ def test_lsa_beta_series(sub_metadata, preproc_file, sub_events,
                                 hrf_model=hrf_model,
                                 return_tstat=return_tstat,
                                 smoothing_kernel=None,
-                                high_pass=0.008)
+                                high_pass=0.008,
+                                return_residuals=True)
     res = beta_series.run()
 
     events_df = pd.read_csv(str(sub_events), sep='\t')
@@ -194,16 +355,720 @@ def test_lsa_beta_series(sub_metadata, preproc_file, sub_events,
     os.remove(res.outputs.residual)
 
 
+@pytest.mark.parametrize(
+    "hrf_model,return_tstat,noise_model",
+    [
+        ('glover', True, 'ar1'),
+        ('spm + derivative', False, 'ar1'),
+        ('glover + derivative + dispersion', True, 'ar1'),
+        ('spm + derivative', True, 'ols'),
+    ]
+)
+def test_lsa_beta_series_matches_nistats(sub_metadata, preproc_file, sub_events,
+                                         confounds_file, brainmask_file,
+                                         hrf_model, return_tstat, noise_model):
+    """Test the lsa betas match the contrasts of a nistats model
+    """
+    import numpy as np
+
+    selected_confounds = ['white_matter', 'csf']
+    with open(str(sub_metadata), 'r') as md:
+        bold_metadata = json.load(md)
+
+    beta_series = LSABetaSeries(bold_file=str(preproc_file),
+                                bold_metadata=bold_metadata,
+                                mask_file=str(brainmask_file),
+                                events_file=str(sub_events),
+                                confounds_file=str(confounds_file),
+                                selected_confounds=selected_confounds,
+                                signal_scaling=0,
+                                hrf_model=hrf_model,
+                                return_tstat=return_tstat,
+                                noise_model=noise_model,
+                                smoothing_kernel=None,
+                                high_pass=0.008,
+                                return_residuals=True)
+    res = beta_series.run()
+
+    model = first_level_model.FirstLevelModel(
+        t_r=bold_metadata['RepetitionTime'],
+        slice_time_ref=0,
+        hrf_model=hrf_model,
+        mask_img=str(brainmask_file),
+        signal_scaling=0,
+        noise_model=noise_model,
+        high_pass=0.008,
+        drift_model='cosine',
+        minimize_memory=False,
+    )
+    lsa_df = _lsa_events_converter(str(sub_events))
+    model.fit(str(preproc_file), events=lsa_df,
+              confounds=_select_confounds(str(confounds_file), selected_confounds))
+    expected = {}
+    for t_name, t_type in zip(lsa_df['trial_type'], lsa_df['original_trial_type']):
+        expected.setdefault(t_type, []).append(
+            _nistats_beta_map(model, t_name, hrf_model, return_tstat))
+
+    assert len(expected) == len(res.outputs.beta_maps)
+    for beta_map in res.outputs.beta_maps:
+        trial_type = re.search(r'desc-([A-Za-z0-9]+)_', beta_map).groups()[0]
+        np.testing.assert_allclose(load_img(beta_map).get_fdata(),
+                                   np.stack(expected[trial_type], axis=-1),
+                                   rtol=1e-6, atol=1e-10)
+        os.remove(beta_map)
+
+    np.testing.assert_allclose(load_img(res.outputs.residual).get_fdata(),
+                               model.residuals[0].get_fdata(), rtol=1e-6, atol=1e-8)
+    os.remove(res.outputs.residual)
+
+
+# a budget so small that one voxel (and two volumes) are processed at once
+_BUDGET_INPUTS = {'hrf_model': 'spm + derivative', 'return_tstat': True, 'smoothing_kernel': 4.0}
+
+
+@pytest.mark.parametrize(
+    "interface,option,values,inputs,rtol,atol",
+    [
+        # the trial models fit by a pool of workers
+        (LSSBetaSeries, 'n_jobs', (1, 2),
+         {'hrf_model': 'spm', 'return_tstat': True, 'residual_precision': 'float64'}, 1e-7, 0),
+        # (with the residual sums of the workers memory mapped)
+        (LSSBetaSeries, 'n_jobs', (1, 2),
+         {'hrf_model': 'spm', 'residual_precision': 'float64', 'mem_budget_gb': 1e-7},
+         1e-7, 0),
+        # blocks of voxels fit in a memory budget
+        (LSSBetaSeries, 'mem_budget_gb', (None, 1e-7), _BUDGET_INPUTS, 1e-10, 1e-10),
+        (LSABetaSeries, 'mem_budget_gb', (None, 1e-7), _BUDGET_INPUTS, 1e-10, 1e-10),
+        # (with the data whitened once for every trial model)
+        (LSSBetaSeries, 'mem_budget_gb', (None, 1e-7),
+         dict(_BUDGET_INPUTS, ar1_estimate='condition'), 1e-10, 1e-10),
+        (LSSBetaSeries, 'mem_budget_gb', (None, 1e-7),
+         dict(_BUDGET_INPUTS, noise_model='ols'), 1e-10, 1e-10),
+        # the confounds and drifts projected out of the data once
+        (LSSBetaSeries, 'project_nuisance', (False, True),
+         {'hrf_model': 'glover + derivative', 'return_tstat': True}, 1e-8, 1e-10),
+        (LSSBetaSeries, 'project_nuisance', (False, True),
+         {'hrf_model': 'fir', 'fir_delays': [0, 1, 2], 'return_tstat': True}, 1e-8, 1e-10),
+    ]
+)
+def test_beta_series_unchanged(run_beta_series, interface, option, values, inputs,
+                               rtol, atol):
+    """Test the beta series (and residuals) do not depend on a performance option
+    """
+    import numpy as np
+
+    outputs = []
+    for value in values:
+        outputs.append(_read_outputs(run_beta_series(interface, **{option: value}, **inputs)))
+        # neither the bold data, the beta series, nor the residuals are left memory mapped
+        assert not glob.glob('desc-*.npy')
+
+    expected, actual = outputs
+    assert list(actual) == list(expected)
+    for key in expected:
+        np.testing.assert_allclose(actual[key], expected[key], rtol=rtol, atol=atol)
+
+
+@pytest.mark.parametrize(
+    "inputs,projected",
+    [
+        ({}, False),
+        ({'project_nuisance': True}, True),
+        ({'noise_model': 'ols'}, True),
+        ({'ar1_estimate': 'condition'}, True),
+    ]
+)
+def test_lss_beta_series_nuisance_projection(run_beta_series, monkeypatch, inputs, projected):
+    """Test the projected copy of the bold data is only made where it is used
+    """
+    from .. import nistats
+
+    projections = []
+
+    class _RecordedProjection(_NuisanceProjection):
+        def __init__(self, *args, **kwargs):
+            projections.append(self)
+            super(_RecordedProjection, self).__init__(*args, **kwargs)
+
+    monkeypatch.setattr(nistats, '_NuisanceProjection', _RecordedProjection)
+    run_beta_series(LSSBetaSeries, hrf_model='spm', return_residuals=False, **inputs)
+
+    assert bool(projections) == projected
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_precision(run_beta_series, preproc_file, interface):
+    """Test the float32 beta series are within float32 tolerance of the float64 ones
+
+    float32 keeps about 7 significant digits of the bold data, so the estimates
+    (and residuals) are expected to agree up to 1e-5 times the largest bold value.
+    """
+    import numpy as np
+
+    tolerance = 1e-5 * np.abs(load_img(str(preproc_file)).get_fdata()).max()
+
+    outputs = []
+    for precision in ('float64', 'float32'):
+        res = run_beta_series(interface, signal_scaling=False, hrf_model='spm + derivative',
+                              precision=precision)
+        for out_file in res.beta_maps + [res.residual]:
+            assert load_img(out_file).get_data_dtype() == np.dtype(precision)
+        outputs.append(_read_outputs(res))
+
+    double, single = outputs
+    assert list(double) == list(single)
+    for key in double:
+        np.testing.assert_allclose(single[key], double[key], rtol=1e-4, atol=tolerance)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_hdf5(run_beta_series, brainmask_file, interface):
+    """Test the hdf5 beta series hold the same trials as the nifti beta series
+    """
+    import numpy as np
+    h5py = pytest.importorskip('h5py')
+
+    nifti_files = run_beta_series(interface, return_residuals=False).beta_maps
+    hdf5_files = run_beta_series(interface, return_residuals=False,
+                                 beta_series_format='hdf5').beta_maps
+
+    mask = load_img(str(brainmask_file)).get_fdata().astype(bool)
+    assert [os.path.splitext(f)[0] + '.nii.gz' for f in hdf5_files] == nifti_files
+    for nifti_file, hdf5_file in zip(nifti_files, hdf5_files):
+        nifti_img = load_img(nifti_file)
+        with h5py.File(hdf5_file, 'r') as series:
+            # one trial of the masked voxels at a time
+            for trial_idx in range(nifti_img.shape[-1]):
+                np.testing.assert_array_equal(
+                    series['betaseries'][trial_idx],
+                    nifti_img.get_fdata()[..., trial_idx][mask])
+            np.testing.assert_array_equal(series['affine'][()], nifti_img.affine)
+        hdf5_img = load_beta_series(hdf5_file)
+        np.testing.assert_array_equal(hdf5_img.get_fdata(), nifti_img.get_fdata())
+        np.testing.assert_array_equal(hdf5_img.affine, nifti_img.affine)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_masked(run_beta_series, interface):
+    """Test the masked beta series hold the masked voxels of each beta series
+    """
+    import numpy as np
+
+    res = run_beta_series(interface, return_residuals=False, return_masked_betaseries=True)
+
+    mask = load_img(res.mask_file).get_fdata().astype(bool)
+    assert len(res.masked_beta_maps) == len(res.beta_maps)
+    for nifti_file, masked_file in zip(res.beta_maps, res.masked_beta_maps):
+        nifti_data = load_img(nifti_file).get_fdata()
+        masked_series = np.load(masked_file, mmap_mode='r')
+        assert masked_series.dtype == np.float32
+        assert masked_series.shape == (nifti_data.shape[-1], mask.sum())
+        for trial_idx in range(nifti_data.shape[-1]):
+            np.testing.assert_allclose(masked_series[trial_idx],
+                                       nifti_data[..., trial_idx][mask],
+                                       rtol=1e-6)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_uncompressed(run_beta_series, interface):
+    """Test the beta series and residuals are saved as .nii files without compression
+    """
+    import numpy as np
+
+    outputs = []
+    for compression_level in (1, 0):
+        res = run_beta_series(interface, compression_level=compression_level,
+                              compression_threads=2)
+        outputs.append(res.beta_maps + [res.residual])
+
+    assert [f[:-len('.gz')] for f in outputs[0]] == outputs[1]
+    for compressed_file, uncompressed_file in zip(*outputs):
+        np.testing.assert_array_equal(load_img(uncompressed_file).get_fdata(),
+                                      load_img(compressed_file).get_fdata())
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_bold_cache(run_beta_series, interface, tmp_path):
+    """Test the beta series from the cached bold run match the beta series from the bold run
+    """
+    import numpy as np
+
+    bold_cache_dir = str(tmp_path / 'boldcache')
+    outputs = [_read_outputs(run_beta_series(interface, return_residuals=False,
+                                             bold_cache_dir=cache_dir))
+               for cache_dir in (None, bold_cache_dir)]
+
+    assert len(os.listdir(bold_cache_dir)) == 1
+    assert outputs[0].keys() == outputs[1].keys()
+    for beta_map, beta_data in outputs[0].items():
+        np.testing.assert_array_equal(outputs[1][beta_map], beta_data)
+
+
+@pytest.mark.parametrize(
+    "interface,inputs",
+    [
+        (LSSBetaSeries, {}),
+        (LSSBetaSeries, {'ar1_estimate': 'condition'}),
+        (LSABetaSeries, {}),
+    ]
+)
+def test_beta_series_design_cache(run_beta_series, interface, inputs, tmp_path):
+    """Test the beta series from the cached design factorizations match the beta series
+    from the factorized designs, and a run with the same designs reuses the cache
+    """
+    import numpy as np
+
+    design_cache_dir = str(tmp_path / 'designcache')
+    outputs = []
+    cached_files = []
+    for cache_dir in (None, design_cache_dir, design_cache_dir):
+        outputs.append(_read_outputs(run_beta_series(interface, return_residuals=False,
+                                                     design_cache_dir=cache_dir, **inputs)))
+        if cache_dir is not None:
+            cached_files.append(sorted(os.listdir(cache_dir)))
+
+    # the second run loads every factorization saved by the first run
+    assert cached_files[0]
+    assert cached_files[1] == cached_files[0]
+    for beta_maps in outputs[1:]:
+        assert beta_maps.keys() == outputs[0].keys()
+        for beta_map, beta_data in outputs[0].items():
+            np.testing.assert_array_equal(beta_maps[beta_map], beta_data)
+
+
+@pytest.mark.parametrize(
+    "runs_interface,interface",
+    [
+        (LSSBetaSeriesRuns, LSSBetaSeries),
+        (LSABetaSeriesRuns, LSABetaSeries),
+    ]
+)
+def test_beta_series_runs(run_beta_series, sub_metadata, preproc_file, sub_events,
+                          confounds_file, brainmask_file, runs_interface, interface, tmp_path):
+    """Test the runs fit in a single node match the runs fit one by one
+    """
+    import numpy as np
+    import pandas as pd
+
+    with open(str(sub_metadata), 'r') as md:
+        bold_metadata = json.load(md)
+
+    # a second run with shifted events
+    events_df = pd.read_csv(str(sub_events), sep='\t')
+    events_df['onset'] += 2.
+    shifted_events = str(tmp_path / 'shifted_events.tsv')
+    events_df.to_csv(shifted_events, sep='\t', index=False)
+    events_files = [str(sub_events), shifted_events]
+
+    runs_res = runs_interface(bold_file=[str(preproc_file)] * 2,
+                              bold_metadata=[bold_metadata] * 2,
+                              mask_file=[str(brainmask_file)] * 2,
+                              events_file=events_files,
+                              confounds_file=[str(confounds_file)] * 2,
+                              selected_confounds=['white_matter', 'csf'],
+                              signal_scaling=0,
+                              hrf_model='glover',
+                              smoothing_kernel=None,
+                              high_pass=0.008,
+                              return_residuals=True).run()
+    assert len(runs_res.outputs.beta_maps) == len(runs_res.outputs.residual) == 2
+
+    for events_file, beta_maps, residual in zip(events_files, runs_res.outputs.beta_maps,
+                                                runs_res.outputs.residual):
+        run_outputs = run_beta_series(interface, events_file=events_file)
+        expected = _read_outputs(run_outputs)
+        assert list(expected) == [os.path.basename(f).split('.')[0]
+                                  for f in beta_maps + [residual]]
+        for beta_map in beta_maps + [residual]:
+            np.testing.assert_allclose(load_img(beta_map).get_fdata(),
+                                       expected[os.path.basename(beta_map).split('.')[0]],
+                                       rtol=1e-8, atol=1e-12)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_parcels(run_beta_series, atlas_file, interface):
+    """Test the parcel beta series match the beta series of the (one voxel) parcels
+    """
+    import numpy as np
+    from nipype.interfaces.base import isdefined
+
+    voxels = _read_outputs(run_beta_series(interface))
+    parcels = run_beta_series(interface, return_masked_betaseries=True,
+                              atlas_file=str(atlas_file))
+
+    assert list(voxels) == [os.path.basename(f)[:-len('.tsv')]
+                            for f in parcels.beta_maps + [parcels.residual]]
+    for parcel_file, masked_file in zip(parcels.beta_maps, parcels.masked_beta_maps):
+        parcel_series = pd.read_csv(parcel_file, sep='\t')
+        # every voxel of the test atlas is a parcel
+        assert parcel_series.columns.tolist() == ['1', '2']
+        np.testing.assert_allclose(
+            parcel_series.values,
+            voxels[os.path.basename(parcel_file)[:-len('.tsv')]][0, 0].T)
+        np.testing.assert_allclose(np.load(masked_file), parcel_series.values, rtol=1e-6)
+    np.testing.assert_allclose(pd.read_csv(parcels.residual, sep='\t').values,
+                               voxels['desc-residuals_bold'][0, 0].T)
+    assert not isdefined(parcels.mask_file)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_atlas_support(run_beta_series, interface, tmp_path):
+    """Test only the voxels with an atlas label are modeled, with the same estimates
+    """
+    import numpy as np
+
+    # an atlas labeling the second voxel of the brain mask
+    atlas_file = str(tmp_path / 'atlas.nii.gz')
+    nib.Nifti1Image(np.array([[[0, 2]]], dtype=np.int16), np.eye(4)).to_filename(atlas_file)
+
+    outputs = [_read_outputs(run_beta_series(interface, return_residuals=False,
+                                             atlas_support_file=atlas_support_file))
+               for atlas_support_file in (None, atlas_file)]
+
+    assert outputs[0].keys() == outputs[1].keys()
+    for beta_map, beta_data in outputs[0].items():
+        np.testing.assert_array_equal(outputs[1][beta_map][0, 0, 0], 0)
+        # (up to the rounding errors of multiplying matrices of another size)
+        np.testing.assert_allclose(outputs[1][beta_map][0, 0, 1], beta_data[0, 0, 1],
+                                   rtol=1e-8)
+
+
+@pytest.mark.parametrize("interface", [LSSBetaSeries, LSABetaSeries])
+def test_beta_series_without_residuals(run_beta_series, interface):
+    """Test no residual image is made unless requested
+    """
+    from nipype.interfaces.base import isdefined
+
+    # (residuals are not requested by default)
+    assert not interface.input_spec().return_residuals
+    res = run_beta_series(interface, hrf_model='spm', return_residuals=False)
+
+    assert not isdefined(res.residual)
+    assert not os.path.isfile('desc-residuals_bold.nii.gz')
+
+
+def test_lss_beta_series_trial_types(run_beta_series, sub_metadata, preproc_file, sub_events,
+                                     confounds_file, brainmask_file):
+    """Test only the selected trial types are fit (with the same models)
+    """
+    import numpy as np
+
+    outputs = [_read_outputs(run_beta_series(LSSBetaSeries, hrf_model='spm',
+                                             trial_types=trial_types))
+               for trial_types in (None, ['waff.*'])]
+
+    # the other trial types stay in the model as conditions
+    # (up to the rounding errors of updating the inverses from other trial models)
+    assert list(outputs[1]) == ['desc-waffle_betaseries', 'desc-residuals_bold']
+    np.testing.assert_allclose(outputs[1]['desc-waffle_betaseries'],
+                               outputs[0]['desc-waffle_betaseries'], rtol=1e-8)
+
+    # the residual is the average over the models of the selected trials
+    with open(str(sub_metadata), 'r') as md:
+        bold_metadata = json.load(md)
+    confounds = _select_confounds(str(confounds_file), ['white_matter', 'csf'])
+    events = pd.read_csv(str(sub_events), sep='\t')
+    residuals = []
+    for trial_labels, trial_type, _ in _lss_events_iterator(str(sub_events)):
+        if trial_type != 'waffle':
+            continue
+        model = first_level_model.FirstLevelModel(
+            t_r=bold_metadata['RepetitionTime'],
+            slice_time_ref=0,
+            hrf_model='spm',
+            mask_img=str(brainmask_file),
+            signal_scaling=0,
+            high_pass=0.008,
+            drift_model='cosine',
+            minimize_memory=False,
+        )
+        model.fit(str(preproc_file), events=events.assign(trial_type=trial_labels),
+                  confounds=confounds)
+        residuals.append(model.residuals[0].get_fdata())
+    assert len(residuals) == (events['trial_type'] == 'waffle').sum()
+    np.testing.assert_allclose(outputs[1]['desc-residuals_bold'],
+                               np.mean(residuals, axis=0), rtol=1e-6, atol=1e-8)
+
+
+@pytest.mark.parametrize(
+    "interface,mem_budget_gb",
+    [
+        (LSSBetaSeries, None),
+        (LSSBetaSeries, 1e-7),
+        (LSABetaSeries, 1e-7),
+    ]
+)
+def test_beta_series_censor_outliers(run_beta_series, confounds_file, tmp_path,
+                                     interface, mem_budget_gb):
+    """Test dropping the outlier scans gives the same models as spike regressors
+    """
+    import numpy as np
+
+    # outliers at the start (in the fixture) and in the middle of the run
+    confounds = pd.read_csv(str(confounds_file), sep='\t')
+    for scan in (50, 51, 120):
+        confounds['motion_outlier{}'.format(scan)] = (np.arange(len(confounds)) == scan) * 1.
+    outlier_confounds_file = str(tmp_path / 'confounds.tsv')
+    confounds.to_csv(outlier_confounds_file, sep='\t', index=False, na_rep='n/a')
+
+    outputs = []
+    for censor_outliers in (False, True):
+        res = run_beta_series(interface,
+                              confounds_file=outlier_confounds_file,
+                              selected_confounds=['white_matter', 'csf', 'motion_outlier.*'],
+                              hrf_model='glover + derivative',
+                              return_tstat=True,
+                              censor_outliers=censor_outliers,
+                              mem_budget_gb=mem_budget_gb)
+        outputs.append(_read_outputs(res))
+        assert not glob.glob('desc-*.npy')
+
+    for design_matrix in (res.design_matrices.values() if interface is LSSBetaSeries
+                          else res.design_matrices):
+        assert len(design_matrix) == len(confounds) - 8
+        assert not design_matrix.columns.str.startswith('motion_outlier').any()
+
+    spikes, censored = outputs
+    # the dropped scans have no residuals
+    np.testing.assert_array_equal(
+        censored['desc-residuals_bold'][..., [0, 1, 2, 3, 4, 50, 51, 120]], 0)
+    del spikes['desc-residuals_bold'], censored['desc-residuals_bold']
+    assert list(spikes) == list(censored)
+    for key in spikes:
+        np.testing.assert_allclose(censored[key], spikes[key], rtol=1e-8, atol=1e-10)
+
+
+def test_select_trial_types():
+    import numpy as np
+
+    trial_types = np.array(['go', 'stop', 'go_correct', 'fixation'])
+
+    np.testing.assert_array_equal(_select_trial_types(trial_types),
+                                  [True, True, True, True])
+    np.testing.assert_array_equal(_select_trial_types(trial_types, ['go.*', 'stop']),
+                                  [True, True, True, False])
+    # the expressions match the whole trial type
+    np.testing.assert_array_equal(_select_trial_types(trial_types, ['go']),
+                                  [True, False, False, False])
+    with pytest.raises(ValueError) as val_err:
+        _select_trial_types(trial_types, ['rest'])
+    assert "None of the trial types ['rest'] match" in str(val_err.value)
+    # numeric trial types
+    np.testing.assert_array_equal(_select_trial_types(np.array([1, 2, 12]), ['1.*']),
+                                  [True, False, True])
+
+
+@pytest.mark.parametrize(
+    "hrf_model,fir_delays,trial_type_names",
+    [
+        ('glover', None, None),
+        ('spm + derivative + dispersion', None, None),
+        ('fir', [0, 1, 2], None),
+        # numeric trial types, and numbers mixed with strings
+        ('glover', None, {'waffle': 1, 'fry': 2, 'milkshake': 3}),
+        ('glover', None, {'waffle': 1}),
+    ]
+)
+def test_lss_design_builder(preproc_file, sub_metadata, sub_events, confounds_file, tmp_path,
+                            hrf_model, fir_delays, trial_type_names):
+    """Test the cached trial regressors make the same designs as nistats
+    """
+    import numpy as np
+    from nistats.design_matrix import make_first_level_design_matrix
+
+    with open(str(sub_metadata), 'r') as md:
+        t_r = json.load(md)['RepetitionTime']
+    n_scans = load_img(str(preproc_file)).shape[-1]
+    frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
+    confounds = _select_confounds(str(confounds_file), ['white_matter', 'csf'])
+
+    events_file = str(sub_events)
+    events = pd.read_csv(events_file, sep='\t')
+    if trial_type_names is not None:
+        events['trial_type'] = [trial_type_names.get(trial_type, trial_type)
+                                for trial_type in events['trial_type']]
+        events_file = str(tmp_path / 'events.tsv')
+        events.to_csv(events_file, sep='\t', index=False)
+        # (only a column of numbers is read back as numbers)
+        if len(trial_type_names) == events['trial_type'].nunique():
+            events = pd.read_csv(events_file, sep='\t')
+            assert events['trial_type'].dtype.kind == 'i'
+    design = _LSSDesignBuilder(events, frame_times, hrf_model, 0.008,
+                               fir_delays=fir_delays, confounds=confounds)
+    cache = {}
+    n_updates = []
+    for trial_id, (trial_labels, trial_type, trial_counter) in enumerate(
+            _lss_events_iterator(events_file)):
+        # the builder labels the trials like the events iterator
+        assert design.trial_types[trial_id] == str(trial_type)
+        assert design.trial_counters[trial_id] == trial_counter
+        expected = make_first_level_design_matrix(
+            frame_times, pd.read_csv(events_file, sep='\t').assign(trial_type=trial_labels),
+            hrf_model=hrf_model,
+            drift_model='cosine',
+            high_pass=0.008, fir_delays=fir_delays, add_regs=confounds.values,
+            add_reg_names=confounds.columns.tolist())
+        design_matrix = design.design_matrix(trial_id)
+        assert expected.columns.tolist() == design_matrix.columns.tolist()
+        np.testing.assert_allclose(design_matrix.values, expected.values, atol=1e-12)
+
+        # the inverse is updated from the previous trial model
+        whitened_design, inverse = _whitened_inverse(design_matrix.values, 0.3, cache)
+        np.testing.assert_allclose(
+            inverse, np.linalg.inv(whitened_design.T.dot(whitened_design)),
+            rtol=1e-7, atol=1e-10)
+        n_updates.append(cache[0.3][2])
+
+    # the inverse was updated from the previous trial model
+    assert max(n_updates) > 0
+
+
+@pytest.mark.parametrize("censor", [False, True])
+def test_run_projected_glm(preproc_file, sub_metadata, sub_events, confounds_file, censor):
+    """Test fitting the projected data with shared AR(1) coefficients gives
+    the same models as fitting the full designs
+    """
+    import numpy as np
+
+    from ..nistats import _ResidualSum
+
+    with open(str(sub_metadata), 'r') as md:
+        t_r = json.load(md)['RepetitionTime']
+    n_scans = load_img(str(preproc_file)).shape[-1]
+    frame_times = np.linspace(0, (n_scans - 1) * t_r, n_scans)
+    confounds = _select_confounds(str(confounds_file), ['white_matter', 'csf'])
+    scans = (np.arange(n_scans) % 7 != 3) if censor else None
+
+    events = pd.read_csv(str(sub_events), sep='\t')
+    design = _LSSDesignBuilder(events, frame_times, 'glover + derivative', 0.008,
+                               confounds=confounds, scans=scans)
+    rng = np.random.RandomState(0)
+    n_rows = n_scans if scans is None else scans.sum()
+    data = np.cumsum(rng.standard_normal((n_rows, 30)), axis=0) * 0.1 + rng.standard_normal(30)
+
+    # the AR(1) coefficients estimated once from the condition model
+    labels = _ar1_labels(data, design.condition_design_matrix().values, scans=scans)
+    projection = _NuisanceProjection(design.nuisance, data, labels=labels, scans=scans,
+                                     block_size=7)
+    for trial_id in (0, 5):
+        design_matrix = design.design_matrix(trial_id)
+        columns = [design.trial_types[trial_id], design.trial_types[trial_id] + '_derivative']
+        expected_residuals = _ResidualSum('float64', data.shape)
+        expected = _run_glm(data, design_matrix, columns, residual_sum=expected_residuals,
+                            scans=scans, labels=labels)
+        residuals = _ResidualSum('float64', data.shape)
+        effects, variances = _run_projected_glm(projection, design_matrix, columns,
+                                                block_size=11, residual_sum=residuals,
+                                                data=data)
+        np.testing.assert_allclose(effects, expected[0], rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(variances, expected[1], rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(residuals.mean(1), expected_residuals.mean(1),
+                                   rtol=1e-8, atol=1e-10)
+
+
+@pytest.mark.parametrize("compression_level,n_threads", [(1, 1), (9, 4)])
+def test_save_nifti(preproc_file, tmp_path, compression_level, n_threads):
+    import gzip
+    import numpy as np
+
+    bold_img = nib.load(str(preproc_file))
+    nifti_file = _save_nifti(bold_img, str(tmp_path / 'bold.nii.gz'),
+                             compression_level, n_threads)
+
+    assert not glob.glob(str(tmp_path / '*.nii'))
+    np.testing.assert_array_equal(nib.load(nifti_file).get_fdata(), bold_img.get_fdata())
+
+    # blocks smaller than the file are gzip members decompressed back to back
+    raw_file = str(tmp_path / 'bold.nii')
+    nib.save(bold_img, raw_file)
+    _block_gzip(raw_file, str(tmp_path / 'blocks.nii.gz'), compression_level, n_threads,
+                block_size=4096)
+    with open(raw_file, 'rb') as raw, gzip.open(str(tmp_path / 'blocks.nii.gz')) as blocks:
+        assert blocks.read() == raw.read()
+
+
+def test_cached_bold(preproc_file, tmp_path):
+    import shutil
+    import numpy as np
+
+    bold_file = str(tmp_path / os.path.basename(str(preproc_file)))
+    shutil.copy(str(preproc_file), bold_file)
+    cache_dir = str(tmp_path / 'boldcache')
+
+    cached_file = _cached_bold(bold_file, cache_dir)
+    assert cached_file.endswith('.nii')
+    assert isinstance(nib.load(cached_file).dataobj.get_unscaled(), np.memmap)
+    np.testing.assert_array_equal(nib.load(cached_file).get_fdata(),
+                                  nib.load(bold_file).get_fdata())
+    # the run is decompressed once
+    assert _cached_bold(bold_file, cache_dir) == cached_file
+    assert os.listdir(cache_dir) == [os.path.basename(cached_file)]
+
+    # a modified run replaces its cached copy
+    os.utime(bold_file, ns=(0, 0))
+    modified_file = _cached_bold(bold_file, cache_dir)
+    assert modified_file != cached_file
+    assert os.listdir(cache_dir) == [os.path.basename(modified_file)]
+
+    # uncompressed runs are not cached
+    assert _cached_bold(cached_file, cache_dir) == cached_file
+
+
+@pytest.mark.parametrize("n_volumes", [1, 7, 1000])
+def test_iter_volumes(preproc_file, n_volumes):
+    import numpy as np
+
+    bold_img = _load_bold(str(preproc_file))
+    batches = list(_iter_volumes(bold_img, n_volumes))
+
+    assert [start for start, _ in batches] == list(range(0, bold_img.shape[3], n_volumes))
+    assert all(volumes.shape[-1] <= n_volumes for _, volumes in batches)
+    np.testing.assert_array_equal(np.concatenate([volumes for _, volumes in batches], axis=-1),
+                                  nib.load(str(preproc_file)).get_fdata())
+
+
+@pytest.mark.parametrize("precision,rtol", [('float32', 1e-3), ('float64', 1e-12)])
+@pytest.mark.parametrize("memmap", [False, True])
+def test_residual_sum(tmp_path, precision, rtol, memmap):
+    import pickle
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    chunks = [rng.randn(20, 10) * 1e3 for _ in range(6)]
+
+    partial = [
+        _ResidualSum(precision, (20, 10), block_size=3,
+                     memmap_file=str(tmp_path / 'sum{}.npy'.format(i)) if memmap else None)
+        for i in range(2)
+    ]
+    for i, chunk in enumerate(chunks):
+        partial[i % 2].add(chunk)
+    # (e.g., returned by a worker)
+    partial[1] = pickle.loads(pickle.dumps(partial[1]))
+    partial[0].merge(partial[1])
+
+    ave = partial[0].mean(len(chunks))
+    assert ave.dtype == np.dtype(precision)
+    assert isinstance(ave, np.memmap) == memmap
+    np.testing.assert_allclose(ave, np.mean(chunks, axis=0), rtol=rtol, atol=rtol)
+    # the merged sum is removed
+    assert not list(tmp_path.glob('sum1*'))
+    partial[0].remove()
+    assert not list(tmp_path.iterdir())
+
+
 def test_lss_events_iterator(sub_events):
     # all but the first instance of waffle
     # should be changed to "other"
     t_lst = ['other', 'fry', 'milkshake'] * 5
     t_lst[0] = 'waffle'
-    res = _lss_events_iterator(sub_events)
-    out_df = list(res)[0][0]
-    out_lst = list(out_df['trial_type'])
+    res = list(_lss_events_iterator(sub_events))
+    out_lst = list(res[0][0])
 
     assert t_lst == out_lst
+    # the nth trial of each type
+    assert [trial_counter for _, _, trial_counter in res] == [
+        x for x in range(5) for y in range(3)]
 
 
 def test_lsa_events_converter(sub_events):
@@ -297,40 +1162,3 @@ def test_select_confounds(confounds_file, selected_confounds, nan_confounds,
             vals = confounds_df[nan_c].values
             expected_result = np.nanmean(vals[vals != 0])
             assert res_df[nan_c][0] == expected_result
-
-
-@pytest.mark.parametrize(
-    "hrf_model,return_tstat",
-    [
-        ("glover", True),
-        ("glover + derivative", False),
-        ("glover + derivative + dispersion", True),
-    ],
-)
-def test_calc_beta_map(sub_metadata, preproc_file, sub_events,
-                       confounds_file, brainmask_file, hrf_model,
-                       return_tstat):
-
-    model = first_level_model.FirstLevelModel(
-            t_r=2,
-            slice_time_ref=0,
-            hrf_model=hrf_model,
-            mask_img=str(brainmask_file),
-            smoothing_fwhm=0,
-            signal_scaling=False,
-            high_pass=0.008,
-            drift_model='cosine',
-            verbose=1,
-            minimize_memory=False,
-        )
-
-    lsa_df = _lsa_events_converter(str(sub_events))
-
-    model.fit(str(preproc_file), events=lsa_df)
-
-    i_trial = lsa_df.index[0]
-    t_name = lsa_df.loc[i_trial, 'trial_type']
-
-    beta_map = _calc_beta_map(model, t_name, hrf_model, return_tstat)
-
-    assert beta_map.shape == nib.load(str(brainmask_file)).shape
@@ -18,7 +18,7 @@ from matplotlib import __version__ as matplotlib_ver
 from ..interfaces.nilearn import AtlasConnectivity
 
 
-def init_correlation_wf(name="correlation_wf"):
+def init_correlation_wf(name="correlation_wf", precision='float64'):
     """
     This workflow calculates betaseries correlations using a parcellation
     from an atlas.
@@ -35,6 +35,9 @@ def init_correlation_wf(name="correlation_wf"):
 
         name : str
             Name of workflow (default: ``correlation_wf``)
+        precision : str
+            floating point precision ('float64' or 'float32')
+            of the roi timeseries (default: ``float64``)
 
     Inputs
     ------
@@ -85,7 +88,7 @@ Matplotlib {matplotlib_ver} [@Hunter2007] and MNE-Python {mne_ver}
                                                         'correlation_fig']),
                           name='output_node')
 
-    atlas_corr_node = pe.MapNode(AtlasConnectivity(),
+    atlas_corr_node = pe.MapNode(AtlasConnectivity(precision=precision),
                                  name='atlas_corr_node',
                                  iterfield=['timeseries_file'])
 
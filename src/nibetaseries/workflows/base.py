@@ -30,11 +30,13 @@ from ..interfaces.nilearn import CensorVolumes
 
 
 def init_nibetaseries_participant_wf(
-    estimator, atlas_img, atlas_lut, bids_dir,
-    database_path, derivatives_pipeline_dir, exclude_description_label,
-    fir_delays, hrf_model, high_pass, norm_betas, output_dir, return_residuals,
-    run_label, selected_confounds, session_label, signal_scaling, smoothing_kernel,
-    space_label, subject_list, task_label, description_label, work_dir,
+    estimator, ar1_estimate, atlas_img, atlas_lut, batch_runs, beta_series_format, bids_dir,
+    cache_bold, cache_designs, censor_outliers, compression_level, database_path,
+    derivatives_pipeline_dir, estimation_space, exclude_description_label, fir_delays, hrf_model,
+    high_pass, mem_budget_gb, n_jobs, noise_model, norm_betas, output_dir, precision,
+    restrict_to_atlas, return_masked_betaseries, return_residuals, run_label, selected_confounds,
+    session_label, signal_scaling, smoothing_kernel,
+    space_label, subject_list, task_label, trial_types, description_label, work_dir,
         ):
 
     """
@@ -44,16 +46,41 @@ def init_nibetaseries_participant_wf(
     Parameters
     ----------
 
+        ar1_estimate : str
+            Estimate the AR(1) coefficients from each LSS trial model ('trial'),
+            or once from the model with one regressor per condition ('condition')
         atlas_img : str
             Path to input atlas nifti
         atlas_lut : str
             Path to input atlas lookup table (tsv)
+        batch_runs : bool
+            Fit all the bold runs of a subject one after the other in a single node
+            (sharing the design factorizations, and reading the next run while a run
+            is fit), instead of a node per run
+        beta_series_format : str
+            File format of the beta series ('nifti' or 'hdf5')
         bids_dir : str
             Root directory of BIDS dataset
+        cache_bold : bool
+            Decompress each gzipped bold run once into the ``boldcache`` directory
+            of ``work_dir``, the models then read the (memory mapped) cached run
+        cache_designs : bool
+            Cache the factorizations of the design matrices into the ``designcache``
+            directory of ``work_dir``, the runs and subjects with identical designs
+            (events, repetition time, confounds, ...) then reuse them
+        censor_outliers : bool
+            drop the scans flagged by the outlier (spike) regressors of the
+            selected confounds, instead of fitting a regressor for each
+        compression_level : int
+            gzip compression level (0 to 9) of the nifti outputs,
+            0 saves uncompressed (.nii) files
         database_path : str
             Path to a BIDS database
         derivatives_pipeline_dir : str
             Root directory of the derivatives pipeline
+        estimation_space : str
+            Fit the models on the time series of the voxels ('voxels')
+            or of the parcels of the atlas ('parcels')
         exclude_description_label : str or None
             Exclude bold series containing this description label
         fir_delays : list or None
@@ -63,10 +90,26 @@ def init_nibetaseries_participant_wf(
         high_pass : float
             High pass filter to apply to bold (in Hertz).
             Reminder - frequencies _higher_ than this number are kept.
+        mem_budget_gb : float or None
+            Memory budget (in gigabytes) to fit the models of a bold run
+            in blocks of voxels
+        n_jobs : int
+            Number of workers fitting the trial models of a bold run in parallel
+        noise_model : str
+            Temporal noise model, AR(1) prewhitening ('ar1') or none ('ols')
         norm_betas : Bool
             If True, beta estimates are divided by the square root of their variance
         output_dir : str
             Directory where derivatives are saved
+        precision : str
+            Floating point precision ('float64' or 'float32') of the bold data,
+            the model fits, and the beta series
+        restrict_to_atlas : bool
+            Only model the voxels of the brain mask with a label in the atlas
+            (the voxels used by the correlations)
+        return_masked_betaseries : bool
+            Output each beta series as a float32 trials by masked voxels
+            numpy (.npy) file (and its mask) into the derivatives directory
         return_residuals : bool
             Output the residuals from the betaseries model into the
             derivatives directory
@@ -86,11 +129,18 @@ def init_nibetaseries_participant_wf(
             List of subject labels
         task_label : str or None
             Include bold series containing this task label
+        trial_types : list or None
+            trial types (or regular expressions) fit as target trials (LSS only),
+            None fits every trial
         description_label : str or None
             Include bold series containing this description label
         work_dir : str
             Directory in which to store workflow execution state and temporary files
     """
+    if estimation_space == 'parcels' and not (atlas_img and atlas_lut):
+        raise ValueError("the parcels estimation space needs an atlas image "
+                         "and lookup table")
+
     # setup workflow
     nibetaseries_participant_wf = Workflow(name='nibetaseries_participant_wf')
     nibetaseries_participant_wf.base_dir = os.path.join(work_dir, 'NiBetaSeries_work')
@@ -140,6 +190,9 @@ It is released under the [CC0]\
                         database_path=database_path,
                         reset_database=reset_database)
 
+    bold_cache_dir = os.path.join(work_dir, 'boldcache') if cache_bold else None
+    design_cache_dir = os.path.join(work_dir, 'designcache') if cache_designs else None
+
     for subject_label in subject_list:
         # collect the necessary inputs for both collect data
         subject_data = collect_data(layout,
@@ -158,23 +211,38 @@ It is released under the [CC0]\
 
         single_subject_wf = init_single_subject_wf(
             estimator=estimator,
+            ar1_estimate=ar1_estimate,
             atlas_img=atlas_img,
             atlas_lut=atlas_lut,
+            batch_runs=batch_runs,
+            beta_series_format=beta_series_format,
+            bold_cache_dir=bold_cache_dir,
             bold_metadata_list=bold_metadata_list,
             brainmask_list=brainmask_list,
+            censor_outliers=censor_outliers,
+            compression_level=compression_level,
             confound_tsv_list=confound_tsv_list,
+            design_cache_dir=design_cache_dir,
+            estimation_space=estimation_space,
             events_tsv_list=events_tsv_list,
             fir_delays=fir_delays,
             hrf_model=hrf_model,
             high_pass=high_pass,
+            mem_budget_gb=mem_budget_gb,
             name='single_subject' + subject_label + '_wf',
+            n_jobs=n_jobs,
+            noise_model=noise_model,
             norm_betas=norm_betas,
             output_dir=output_dir,
+            precision=precision,
             preproc_img_list=preproc_img_list,
+            restrict_to_atlas=restrict_to_atlas,
+            return_masked_betaseries=return_masked_betaseries,
             return_residuals=return_residuals,
             selected_confounds=selected_confounds,
             signal_scaling=signal_scaling,
             smoothing_kernel=smoothing_kernel,
+            trial_types=trial_types,
         )
 
         # add nibetaseries to the output directory because of DerivativesDataSink class
@@ -191,10 +259,15 @@ It is released under the [CC0]\
 
 
 def init_single_subject_wf(
-    estimator, atlas_img, atlas_lut, bold_metadata_list, brainmask_list,
-    confound_tsv_list, events_tsv_list, fir_delays, hrf_model, high_pass,
-    name, norm_betas, output_dir, preproc_img_list, return_residuals,
-    selected_confounds, signal_scaling, smoothing_kernel,
+    estimator, ar1_estimate, atlas_img, atlas_lut, batch_runs, beta_series_format,
+    bold_cache_dir, bold_metadata_list,
+    brainmask_list, censor_outliers, compression_level, confound_tsv_list, design_cache_dir,
+    estimation_space, events_tsv_list,
+    fir_delays,
+    hrf_model, high_pass, mem_budget_gb, name, n_jobs, noise_model, norm_betas, output_dir,
+    precision,
+    preproc_img_list, restrict_to_atlas, return_masked_betaseries, return_residuals,
+    selected_confounds, signal_scaling, smoothing_kernel, trial_types,
         ):
     """
     This workflow completes the generation of the betaseries files
@@ -206,36 +279,75 @@ def init_single_subject_wf(
         from nibetaseries.workflows.base import init_single_subject_wf
         wf = init_single_subject_wf(
             estimator='lss',
+            ar1_estimate='trial',
             atlas_img='',
             atlas_lut='',
+            batch_runs=False,
+            beta_series_format='nifti',
+            bold_cache_dir=None,
             bold_metadata_list=[''],
             brainmask_list=[''],
+            censor_outliers=False,
+            compression_level=1,
             confound_tsv_list=[''],
+            design_cache_dir=None,
+            estimation_space='voxels',
             events_tsv_list=[''],
             fir_delays=None,
             hrf_model='',
             high_pass='',
+            mem_budget_gb=None,
             name='subtest',
+            n_jobs=1,
+            noise_model='ar1',
             norm_betas=False,
             output_dir='.',
+            precision='float64',
             preproc_img_list=[''],
+            restrict_to_atlas=False,
+            return_masked_betaseries=False,
+            return_residuals=False,
             selected_confounds=[''],
             signal_scaling=0,
-            smoothing_kernel=0.0)
+            smoothing_kernel=0.0,
+            trial_types=None)
 
     Parameters
     ----------
 
+        ar1_estimate : str
+            estimate the AR(1) coefficients from each LSS trial model ('trial'),
+            or once from the model with one regressor per condition ('condition')
         atlas_img : str or None
             path to input atlas nifti
         atlas_lut : str or None
             path to input atlas lookup table (tsv)
+        batch_runs : bool
+            fit all the bold runs one after the other in a single node,
+            the outputs of each run are then selected for its derivatives
+        beta_series_format : str
+            file format of the beta series ('nifti' or 'hdf5')
+        bold_cache_dir : str or None
+            directory caching the gzipped bold runs as uncompressed
+            (memory mapped) files, None reads the bold runs directly
         bold_metadata_list : list
             list of bold metadata associated with each preprocessed file
         brainmask_list : list
             list of brain masks
+        censor_outliers : bool
+            drop the scans flagged by the outlier (spike) regressors of the
+            selected confounds, instead of fitting a regressor for each
+        compression_level : int
+            gzip compression level (0 to 9) of the nifti outputs,
+            0 saves uncompressed (.nii) files
         confound_tsv_list : list
             list of confound tsvs (e.g. from FMRIPREP)
+        design_cache_dir : str or None
+            directory caching the factorizations of the design matrices, shared
+            by the runs with identical designs, None factorizes every design
+        estimation_space : str
+            fit the models on the time series of the voxels ('voxels'), or of the
+            parcels of the atlas ('parcels') to get parcel (tsv) beta series
         events_tsv_list : list
             list of event tsvs
         fir_delays : list or None
@@ -245,14 +357,30 @@ def init_single_subject_wf(
         high_pass : float
             High pass filter to apply to bold (in Hertz).
             Reminder - frequencies _higher_ than this number are kept.
+        mem_budget_gb : float or None
+            memory budget (in gigabytes) to fit the models of a bold run
+            in blocks of voxels
+        n_jobs : int
+            number of workers fitting the trial models of a bold run in parallel
+        noise_model : str
+            temporal noise model, AR(1) prewhitening ('ar1') or none ('ols')
         norm_betas : Bool
             If True, beta estimates are divided by the square root of their variance
         name : str
             name of the workflow (e.g. ``subject-01_wf``)
         output_dir : str
             Directory where derivatives are saved
+        precision : str
+            floating point precision ('float64' or 'float32') of the bold data,
+            the model fits, and the beta series
         preproc_img_list : list
             list of preprocessed bold files
+        restrict_to_atlas : bool
+            only model the voxels of the brain masks with a label in the atlas
+            (the voxels used by the correlations)
+        return_masked_betaseries : bool
+            Output each beta series as a float32 trials by masked voxels
+            numpy (.npy) file (and its mask) into the derivatives directory
         return_residuals : bool
             Output the residuals from the betaseries model into the
             derivatives directory
@@ -262,6 +390,9 @@ def init_single_subject_wf(
             Whether (0) or not (False) to scale each voxel's timeseries
         smoothing_kernel : float or None
             the size of the smoothing kernel (full width/half max) applied to the bold file (in mm)
+        trial_types : list or None
+            trial types (or regular expressions) fit as target trials (LSS only),
+            None fits every trial
 
    Inputs
    ------
@@ -292,6 +423,14 @@ def init_single_subject_wf(
     workflow = Workflow(name=name)
 
     # name the nodes
+    run_iterables = [('brainmask', brainmask_list),
+                     ('confound_tsv', confound_tsv_list),
+                     ('events_tsv', events_tsv_list),
+                     ('preproc_img', preproc_img_list),
+                     ('bold_metadata', bold_metadata_list)]
+    if batch_runs:
+        # (the index of each run selects its outputs from the batched betaseries node)
+        run_iterables.append(('run_idx', list(range(len(preproc_img_list)))))
     input_node = pe.Node(niu.IdentityInterface(fields=['atlas_img',
                                                        'atlas_lut',
                                                        'bold_metadata',
@@ -299,33 +438,48 @@ def init_single_subject_wf(
                                                        'confound_tsv',
                                                        'events_tsv',
                                                        'preproc_img',
+                                                       'run_idx',
                                                        ]),
                          name='input_node',
-                         iterables=[('brainmask', brainmask_list),
-                                    ('confound_tsv', confound_tsv_list),
-                                    ('events_tsv', events_tsv_list),
-                                    ('preproc_img', preproc_img_list),
-                                    ('bold_metadata', bold_metadata_list)],
+                         iterables=run_iterables,
                          synchronize=True)
 
     output_node = pe.Node(niu.IdentityInterface(fields=['correlation_matrix',
                                                         'correlation_fig',
                                                         'betaseries_file',
+                                                        'masked_betaseries_file',
+                                                        'betaseries_mask_file',
                                                         'residual_file']),
                           name='output_node')
 
     # initialize the betaseries workflow
     betaseries_wf = init_betaseries_wf(estimator=estimator,
+                                       ar1_estimate=ar1_estimate,
+                                       batch_runs=batch_runs,
+                                       beta_series_format=beta_series_format,
+                                       bold_cache_dir=bold_cache_dir,
+                                       censor_outliers=censor_outliers,
+                                       compression_level=compression_level,
+                                       design_cache_dir=design_cache_dir,
+                                       estimation_space=estimation_space,
                                        fir_delays=fir_delays,
                                        hrf_model=hrf_model,
                                        high_pass=high_pass,
+                                       mem_budget_gb=mem_budget_gb,
+                                       n_jobs=n_jobs,
+                                       noise_model=noise_model,
                                        norm_betas=norm_betas,
+                                       precision=precision,
+                                       restrict_to_atlas=restrict_to_atlas,
+                                       return_masked_betaseries=return_masked_betaseries,
+                                       return_residuals=return_residuals,
                                        selected_confounds=selected_confounds,
                                        signal_scaling=signal_scaling,
-                                       smoothing_kernel=smoothing_kernel)
+                                       smoothing_kernel=smoothing_kernel,
+                                       trial_types=trial_types)
 
     # initialize the analysis workflow
-    correlation_wf = init_correlation_wf()
+    correlation_wf = init_correlation_wf(precision=precision)
 
     # correlation matrix datasink
     ds_correlation_matrix = pe.MapNode(DerivativesDataSink(base_directory=output_dir),
@@ -341,15 +495,45 @@ def init_single_subject_wf(
                                     name='ds_betaseries_file')
 
     # connect the nodes for the beta series workflow
+    if batch_runs:
+        # every run is fit by the same node (upstream of the run iterables),
+        # the outputs of each run are selected for the nodes iterating over the runs
+        betaseries_inputs = betaseries_wf.get_node('input_node').inputs
+        betaseries_inputs.bold_file = preproc_img_list
+        betaseries_inputs.events_file = events_tsv_list
+        betaseries_inputs.bold_mask_file = brainmask_list
+        betaseries_inputs.confounds_file = confound_tsv_list
+        betaseries_inputs.bold_metadata = bold_metadata_list
+
+        select_run = pe.Node(niu.Function(function=_select_run,
+                                          output_names=['betaseries_files',
+                                                        'masked_betaseries_files',
+                                                        'betaseries_mask_file',
+                                                        'residual_file']),
+                             name='select_run')
+        workflow.connect([
+            (input_node, select_run, [('run_idx', 'run_idx')]),
+            (betaseries_wf, select_run,
+                [('output_node.betaseries_files', 'betaseries_files'),
+                 ('output_node.masked_betaseries_files', 'masked_betaseries_files'),
+                 ('output_node.betaseries_mask_file', 'betaseries_mask_file'),
+                 ('output_node.residual_file', 'residual_file')]),
+        ])
+        betaseries_outputs, outputs_prefix = select_run, ''
+    else:
+        workflow.connect([
+            (input_node, betaseries_wf,
+                [('preproc_img', 'input_node.bold_file'),
+                 ('events_tsv', 'input_node.events_file'),
+                 ('brainmask', 'input_node.bold_mask_file'),
+                 ('confound_tsv', 'input_node.confounds_file'),
+                 ('bold_metadata', 'input_node.bold_metadata')]),
+        ])
+        betaseries_outputs, outputs_prefix = betaseries_wf, 'output_node.'
+
     workflow.connect([
-        (input_node, betaseries_wf,
-            [('preproc_img', 'input_node.bold_file'),
-             ('events_tsv', 'input_node.events_file'),
-             ('brainmask', 'input_node.bold_mask_file'),
-             ('confound_tsv', 'input_node.confounds_file'),
-             ('bold_metadata', 'input_node.bold_metadata')]),
-        (betaseries_wf, output_node,
-            [('output_node.betaseries_files', 'betaseries_file')]),
+        (betaseries_outputs, output_node,
+            [(outputs_prefix + 'betaseries_files', 'betaseries_file')]),
         (input_node, ds_betaseries_file, [('preproc_img', 'source_file')]),
         (output_node, ds_betaseries_file, [('betaseries_file', 'in_file')]),
     ])
@@ -364,15 +548,33 @@ def init_single_subject_wf(
                                             output_names=["beta_series_list"]),
                                          name="check_beta_series_list")
 
-        censor_volumes = pe.MapNode(CensorVolumes(),
+        censor_volumes = pe.MapNode(CensorVolumes(precision=precision,
+                                                  compression_level=compression_level,
+                                                  mem_budget_gb=mem_budget_gb),
                                     iterfield=['timeseries_file'],
                                     name='censor_volumes')
 
+        if restrict_to_atlas:
+            # the outlier volumes are found from the (estimated) voxels of the atlas
+            censor_mask = pe.Node(niu.Function(function=_atlas_support_mask_file,
+                                               output_names=['mask_file']),
+                                  name='censor_mask')
+            workflow.connect([
+                (input_node, censor_mask,
+                    [('brainmask', 'brainmask'),
+                     ('atlas_img', 'atlas_img')]),
+                (censor_mask, censor_volumes,
+                    [('mask_file', 'mask_file')]),
+            ])
+        else:
+            workflow.connect([
+                (input_node, censor_volumes,
+                    [('brainmask', 'mask_file')]),
+            ])
+
         workflow.connect([
-            (input_node, censor_volumes,
-                [('brainmask', 'mask_file')]),
-            (betaseries_wf, censor_volumes,
-                [('output_node.betaseries_files', 'timeseries_file')]),
+            (betaseries_outputs, censor_volumes,
+                [(outputs_prefix + 'betaseries_files', 'timeseries_file')]),
             (censor_volumes, check_beta_series_list,
                 [('censored_file', 'beta_series_list')]),
             (check_beta_series_list, correlation_wf,
@@ -389,14 +591,53 @@ def init_single_subject_wf(
             (output_node, ds_correlation_fig, [('correlation_fig', 'in_file')]),
         ])
 
+        if (estimation_space == 'parcels' or restrict_to_atlas) and batch_runs:
+            betaseries_wf.get_node('input_node').inputs.atlas_file = atlas_img
+        elif estimation_space == 'parcels' or restrict_to_atlas:
+            # the beta series are estimated from the parcels of the atlas
+            # (or from the voxels of the parcels)
+            workflow.connect([
+                (input_node, betaseries_wf,
+                    [('atlas_img', 'input_node.atlas_file')]),
+            ])
+
+    if return_masked_betaseries:
+        ds_masked_betaseries_file = pe.MapNode(
+            DerivativesDataSink(base_directory=output_dir),
+            iterfield=['in_file'],
+            name='ds_masked_betaseries_file')
+
+        workflow.connect([
+            (betaseries_outputs, output_node,
+                [(outputs_prefix + 'masked_betaseries_files', 'masked_betaseries_file')]),
+            (output_node, ds_masked_betaseries_file,
+                [('masked_betaseries_file', 'in_file')]),
+            (input_node, ds_masked_betaseries_file,
+                [('preproc_img', 'source_file')]),
+        ])
+
+    if return_masked_betaseries and estimation_space == 'voxels':
+        # (the columns of parcel beta series are the atlas labels)
+        ds_betaseries_mask_file = pe.Node(DerivativesDataSink(base_directory=output_dir),
+                                          name='ds_betaseries_mask_file')
+
+        workflow.connect([
+            (betaseries_outputs, output_node,
+                [(outputs_prefix + 'betaseries_mask_file', 'betaseries_mask_file')]),
+            (output_node, ds_betaseries_mask_file,
+                [('betaseries_mask_file', 'in_file')]),
+            (input_node, ds_betaseries_mask_file,
+                [('preproc_img', 'source_file')]),
+        ])
+
     if return_residuals:
         ds_residual_file = pe.MapNode(DerivativesDataSink(base_directory=output_dir),
                                       iterfield=['in_file'],
                                       name='ds_residual_file')
 
         workflow.connect([
-            (betaseries_wf, output_node,
-                [('output_node.residual_file', 'residual_file')]),
+            (betaseries_outputs, output_node,
+                [(outputs_prefix + 'residual_file', 'residual_file')]),
             (output_node, ds_residual_file,
                 [('residual_file', 'in_file')]),
             (input_node, ds_residual_file,
@@ -406,17 +647,41 @@ def init_single_subject_wf(
     return workflow
 
 
+def _select_run(run_idx, betaseries_files, masked_betaseries_files=None,
+                betaseries_mask_file=None, residual_file=None):
+    """select the outputs of a run from the outputs of all the runs"""
+    return tuple(None if run_outputs is None else run_outputs[run_idx]
+                 for run_outputs in (betaseries_files, masked_betaseries_files,
+                                     betaseries_mask_file, residual_file))
+
+
+def _atlas_support_mask_file(brainmask, atlas_img):
+    """save the voxels of the brain mask with an atlas label"""
+    import os
+
+    from nibetaseries.interfaces.nistats import _atlas_support_mask
+
+    mask_file = os.path.abspath('desc-atlassupport_mask.nii.gz')
+    _atlas_support_mask(brainmask, atlas_img).to_filename(mask_file)
+    return mask_file
+
+
 def _check_bs_len(beta_series_list):
     """make sure each beta series at least 3 betas"""
     import logging
     import re
 
     import nibabel as nib
+    import pandas as pd
 
     min_size = 3
 
     def check_beta_series(beta_series, min_size):
-        size = nib.load(beta_series).shape[-1]
+        if beta_series.endswith('.tsv'):
+            # a parcel beta series has a row per trial
+            size = len(pd.read_csv(beta_series, sep='\t'))
+        else:
+            size = nib.load(beta_series).shape[-1]
         if size < min_size:
             mtch = re.match(".*desc-(?P<trial_type>[0-9A-Za-z]+)_.*", beta_series)
             if mtch:
@@ -15,18 +15,35 @@ from niworkflows.engine.workflows import LiterateWorkflow as Workflow
 
 from nistats import __version__ as nistats_ver
 
-from ..interfaces.nistats import LSSBetaSeries, LSABetaSeries
+from ..interfaces.nistats import (LSSBetaSeries, LSABetaSeries,
+                                  LSSBetaSeriesRuns, LSABetaSeriesRuns)
 
 
 def init_betaseries_wf(name="betaseries_wf",
                        estimator='lss',
+                       ar1_estimate='trial',
+                       batch_runs=False,
+                       beta_series_format='nifti',
+                       bold_cache_dir=None,
+                       censor_outliers=False,
+                       compression_level=1,
+                       design_cache_dir=None,
+                       estimation_space='voxels',
                        fir_delays=None,
                        hrf_model='glover',
                        high_pass=0.0078125,
+                       mem_budget_gb=None,
+                       n_jobs=1,
+                       noise_model='ar1',
                        norm_betas=False,
+                       precision='float64',
+                       restrict_to_atlas=False,
+                       return_masked_betaseries=False,
+                       return_residuals=False,
                        signal_scaling=0,
                        selected_confounds=None,
                        smoothing_kernel=None,
+                       trial_types=None,
                        ):
     """Derives Beta Series Maps
     This workflow derives beta series maps from a bold file.
@@ -49,6 +66,34 @@ def init_betaseries_wf(name="betaseries_wf",
     ----------
     name : str
         Name of workflow (default: ``betaseries_wf``)
+    ar1_estimate : str
+        estimate the AR(1) coefficients from each trial model (``trial``), or once from
+        the model with one regressor per condition (``condition``), so that the data are
+        prewhitened once for every trial model (LSS only, default: ``trial``)
+    batch_runs : Bool
+        If True, the inputs are lists of bold runs (e.g., all the runs of a subject)
+        fit one after the other by a single node, and the outputs are lists with
+        the outputs of each run (default: False)
+    beta_series_format : str
+        file format of the beta series, ``nifti`` (.nii.gz) or ``hdf5`` (.h5)
+        (default: ``nifti``)
+    bold_cache_dir : str or None
+        directory caching the gzipped bold run as an uncompressed file, that is
+        memory mapped by the model(s) and shared with reruns (default: None)
+    censor_outliers : Bool
+        If True, the scans flagged by the outlier (spike) regressors of the
+        ``selected_confounds`` (e.g., ``motion_outlier.*``) are dropped from the model(s)
+        instead of being fit by a regressor each, with the same estimates (default: False)
+    compression_level : int
+        gzip compression level (0 to 9) of the nifti outputs, 0 saves
+        uncompressed (.nii) files (default: 1)
+    design_cache_dir : str or None
+        directory caching the factorizations of the design matrices, that are
+        reused by the runs (and subjects) with identical designs (default: None)
+    estimation_space : str
+        fit the model(s) on the time series of the voxels (``voxels``), or on the
+        mean time series of the parcels of the ``atlas_file`` input (``parcels``),
+        for beta series (tsv) with a column per parcel (default: ``voxels``)
     fir_delays : list or None
         FIR delays (in scans)
     hrf_model : str
@@ -56,20 +101,46 @@ def init_betaseries_wf(name="betaseries_wf",
     high_pass : float
         high pass filter to apply to bold (in Hertz).
         Reminder - frequencies _lower_ than this number are kept.
+    mem_budget_gb : float or None
+        memory budget (in gigabytes) to fit the model(s) in blocks of voxels
+        (default: None, all voxels are fit at once)
+    n_jobs : int
+        number of workers fitting the trial models in parallel, and of threads
+        compressing the nifti outputs (LSS only, default: 1), each LSS worker
+        sums the residuals of its trials in an array as large as the masked data
+    noise_model : str
+        temporal noise model, AR(1) prewhitening (``ar1``) or none, i.e., ordinary
+        least squares (``ols``) (default: ``ar1``)
     norm_betas : Bool
         If True, beta estimates are divided by the square root of their variance
+    precision : str
+        floating point precision ('float64' or 'float32') of the bold data,
+        the model fit(s), and the beta series (default: ``float64``)
+    restrict_to_atlas : Bool
+        If True, only the voxels of the brain mask with a (nonzero) label in the
+        ``atlas_file`` input are modeled (default: False)
+    return_masked_betaseries : Bool
+        If True, each beta series is also saved as a float32 trials by masked
+        voxels numpy (.npy) file, with the mask of its voxels (default: False)
+    return_residuals : Bool
+        If True, the residuals of the model(s) are calculated (default: False)
     selected_confounds : list or None
         the list of confounds to be included in regression.
     signal_scaling : False or 0
         Whether (0) or not (False) to scale each voxel's timeseries
     smoothing_kernel : float or None
         The size of the smoothing kernel (full width/half max) applied to the bold file (in mm)
+    trial_types : list or None
+        trial types (or regular expressions) whose trials are fit as target trials (LSS only),
+        the events of the other trial types are only modeled as conditions
+        (default: None, every trial is fit)
 
     Inputs
     ------
 
     bold_file
-        The bold file from the derivatives (e.g., fmriprep) dataset.
+        The bold file from the derivatives (e.g., fmriprep) dataset
+        (the inputs of a run are lists of runs with ``batch_runs``).
     events_file
         The events tsv from the BIDS dataset.
     bold_mask_file
@@ -78,15 +149,27 @@ def init_betaseries_wf(name="betaseries_wf",
         dictionary of relevant metadata of bold sequence
     confounds_file
         The tsv file from the derivatives (e.g., fmriprep) dataset.
+    atlas_file
+        The atlas image of the parcels (only with the ``parcels`` estimation space,
+        or to ``restrict_to_atlas``).
 
     Outputs
     -------
 
     betaseries_files
         One file per trial type, with each file being
-        as long as the number of events for that trial type.
+        as long as the number of events for that trial type
+        (the outputs are lists with the outputs of each run with ``batch_runs``).
+    masked_betaseries_files
+        One float32 trials by masked voxels numpy (.npy) file per trial type
+        (only when ``return_masked_betaseries`` is True).
+        ``numpy.load(masked_betaseries_file, mmap_mode='r')`` maps it without a copy.
+    betaseries_mask_file
+        The mask of the voxels (columns) of the masked beta series
+        (only when ``return_masked_betaseries`` is True).
     residual_file
-        The residual time series after running beta series.
+        The residual time series after running beta series
+        (only when ``return_residuals`` is True).
         For LSA this is straight forward, but be cautious when
         interpreting residuals from LSS.
 
@@ -102,6 +185,11 @@ def init_betaseries_wf(name="betaseries_wf",
         signal_scaling=signal_scaling,
         estimator=estimator,
         fir_delays=fir_delays,
+        estimation_space=estimation_space,
+        trial_types=trial_types,
+        censor_outliers=censor_outliers,
+        noise_model=noise_model,
+        ar1_estimate=ar1_estimate,
     )
 
     input_node = pe.Node(niu.IdentityInterface(fields=['bold_file',
@@ -109,30 +197,58 @@ def init_betaseries_wf(name="betaseries_wf",
                                                        'bold_mask_file',
                                                        'bold_metadata',
                                                        'confounds_file',
+                                                       'atlas_file',
                                                        ]),
                          name='input_node')
 
     if estimator == 'lss':
-        betaseries_node = pe.Node(LSSBetaSeries(
+        betaseries_node = pe.Node((LSSBetaSeriesRuns if batch_runs else LSSBetaSeries)(
                 fir_delays=fir_delays,
                 selected_confounds=selected_confounds,
                 signal_scaling=signal_scaling,
                 hrf_model=hrf_model,
                 return_tstat=norm_betas,
+                return_residuals=return_residuals,
+                return_masked_betaseries=return_masked_betaseries,
+                precision=precision,
+                beta_series_format=beta_series_format,
+                censor_outliers=censor_outliers,
+                compression_level=compression_level,
+                compression_threads=n_jobs,
+                bold_cache_dir=bold_cache_dir,
+                design_cache_dir=design_cache_dir,
                 smoothing_kernel=smoothing_kernel,
-                high_pass=high_pass),
-            name='betaseries_node')
+                high_pass=high_pass,
+                mem_budget_gb=mem_budget_gb,
+                trial_types=trial_types,
+                noise_model=noise_model,
+                ar1_estimate=ar1_estimate,
+                n_jobs=n_jobs),
+            name='betaseries_node',
+            n_procs=n_jobs)
     elif estimator == 'lsa':
-        betaseries_node = pe.Node(LSABetaSeries(
+        betaseries_node = pe.Node((LSABetaSeriesRuns if batch_runs else LSABetaSeries)(
                 selected_confounds=selected_confounds,
                 signal_scaling=signal_scaling,
                 hrf_model=hrf_model,
                 return_tstat=norm_betas,
+                return_residuals=return_residuals,
+                return_masked_betaseries=return_masked_betaseries,
+                precision=precision,
+                beta_series_format=beta_series_format,
+                censor_outliers=censor_outliers,
+                compression_level=compression_level,
+                bold_cache_dir=bold_cache_dir,
+                design_cache_dir=design_cache_dir,
                 smoothing_kernel=smoothing_kernel,
-                high_pass=high_pass),
+                high_pass=high_pass,
+                mem_budget_gb=mem_budget_gb,
+                noise_model=noise_model),
             name='betaseries_node')
 
     output_node = pe.Node(niu.IdentityInterface(fields=['betaseries_files',
+                                                        'masked_betaseries_files',
+                                                        'betaseries_mask_file',
                                                         'residual_file']),
                           name='output_node')
 
@@ -144,15 +260,28 @@ def init_betaseries_wf(name="betaseries_wf",
                                        ('bold_metadata', 'bold_metadata'),
                                        ('confounds_file', 'confounds_file')]),
         (betaseries_node, output_node, [('beta_maps', 'betaseries_files'),
+                                        ('masked_beta_maps', 'masked_betaseries_files'),
+                                        ('mask_file', 'betaseries_mask_file'),
                                         ('residual', 'residual_file')]),
     ])
 
+    if estimation_space == 'parcels':
+        workflow.connect([
+            (input_node, betaseries_node, [('atlas_file', 'atlas_file')]),
+        ])
+    elif restrict_to_atlas:
+        workflow.connect([
+            (input_node, betaseries_node, [('atlas_file', 'atlas_support_file')]),
+        ])
+
     return workflow
 
 
 def gen_wf_description(nistats_ver, fwhm, hrf, hpf,
                        selected_confounds, signal_scaling,
-                       estimator, norm_betas, fir_delays=None):
+                       estimator, norm_betas, fir_delays=None, estimation_space='voxels',
+                       trial_types=None, censor_outliers=False, noise_model='ar1',
+                       ar1_estimate='trial'):
     from textwrap import dedent
 
     smooth_str = ('smoothed with a Gaussian kernel with a FWHM of {fwhm} mm,'
@@ -160,8 +289,12 @@ def gen_wf_description(nistats_ver, fwhm, hrf, hpf,
                   if fwhm != 0. else '')
     signal_scale_str = ', and mean-scaled over time.' if signal_scaling == 0 else '.'
 
-    preproc_str = ('Prior to modeling, preprocessed data were {smooth_str}masked{signal_scale_str}'
-                   .format(smooth_str=smooth_str, signal_scale_str=signal_scale_str))
+    parcel_str = (', averaged within each parcel of the atlas'
+                  if estimation_space == 'parcels' else '')
+    preproc_str = ('Prior to modeling, preprocessed data were '
+                   '{smooth_str}masked{parcel_str}{signal_scale_str}'
+                   .format(smooth_str=smooth_str, parcel_str=parcel_str,
+                           signal_scale_str=signal_scale_str))
 
     beta_series_tmp = dedent("""
         After fitting {n_models} model, the{normed} parameter estimate (i.e., beta) map
@@ -236,6 +369,12 @@ def gen_wf_description(nistats_ver, fwhm, hrf, hpf,
     else:
         raise ValueError("{est} not a supported estimator".format(est=estimator))
 
+    if estimator == "lss" and trial_types:
+        estimator_str += dedent("""
+            Only the trials of the {trial_types} conditions were modeled as target trials,
+            the other events were only modeled in their condition regressors.\
+            """.format(trial_types=', '.join(trial_types)))
+
     hrf_str = dedent("""\
         Each condition regressor was convolved with a
         "{hrf}" hemodynamic response function for the model.\
@@ -244,15 +383,39 @@ def gen_wf_description(nistats_ver, fwhm, hrf, hpf,
     confound_str = (', '.join(selected_confounds) + ' and ' if
                     selected_confounds else '')
 
+    if noise_model == 'ols':
+        noise_str = 'No prewhitening was applied (ordinary least squares).'
+    elif estimator == 'lss' and ar1_estimate == 'condition':
+        noise_str = dedent("""\
+            AR(1) prewhitening was applied in each model to account for temporal
+            autocorrelation, with the AR(1) coefficients estimated once from a model
+            with one regressor per condition.\
+            """)
+    else:
+        noise_str = dedent("""\
+            AR(1) prewhitening was applied in each model to account for temporal
+            autocorrelation.\
+            """)
+
     confound_desc = dedent("""\
         In addition to condition regressors, {confound_str}a
         high-pass filter of {hpf} Hz (implemented using a cosine drift model) {is_mult_confs}
         included in the model.
-        AR(1) prewhitening was applied in each model to account for temporal
-        autocorrelation.\
-        """.format(confound_str=confound_str,
-                   hpf=hpf,
-                   is_mult_confs='were' if len(confound_str) else 'was'))
+        {noise_str}\
+        """).format(confound_str=confound_str,
+                    hpf=hpf,
+                    is_mult_confs='were' if len(confound_str) else 'was',
+                    noise_str=noise_str)
+    if censor_outliers and noise_model == 'ols':
+        confound_desc += dedent("""
+            Instead of being modeled by their outlier regressors, outlier volumes were
+            censored (i.e., dropped from the model).\
+            """)
+    elif censor_outliers:
+        confound_desc += dedent("""
+            Instead of being modeled by their outlier regressors, outlier volumes were
+            censored, with the AR(1) model spanning the censored volumes.\
+            """)
 
     # combine all sentences
     description = dedent("""\
@@ -5,21 +5,26 @@ import nibabel as nib
 import numpy as np
 import pytest
 
-from ..base import init_nibetaseries_participant_wf, _check_bs_len
+from ..base import init_nibetaseries_participant_wf, _atlas_support_mask_file, _check_bs_len
 
 
 @pytest.mark.parametrize(
-    "estimator,fir_delays,hrf_model,signal_scaling,norm_betas",
+    "estimator,fir_delays,hrf_model,signal_scaling,norm_betas,estimation_space,restrict_to_atlas,"
+    "batch_runs",
     [
-        ('lsa', None, 'spm', 0, True),
-        ('lss', None, 'spm', False, False),
-        ('lss', [0, 1, 2, 3, 4], 'fir', False, True),
+        ('lsa', None, 'spm', 0, True, 'voxels', False, False),
+        ('lss', None, 'spm', False, False, 'voxels', True, False),
+        ('lss', [0, 1, 2, 3, 4], 'fir', False, True, 'voxels', False, False),
+        ('lss', None, 'glover', 0, False, 'parcels', False, False),
+        ('lss', None, 'glover', 0, False, 'voxels', False, True),
+        ('lsa', None, 'spm', 0, False, 'parcels', False, True),
     ]
 )
 def test_valid_init_nibetaseries_participant_wf(
         bids_dir, deriv_dir, sub_fmriprep, sub_top_metadata, bold_file, preproc_file,
         sub_events, confounds_file, brainmask_file, atlas_file, atlas_lut, bids_db_file,
-        estimator, fir_delays, hrf_model, signal_scaling, norm_betas):
+        estimator, fir_delays, hrf_model, signal_scaling, norm_betas, estimation_space,
+        restrict_to_atlas, batch_runs):
 
     output_dir = op.join(str(bids_dir), 'derivatives', 'atlasCorr')
     work_dir = op.join(str(bids_dir), 'derivatives', 'work')
@@ -34,17 +39,31 @@ def test_valid_init_nibetaseries_participant_wf(
 
     test_np_wf = init_nibetaseries_participant_wf(
         estimator=estimator,
+        ar1_estimate='trial',
         fir_delays=fir_delays,
         atlas_img=str(atlas_file),
         atlas_lut=str(atlas_lut),
+        batch_runs=batch_runs,
+        beta_series_format='nifti',
         bids_dir=str(bids_dir),
+        cache_bold=False,
+        cache_designs=False,
+        censor_outliers=False,
+        compression_level=1,
         database_path=str(bids_db_file),
         derivatives_pipeline_dir=deriv_dir,
+        estimation_space=estimation_space,
         exclude_description_label=None,
         hrf_model=hrf_model,
         high_pass=0.008,
+        mem_budget_gb=None,
+        n_jobs=1,
+        noise_model='ar1',
         norm_betas=norm_betas,
         output_dir=output_dir,
+        precision='float64',
+        restrict_to_atlas=restrict_to_atlas,
+        return_masked_betaseries=False,
         return_residuals=False,
         run_label=None,
         selected_confounds=['white_matter', 'csf'],
@@ -54,6 +73,7 @@ def test_valid_init_nibetaseries_participant_wf(
         space_label=None,
         subject_list=["01"],
         task_label=None,
+        trial_types=None,
         description_label=None,
         work_dir=work_dir)
 
@@ -81,17 +101,31 @@ def test_filters_init_nibetaseries_participant_wf(
     with pytest.raises(ValueError) as val_err:
         init_nibetaseries_participant_wf(
             estimator='lsa',
+            ar1_estimate='trial',
             fir_delays=None,
             atlas_img=None,
             atlas_lut=None,
+            batch_runs=False,
+            beta_series_format='nifti',
             bids_dir=str(bids_dir),
+            cache_bold=False,
+            cache_designs=False,
+            censor_outliers=False,
+            compression_level=1,
             database_path=None,
             derivatives_pipeline_dir=deriv_dir,
+            estimation_space='voxels',
             exclude_description_label=None,
             hrf_model='spm',
             high_pass=0.008,
+            mem_budget_gb=None,
+            n_jobs=1,
+            noise_model='ar1',
             norm_betas=False,
             output_dir=output_dir,
+            precision='float64',
+            restrict_to_atlas=False,
+            return_masked_betaseries=False,
             return_residuals=False,
             run_label=run_label,
             selected_confounds=['white_matter', 'csf'],
@@ -101,6 +135,7 @@ def test_filters_init_nibetaseries_participant_wf(
             space_label=space_label,
             subject_list=["01"],
             task_label=task_label,
+            trial_types=None,
             description_label=description_label,
             work_dir=work_dir)
 
@@ -123,13 +158,24 @@ def test_filters_init_nibetaseries_participant_wf(
           'sub-01_desc-biscuit_betaseries.nii.gz'],
          [2, 2],
          None),
+        (['sub-01_desc-jam_betaseries.tsv',
+          'sub-01_desc-toast_betaseries.tsv'],
+         [3, 2],
+         ['sub-01_desc-jam_betaseries.tsv']),
     ])
 def test_check_bs_len(fnames, lengths, expected_out, tmp_path):
+    import pandas as pd
+
     affine = np.eye(4)
     fpaths = []
     for fname, length in zip(fnames, lengths):
         fpath = tmp_path / fname
-        nib.Nifti2Image(np.zeros((1, 1, 1, length)), affine=affine).to_filename(str(fpath))
+        if fname.endswith('.tsv'):
+            # a parcel beta series
+            pd.DataFrame(np.zeros((length, 2)), columns=[1, 2]).to_csv(
+                str(fpath), sep='\t', index=False)
+        else:
+            nib.Nifti2Image(np.zeros((1, 1, 1, length)), affine=affine).to_filename(str(fpath))
         fpaths.append(str(fpath))
 
     if all(i < 3 for i in lengths):
@@ -138,3 +184,39 @@ def test_check_bs_len(fnames, lengths, expected_out, tmp_path):
         assert "None of the beta series" in str(rterr.value)
     else:
         assert [op.basename(f) for f in _check_bs_len(fpaths)] == expected_out
+
+
+def test_atlas_support_censoring(tmp_path, monkeypatch):
+    from ...interfaces.nilearn import CensorVolumes
+
+    monkeypatch.chdir(str(tmp_path))
+    # two of the four brain voxels have an atlas label
+    brainmask = str(tmp_path / 'brainmask.nii.gz')
+    nib.Nifti1Image(np.ones((1, 1, 4), dtype=np.int16), np.eye(4)).to_filename(brainmask)
+    atlas_img = str(tmp_path / 'atlas.nii.gz')
+    nib.Nifti1Image(np.array([[[1, 2, 0, 0]]], dtype=np.int16), np.eye(4)).to_filename(atlas_img)
+
+    # the beta series of every brain voxel, with an outlier trial
+    np.random.seed(3)
+    beta_data = np.random.rand(1, 1, 4, 20)
+    beta_data[..., 6] += 1000
+    beta_file = str(tmp_path / 'desc-full_betaseries.nii.gz')
+    nib.Nifti1Image(beta_data, np.eye(4)).to_filename(beta_file)
+    # and only of the voxels with an atlas label
+    restricted_data = beta_data.copy()
+    restricted_data[:, :, 2:] = 0
+    restricted_file = str(tmp_path / 'desc-restricted_betaseries.nii.gz')
+    nib.Nifti1Image(restricted_data, np.eye(4)).to_filename(restricted_file)
+
+    mask_file = _atlas_support_mask_file(brainmask, atlas_img)
+    np.testing.assert_array_equal(nib.load(mask_file).get_fdata(), [[[1, 1, 0, 0]]])
+
+    full = CensorVolumes(timeseries_file=beta_file, mask_file=brainmask).run()
+    restricted = CensorVolumes(timeseries_file=restricted_file, mask_file=mask_file).run()
+
+    # the same volumes are censored with and without restricting the voxels to the atlas
+    assert np.flatnonzero(full.outputs.outliers).tolist() == [6]
+    np.testing.assert_array_equal(restricted.outputs.outliers, full.outputs.outliers)
+    np.testing.assert_array_equal(
+        nib.load(restricted.outputs.censored_file).get_fdata()[:, :, :2],
+        nib.load(full.outputs.censored_file).get_fdata()[:, :, :2])